@@ -0,0 +1,171 @@
+# Cold start benchmark for the engine lambdas. Each handler is measured in a fresh python process, like a new Lambda
+# execution environment:
+# - import: time to import the handler module
+# - first invocation: first call of the handler, including creating boto3 clients
+# - second invocation: a warm call of the same handler
+#
+# AWS API calls never leave the process, a botocore "before-send" hook answers every request with a canned response.
+# Request signing, serialization and response parsing still run, so client creation and api call overhead is included.
+#
+# Usage, from the repository root:
+#   python modules/tf-svc-ctlg-engine/benchmarks/cold_start.py [--runs 5]
+
+import argparse
+import contextlib
+import datetime
+import importlib
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import zipfile
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda")
+# Local AWS stand-ins shared with the tests, see tests/local_aws.py
+TESTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests")
+sys.path.insert(0, TESTS_DIR)
+
+import local_aws
+
+OP_REQ = {
+    "token": "b3f9a7f7-a162-4fa5-b092-302c9afc0153",
+    "operation": "PROVISION_PRODUCT",
+    "provisionedProductId": "pp-wp3ziihdnvmse",
+    "provisionedProductName": "tf-s3-bucket-11261418",
+    "productId": "prod-xayh7l3a7e66m",
+    "provisioningArtifactId": "pa-qhjerwxbaulto",
+    "recordId": "rec-6zfcyj6jqsoj6",
+    "launchRoleArn": "arn:aws:iam::111111111111:role/ServiceCatalogLaunchRole",
+    "artifact": {"path": "S3://artifact-bucket/out/product.zip", "type": "AWS_S3"},
+    "identity": {"principal": "AROASGNG33TL2BDDOJDZK", "awsAccountId": "111111111111", "organizationId": None},
+    "parameters": [{"key": "bucket_name_prefix", "value": "asdfg"}],
+    "tags": [{"key": "finops_project_name", "value": "project-a"}],
+}
+
+STATE = {
+    "productOperationRequest": {k: OP_REQ[k] for k in ["token", "operation", "recordId", "provisionedProductId"]},
+    "codebuild": {
+        "environmentVariablesOverride": [
+            {"Name": "OUTPUTS_S3_URI", "Value": "s3://tfstate-bucket/111111111111/pp-wp3ziihdnvmse.outputs.json"},
+            {"Name": "STDERR_S3_URI", "Value": "s3://tfstate-bucket/111111111111/pp-wp3ziihdnvmse.stderr.txt"},
+        ],
+    },
+}
+
+# handler module: event
+EVENTS = {
+    "parameter_parser": {
+        "artifact": {"path": "s3://artifact-bucket/out/product.zip", "type": "AWS_S3"},
+        "launchRoleArn": OP_REQ["launchRoleArn"],
+    },
+    "start_product_operation": {
+        "Records": [{"messageId": "f828161a-aceb-4b26-bccf-c5e5106a0d1d", "body": json.dumps(OP_REQ)}],
+    },
+    "succeeded_product_operation": STATE,
+    "failed_product_operation": {
+        "State": dict(STATE, Error={"Error": "States.TaskFailed", "Cause": "{}"}),
+        "Context": {"Execution": {"Id": "arn:aws:states:us-east-1:111111111111:execution:x:y"}},
+    },
+}
+
+
+def artifact_zip():
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("main.tf", "# " + "x" * 4096)
+        zf.writestr(
+            "variables.tf.json",
+            json.dumps({"variable": {"bucket_name_prefix": {"type": "string", "default": "svc-ctlg-bucket-"}}}),
+        )
+    return buf.getvalue()
+
+
+def s3_get_object(url):
+    if url.endswith("product.zip"):
+        return 200, {}, artifact_zip()
+    if url.endswith(".outputs.json"):
+        return 200, {}, json.dumps({"bucket_name": {"sensitive": False, "type": "string", "value": "b"}}).encode()
+    if url.endswith(".stderr.txt"):
+        return 200, {}, b"Error: something failed\n"
+    return 404, {}, b"<Error><Code>NoSuchKey</Code><Message>The specified key does not exist.</Message></Error>"
+
+
+def canned_response(request, event_name, **kwargs):
+    import botocore.awsrequest
+
+    operation = event_name.split(".")[-1]
+    status, headers, body = 200, {}, b"{}"
+    if operation == "AssumeRole":
+        expiration = (datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)).isoformat()
+        body = (
+            "<AssumeRoleResponse><AssumeRoleResult><Credentials>"
+            "<AccessKeyId>ASIAEXAMPLE</AccessKeyId><SecretAccessKey>secret</SecretAccessKey>"
+            f"<SessionToken>token</SessionToken><Expiration>{expiration}</Expiration>"
+            "</Credentials></AssumeRoleResult></AssumeRoleResponse>"
+        ).encode()
+    elif operation == "HeadObject":
+        headers = {"ETag": '"d41d8cd98f00b204e9800998ecf8427e"'}
+        body = b""
+    elif operation == "GetObject":
+        status, headers, body = s3_get_object(request.url)
+    elif operation in ["PutObject", "DeleteObject"]:
+        body = b""
+    elif operation == "StartExecution":
+        body = json.dumps({"executionArn": "arn:aws:states:us-east-1:111111111111:execution:x:y", "startDate": 0})
+        body = body.encode()
+    headers = dict(headers, **{"Content-Length": str(len(body))})
+    return botocore.awsrequest.AWSResponse(request.url, status, headers, local_aws.RawResponse(body))
+
+
+# Runs in a fresh process, prints timings of one handler as json
+def measure(handler_module):
+    os.environ.update(local_aws.ENV)
+    sys.path.insert(0, LAMBDA_DIR)
+    event = EVENTS[handler_module]
+    timings = {}
+
+    # Handlers print their events and api calls, keep benchmark output readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        module = importlib.import_module(handler_module)
+        timings["import"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        importlib.import_module("clients").session().events.register("before-send", canned_response)
+        module.handler(event, local_aws.LambdaContext())
+        timings["first_invocation"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        module.handler(event, local_aws.LambdaContext())
+        timings["second_invocation"] = time.perf_counter() - start
+
+    print(json.dumps(timings))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure import time and first invocation latency of engine lambdas")
+    parser.add_argument("--runs", type=int, default=5, help="fresh processes per handler, the median is reported")
+    parser.add_argument("--measure", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.measure)
+        return
+
+    print(f"{'handler':<32}{'import ms':>12}{'first ms':>12}{'second ms':>12}")
+    for handler_module in EVENTS:
+        runs = []
+        for _ in range(args.runs):
+            out = subprocess.run(
+                [sys.executable, __file__, "--measure", handler_module], check=True, capture_output=True, text=True
+            ).stdout
+            runs.append(json.loads(out.splitlines()[-1]))
+        medians = [statistics.median(r[k] for r in runs) * 1000 for k in ["import", "first_invocation", "second_invocation"]]
+        print(f"{handler_module:<32}" + "".join(f"{m:>12.1f}" for m in medians))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+# Logging CPU time and log volume of a start_product_operation batch. Before log.py, handlers printed the full event,
+# each operation request, the state machine input and the StartExecution arguments as json, serializing the parameters
+# of a record three or four times. log.py logs size-capped payloads, and debug payloads only when debug is enabled.
+#
+# Each mode logs the payloads of one batch to a counting sink, CPU time is the median of --runs batches:
+# - print json: the logging of the handlers before log.py
+# - log.py INFO: default level, state machine input is a debug payload
+# - log.py DEBUG: full payloads, LOG_LEVEL=DEBUG or a debug sampled invocation
+#
+# Usage, from the repository root:
+#   python modules/tf-svc-ctlg-engine/benchmarks/log_cpu.py [--records 10] [--parameters 100] [--value-chars 2048]
+
+import argparse
+import contextlib
+import json
+import statistics
+import sys
+import time
+
+import cold_start
+
+
+class CountingSink:
+    def __init__(self):
+        self.chars = 0
+
+    def write(self, text):
+        self.chars += len(text)
+
+    def flush(self):
+        pass
+
+
+def batch(records, parameters, value_chars):
+    op_reqs = []
+    for i in range(records):
+        op_reqs.append(
+            dict(
+                cold_start.OP_REQ,
+                recordId=f"rec-{i}",
+                parameters=[{"key": f"parameter_{p}", "value": "v" * value_chars} for p in range(parameters)],
+            )
+        )
+    event = {
+        "Records": [
+            {"messageId": f"m-{i}", "receiptHandle": "h" * 400, "body": json.dumps(op_req), "attributes": {}}
+            for i, op_req in enumerate(op_reqs)
+        ]
+    }
+    return event, op_reqs
+
+
+def env_vars(op_req):
+    return [{"Name": "OPERATION", "Value": op_req["operation"]}] + [
+        {"Name": f"TF_VAR_{p['key']}", "Value": p["value"]} for p in op_req["parameters"]
+    ]
+
+
+def print_json(event, op_reqs):
+    print("lambda invocation event payload:")
+    print(json.dumps(event, default=str))
+    for op_req in op_reqs:
+        print("sqs message operation request received:")
+        print(json.dumps(op_req, default=str))
+        sfn_input = {"productOperationRequest": op_req, "codebuild": {"environmentVariablesOverride": env_vars(op_req)}}
+        sfn_input = json.dumps(sfn_input, default=str)
+        print("state machine input json:")
+        print(sfn_input)
+        print("starting state machine execution with arguments:")
+        print(json.dumps({"stateMachineArn": "arn", "name": op_req["recordId"], "input": sfn_input}, default=str))
+
+
+def log_py(event, op_reqs):
+    import log
+
+    log.info("lambda invocation event", records=[{k: v for k, v in r.items() if k != "body"} for r in event["Records"]])
+    for op_req in op_reqs:
+        log.info("sqs message operation request received", operationRequest=op_req)
+        sfn_input = {"productOperationRequest": op_req, "codebuild": {"environmentVariablesOverride": env_vars(op_req)}}
+        log.debug("state machine input", input=sfn_input)
+        log.info("starting state machine execution", stateMachineArn="arn", name=op_req["recordId"])
+
+
+def measure(log_batch, event, op_reqs, runs):
+    sink = CountingSink()
+    cpu = []
+    with contextlib.redirect_stdout(sink):
+        for _ in range(runs):
+            start = time.process_time()
+            log_batch(event, op_reqs)
+            cpu.append(time.process_time() - start)
+    return statistics.median(cpu) * 1000, sink.chars // runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure logging CPU time and volume of a batch of operations")
+    parser.add_argument("--records", type=int, default=10, help="records per batch")
+    parser.add_argument("--parameters", type=int, default=100, help="parameters per operation request")
+    parser.add_argument("--value-chars", type=int, default=2048, help="characters per parameter value")
+    parser.add_argument("--runs", type=int, default=20, help="batches per mode, the median is reported")
+    args = parser.parse_args()
+
+    sys.path.insert(0, cold_start.LAMBDA_DIR)
+    import log
+
+    event, op_reqs = batch(args.records, args.parameters, args.value_chars)
+    print(f"{'mode':<16}{'cpu ms/batch':>14}{'log KB/batch':>14}")
+    modes = [("print json", print_json, None), ("log.py INFO", log_py, "INFO"), ("log.py DEBUG", log_py, "DEBUG")]
+    for name, log_batch, level in modes:
+        if level:
+            log.LEVEL = log.LEVELS[level]
+            log.start_invocation()
+        cpu_ms, chars = measure(log_batch, event, op_reqs, args.runs)
+        print(f"{name:<16}{cpu_ms:>14.2f}{chars / 1024:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
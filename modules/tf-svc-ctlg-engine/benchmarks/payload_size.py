@@ -0,0 +1,96 @@
+# State machine input size with and without the product operation context claim-check (see lambda/op_context.py).
+# Inline, state machine input carried the full product operation request and the CodeBuild environment variables, and
+# every state and lambda invocation passed them on: large parameter and tag sets could exceed the Step Functions payload
+# quota (256 KiB) and fail the execution. With the claim-check, they are written once to the context object in S3.
+#
+# start_product_operation runs in process for products with growing parameter and tag sets. A botocore "before-send"
+# hook answers S3 with the local S3 of tests/local_aws.py and captures the state machine input of StartExecution.
+#
+# Usage, from the repository root:
+#   python modules/tf-svc-ctlg-engine/benchmarks/payload_size.py [--value-chars 256]
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+
+import cold_start
+import local_aws
+
+SFN_PAYLOAD_QUOTA = 256 * 1024
+
+# (parameters, tags) per product
+PRODUCTS = [(5, 5), (20, 10), (50, 20), (100, 50), (200, 50), (500, 50)]
+
+
+class LocalAws:
+    def __init__(self):
+        self.s3 = local_aws.LocalS3()
+        self.inputs = []
+
+    def handle_request(self, request, event_name, **kwargs):
+        import botocore.awsrequest
+
+        _, service, operation = event_name.split(".", 2)
+        if service == "s3":
+            status, headers, body = self.s3.handle(operation, request)
+        elif operation == "StartExecution":
+            self.inputs.append(json.loads(request.body)["input"])
+            status, headers, body = 200, {}, json.dumps({"executionArn": "arn", "startDate": 0}).encode()
+        else:
+            status, headers, body = 200, {}, b"{}"
+        headers = dict(headers, **{"Content-Length": str(len(body))})
+        return botocore.awsrequest.AWSResponse(request.url, status, headers, local_aws.RawResponse(body))
+
+
+def op_request(i, parameters, tags, value_chars):
+    return dict(
+        cold_start.OP_REQ,
+        provisionedProductId=f"pp-{i}",
+        recordId=f"rec-{i}",
+        parameters=[{"key": f"parameter_{p}", "value": "v" * value_chars} for p in range(parameters)],
+        tags=[{"key": f"tag-{t}", "value": "t" * min(value_chars, 256)} for t in range(tags)],
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare state machine input sizes with and without the claim-check")
+    parser.add_argument("--value-chars", type=int, default=256, help="characters per parameter value")
+    args = parser.parse_args()
+
+    os.environ.update(local_aws.ENV)
+    sys.path.insert(0, cold_start.LAMBDA_DIR)
+    import clients
+    import start_product_operation
+
+    local = LocalAws()
+    clients.session().events.register("before-send", local.handle_request)
+
+    print(
+        f"{'parameters':>10}{'tags':>6}{'inline bytes':>14}{'claim-check bytes':>19}{'context bytes':>15}  inline fits"
+    )
+    for i, (parameters, tags) in enumerate(PRODUCTS):
+        op_req = op_request(i, parameters, tags, args.value_chars)
+        # Handler logs and metrics
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            start_product_operation.handle_op_req(op_req)
+
+        claim_check = local.inputs[-1]
+        state = json.loads(claim_check)
+        bucket, _, key = state["context"]["s3Uri"].removeprefix("s3://").partition("/")
+        context = json.loads(local.s3.get(bucket, key))
+        # State machine input before the claim-check
+        inline = {k: v for k, v in state.items() if k != "context"}
+        inline.update(productOperationRequest=context["productOperationRequest"], codebuild=context["codebuild"])
+        inline = json.dumps(inline, default=str)
+
+        fits = "yes" if len(inline.encode()) <= SFN_PAYLOAD_QUOTA else "no, over the 256 KiB quota"
+        print(
+            f"{parameters:>10}{tags:>6}{len(inline.encode()):>14}{len(claim_check.encode()):>19}"
+            f"{len(json.dumps(context).encode()):>15}  {fits}"
+        )
+
+
+if __name__ == "__main__":
+    main()
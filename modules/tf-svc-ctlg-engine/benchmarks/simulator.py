@@ -0,0 +1,749 @@
+# Local end-to-end simulator and load benchmark for the engine pipeline. No AWS account is needed, the real lambda
+# handlers run in this process against local stand-ins:
+# - SQS: operation queues with visibility timeout, batchItemFailures and a dead letter queue after maxReceiveCount,
+#   polled by a configurable number of concurrent start_product_operation invocations (event source mapping).
+#   ChangeMessageVisibility and the queue depth attributes are supported. Notifications queued for retry by notify.py
+#   are delivered by retry_notifications invocations.
+# - Step Functions: executions follow the sfn.tf flow. The CodeBuild task is retried once on failure, then caught by
+#   the failed_product_operation task. The succeeded/failed lambda tasks are retried twice, errors still raised fail
+#   the execution. --lambda-error-rate of their invocations fail before running the handler.
+# - EventBridge: release_stale_operations runs every --sweep-interval seconds
+# - CodeBuild: sleeps for the simulated queue and run time and writes terraform outputs or stderr to S3. With
+#   --build-quota, builds over the concurrent build quota wait for a running build to finish, and fail after
+#   --build-queued-timeout seconds.
+# - S3: in-memory objects, including ranged and conditional requests, copies and listings
+# - Service Catalog: records Notify*ProductEngineWorkflowResult calls, --throttle-rate of them are throttled
+#
+# AWS api calls made by the handlers are answered by a botocore "before-send" hook, so boto3 serialization, retries and
+# error parsing behave as they do in Lambda.
+#
+# Synthetic traffic is replayed at --rate operations per second with a configurable mix of operations and failures. The
+# report shows throughput, per-stage latency percentiles from the EMF metrics the handlers emit (see op_trace.py), and
+# stuck operations: operations Service Catalog was never notified of.
+#
+# Usage, from the repository root:
+#   python modules/tf-svc-ctlg-engine/benchmarks/simulator.py --rate 20 --duration 30 --failure-rate 0.1
+#
+# Burst against the CodeBuild quota, without and with admission control (see admission.py):
+#   python modules/tf-svc-ctlg-engine/benchmarks/simulator.py --rate 100 --duration 1 --build-quota 5 \
+#       --build-run-seconds 1 --build-queued-timeout 5 --max-in-flight 5
+
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+
+import cold_start
+import local_aws
+
+STATE_MACHINE_ARN = local_aws.STATE_MACHINE_ARN
+OPERATION_QUEUES = {
+    "PROVISION_PRODUCT": "ServiceCatalogExternalProvisionOperationQueue",
+    "UPDATE_PROVISIONED_PRODUCT": "ServiceCatalogExternalUpdateOperationQueue",
+    "TERMINATE_PROVISIONED_PRODUCT": "ServiceCatalogExternalTerminateOperationQueue",
+}
+NOTIFY_RETRY_QUEUE = "TerraformSvcCtlgEngine-NotifyRetry"
+# Metrics reported as their maximum
+GAUGES = ["InFlightExecutions", "QueueDepth", "QueueInFlightMessages"]
+# Metrics reported as latency percentiles, in pipeline order
+STAGES = [
+    "QueueWait",
+    "DispatchTime",
+    "CodeBuildQueueTime",
+    "CodeBuildRunTime",
+    "S3ReadTime",
+    "NotifyLatency",
+    "EndToEndLatency",
+]
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+class LocalQueue:
+    def __init__(self, name, visibility_timeout, max_receive_count, dead_letter):
+        self.name = name
+        self.visibility_timeout = visibility_timeout
+        self.max_receive_count = max_receive_count
+        self.dead_letter = dead_letter
+        self.lock = threading.Lock()
+        # {message id: message}
+        self.messages = collections.OrderedDict()
+
+    def send(self, body):
+        message = {
+            "messageId": str(uuid.uuid4()),
+            "receiptHandle": str(uuid.uuid4()),
+            "body": body,
+            "attributes": {"ApproximateReceiveCount": "0", "SentTimestamp": str(now_ms())},
+            "messageAttributes": {},
+            "eventSource": "aws:sqs",
+            "eventSourceARN": f"arn:aws:sqs:us-east-1:222222222222:{self.name}",
+            "visibleAt": 0,
+        }
+        with self.lock:
+            self.messages[message["messageId"]] = message
+        return message
+
+    def receive(self, max_messages):
+        records = []
+        now = time.monotonic()
+        with self.lock:
+            for message in list(self.messages.values()):
+                if len(records) >= max_messages:
+                    break
+                if message["visibleAt"] > now:
+                    continue
+                attributes = message["attributes"]
+                if int(attributes["ApproximateReceiveCount"]) >= self.max_receive_count:
+                    # Redrive policy moves the message to the dead letter queue instead of delivering it again
+                    del self.messages[message["messageId"]]
+                    self.dead_letter.append(message)
+                    continue
+                attributes["ApproximateReceiveCount"] = str(int(attributes["ApproximateReceiveCount"]) + 1)
+                attributes.setdefault("ApproximateFirstReceiveTimestamp", str(now_ms()))
+                message["visibleAt"] = now + self.visibility_timeout
+                records.append({k: v for k, v in message.items() if k != "visibleAt"})
+        return records
+
+    def delete(self, message_id):
+        with self.lock:
+            self.messages.pop(message_id, None)
+
+    def change_visibility(self, receipt_handle, timeout):
+        with self.lock:
+            for message in self.messages.values():
+                if message["receiptHandle"] == receipt_handle:
+                    message["visibleAt"] = time.monotonic() + timeout
+                    return True
+        return False
+
+    def url(self):
+        return f"https://sqs.us-east-1.amazonaws.com/222222222222/{self.name}"
+
+    def attributes(self):
+        now = time.monotonic()
+        with self.lock:
+            visible = sum(1 for message in self.messages.values() if message["visibleAt"] <= now)
+            return {
+                "ApproximateNumberOfMessages": str(visible),
+                "ApproximateNumberOfMessagesNotVisible": str(len(self.messages) - visible),
+            }
+
+    def __len__(self):
+        with self.lock:
+            return len(self.messages)
+
+
+# Thread safe metric line capture. Each thread buffers its writes until the end of the line, so concurrent print()
+# calls don't interleave.
+class LineCapture:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.lines = []
+        self.local = threading.local()
+
+    def write(self, text):
+        buf = getattr(self.local, "buf", "") + text
+        *lines, self.local.buf = buf.split("\n")
+        if lines:
+            with self.lock:
+                self.lines.extend(lines)
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+class Simulator:
+    def __init__(self, args):
+        self.args = args
+        self.rand = random.Random(args.seed)
+        self.rand_lock = threading.Lock()
+        self.s3 = local_aws.LocalS3()
+        self.dead_letter = []
+        self.queues = {
+            operation: LocalQueue(name, args.visibility_timeout, args.max_receive_count, self.dead_letter)
+            for operation, name in OPERATION_QUEUES.items()
+        }
+        self.notify_retry_queue = LocalQueue(NOTIFY_RETRY_QUEUE, args.retry_visibility_timeout, 20, self.dead_letter)
+        self.lock = threading.Lock()
+        # {execution name: {"status": ..., "state": ...}}
+        self.executions = {}
+        # {workflow token: [notification]}
+        self.notifications = collections.defaultdict(list)
+        # {workflow token: operation request}
+        self.sent = {}
+        # provisioned product ids: {"productId", "parameters"}
+        self.products = {}
+        self.api_calls = collections.Counter()
+        self.unhandled_calls = collections.Counter()
+        self.lambda_errors = collections.Counter()
+        # {provisioned product id: running builds}, builds of the same product contend for its terraform state
+        self.running_products = collections.Counter()
+        self.overlapping_builds = 0
+        self.build_slots = threading.Semaphore(args.build_quota) if args.build_quota else None
+        self.running_builds = 0
+        self.peak_running_builds = 0
+        self.timed_out_builds = 0
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.max_executions)
+        self.stopping = threading.Event()
+
+    def random(self):
+        with self.rand_lock:
+            return self.rand.random()
+
+    # botocore before-send hook, answers every api call of the handlers
+    def handle_request(self, request, event_name, **kwargs):
+        import botocore.awsrequest
+
+        _, service, operation = event_name.split(".", 2)
+        with self.lock:
+            self.api_calls[f"{service}.{operation}"] += 1
+
+        response = None
+        if service == "s3":
+            response = self.s3.handle(operation, request)
+        elif service == "sfn" and operation == "StartExecution":
+            response = self.start_execution(json.loads(request.body))
+        elif service == "sfn" and operation == "ListExecutions":
+            response = self.list_executions(json.loads(request.body))
+        elif service == "sfn" and operation == "DescribeExecution":
+            response = self.describe_execution(json.loads(request.body))
+        elif service == "sqs":
+            response = self.sqs(operation, json.loads(request.body))
+        elif service == "service-catalog" and operation.startswith("Notify"):
+            response = self.notify(operation, json.loads(request.body))
+
+        if response is None:
+            with self.lock:
+                self.unhandled_calls[f"{service}.{operation}"] += 1
+            response = (200, {}, b"{}")
+        status, headers, body = response
+        headers = dict(headers, **{"Content-Length": str(len(body))})
+        return botocore.awsrequest.AWSResponse(request.url, status, headers, local_aws.RawResponse(body))
+
+    def start_execution(self, params):
+        name = params["name"]
+        with self.lock:
+            if name in self.executions:
+                return 400, {}, local_aws.json_error("ExecutionAlreadyExists", f"Execution Already Exists: '{name}'")
+            self.executions[name] = {"status": "RUNNING", "state": json.loads(params["input"])}
+        arn = f"{STATE_MACHINE_ARN.replace(':stateMachine:', ':execution:')}:{name}"
+        self.executor.submit(self.run_execution, name, arn)
+        return 200, {}, json.dumps({"executionArn": arn, "startDate": time.time()}).encode()
+
+    def list_executions(self, params):
+        with self.lock:
+            names = [n for n, e in self.executions.items() if e["status"] == params.get("statusFilter", e["status"])]
+        arn = STATE_MACHINE_ARN.replace(":stateMachine:", ":execution:")
+        executions = [
+            {"executionArn": f"{arn}:{name}", "stateMachineArn": STATE_MACHINE_ARN, "name": name, "status": "RUNNING"}
+            for name in names
+        ]
+        return 200, {}, json.dumps({"executions": executions}).encode()
+
+    def describe_execution(self, params):
+        name = params["executionArn"].rsplit(":", 1)[-1]
+        with self.lock:
+            execution = self.executions.get(name)
+            if execution is None:
+                return 400, {}, local_aws.json_error("ExecutionDoesNotExist", f"Execution Does Not Exist: '{name}'")
+            resp = {"executionArn": params["executionArn"], "status": execution["status"], "startDate": 0}
+        return 200, {}, json.dumps(resp).encode()
+
+    def sqs(self, operation, params):
+        queues = list(self.queues.values()) + [self.notify_retry_queue]
+        if operation == "GetQueueUrl":
+            queue = next(q for q in queues if q.name == params["QueueName"])
+            return 200, {}, json.dumps({"QueueUrl": queue.url()}).encode()
+        queue = next((q for q in queues if q.url() == params.get("QueueUrl")), None)
+        if queue is None:
+            return 400, {}, local_aws.json_error("AWS.SimpleQueueService.NonExistentQueue", "The queue does not exist")
+        if operation == "SendMessage":
+            message = queue.send(params["MessageBody"])
+            md5 = hashlib.md5(params["MessageBody"].encode()).hexdigest()
+            return 200, {}, json.dumps({"MessageId": message["messageId"], "MD5OfMessageBody": md5}).encode()
+        if operation == "GetQueueAttributes":
+            return 200, {}, json.dumps({"Attributes": queue.attributes()}).encode()
+        if operation == "ChangeMessageVisibility":
+            if not queue.change_visibility(params["ReceiptHandle"], params["VisibilityTimeout"]):
+                return 400, {}, local_aws.json_error("ReceiptHandleIsInvalid", "The receipt handle is not valid")
+            return 200, {}, b"{}"
+        return None
+
+    def notify(self, operation, params):
+        if self.random() < self.args.throttle_rate:
+            return 400, {}, local_aws.json_error("ThrottlingException", "Rate exceeded")
+        with self.lock:
+            self.notifications[params["WorkflowToken"]].append(
+                {
+                    "operation": operation,
+                    "status": params["Status"],
+                    "failureReason": params.get("FailureReason"),
+                    "timestamp": now_ms(),
+                }
+            )
+        return 200, {}, b"{}"
+
+    def invoke(self, function_name, handler, event, timeout=900):
+        try:
+            return handler(event, local_aws.LambdaContext(timeout))
+        except Exception as e:
+            with self.lock:
+                self.lambda_errors[f"{function_name}: {type(e).__name__}"] += 1
+            raise
+
+    # Lambda task of the state machine, States.TaskFailed is retried twice. Function timeout of lambda.tf.
+    def invoke_task(self, function_name, handler, event):
+        for attempt in range(3):
+            try:
+                if self.random() < self.args.lambda_error_rate:
+                    with self.lock:
+                        self.lambda_errors[f"{function_name}: injected"] += 1
+                    raise Exception("injected lambda error")
+                return self.invoke(function_name, handler, event, 60)
+            except Exception:
+                if attempt == 2:
+                    raise
+                time.sleep(self.args.retry_interval)
+
+    # Step Functions execution following sfn.tf
+    def run_execution(self, name, arn):
+        import failed_product_operation
+        import succeeded_product_operation
+
+        state = self.executions[name]["state"]
+        try:
+            # StartCodeBuildTerraformOperation, retried once on States.TaskFailed
+            build = self.run_build(state)
+            if build["BuildStatus"] != "SUCCEEDED":
+                time.sleep(self.args.retry_interval)
+                build = self.run_build(state)
+
+            if build["BuildStatus"] == "SUCCEEDED":
+                state["codebuild"]["build"] = {k: build[k] for k in ["Id", "BuildStatus", "Phases"]}
+                self.invoke_task("succeeded_product_operation", succeeded_product_operation.handler, state)
+                status = "SUCCEEDED"
+            else:
+                # Catch States.TaskFailed, ResultPath $.Error
+                state["Error"] = {"Error": "States.TaskFailed", "Cause": json.dumps(build)}
+                event = {"State": state, "Context": {"Execution": {"Id": arn, "Name": name}}}
+                self.invoke_task("failed_product_operation", failed_product_operation.handler, event)
+                status = "FAILED"
+        except Exception:
+            # Lambda task errors left after the retries are not caught by the state machine
+            status = "FAILED"
+        with self.lock:
+            self.executions[name]["status"] = status
+
+    def run_build(self, state):
+        env_vars = {v["Name"]: v["Value"] for v in state["codebuild"]["environmentVariablesOverride"]}
+        # Load the operation context like the buildspec does
+        bucket, _, key = env_vars["CONTEXT_S3_URI"].removeprefix("s3://").partition("/")
+        context = json.loads(self.s3.get(bucket, key))
+        env_vars.update({v["Name"]: v["Value"] for v in context["codebuild"]["environmentVariablesOverride"]})
+
+        queue_seconds = self.rand_duration(self.args.build_queue_seconds)
+        run_seconds = self.rand_duration(self.args.build_run_seconds)
+        time.sleep(queue_seconds)
+        # Wait for a build slot of the concurrent build quota
+        queued = time.monotonic()
+        timed_out = False
+        if self.build_slots:
+            timed_out = not self.build_slots.acquire(timeout=self.args.build_queued_timeout or None)
+            queue_seconds = round(queue_seconds + time.monotonic() - queued, 3)
+
+        op_req = context["productOperationRequest"]
+        if timed_out:
+            with self.lock:
+                self.timed_out_builds += 1
+            run_seconds = 0
+            failed = True
+        else:
+            pp_id = state["productOperationRequest"]["provisionedProductId"]
+            with self.lock:
+                self.running_products[pp_id] += 1
+                if self.running_products[pp_id] > 1:
+                    self.overlapping_builds += 1
+                self.running_builds += 1
+                self.peak_running_builds = max(self.peak_running_builds, self.running_builds)
+            time.sleep(run_seconds)
+            with self.lock:
+                self.running_products[pp_id] -= 1
+                self.running_builds -= 1
+            if self.build_slots:
+                self.build_slots.release()
+
+            # Failures are chosen when the traffic is generated, see operation_request()
+            failed = op_req.get("simulatedFailure") == "always"
+            if op_req.get("simulatedFailure") == "once":
+                failed = not state.get("simulatedAttempted")
+                state["simulatedAttempted"] = True
+
+        if timed_out:
+            self.put_uri(env_vars["STDERR_S3_URI"], b"Build timed out in the CodeBuild queue\n")
+        elif failed:
+            self.put_uri(env_vars["STDERR_S3_URI"], self.stderr(op_req).encode())
+        elif env_vars["OPERATION"] != "TERMINATE_PROVISIONED_PRODUCT":
+            outputs = {"bucket_name": {"sensitive": False, "type": "string", "value": op_req["provisionedProductName"]}}
+            self.put_uri(env_vars["OUTPUTS_S3_URI"], json.dumps(outputs).encode())
+
+        return {
+            "Id": f"TerraformSvcCtlgEngine:{uuid.uuid4()}",
+            "BuildStatus": "TIMED_OUT" if timed_out else "FAILED" if failed else "SUCCEEDED",
+            "Phases": [
+                {"PhaseType": "SUBMITTED", "DurationInSeconds": 0},
+                {"PhaseType": "QUEUED", "DurationInSeconds": queue_seconds},
+                {"PhaseType": "BUILD", "DurationInSeconds": run_seconds},
+                {"PhaseType": "COMPLETED"},
+            ],
+        }
+
+    def rand_duration(self, mean):
+        with self.rand_lock:
+            return round(self.rand.expovariate(1 / mean), 3) if mean > 0 else 0
+
+    def stderr(self, op_req):
+        return (
+            "╷\n"
+            f"│ Error: creating S3 Bucket ({op_req['provisionedProductName']}): operation error S3: CreateBucket,"
+            " api error BucketAlreadyExists\n"
+            "│\n"
+            "╵\n"
+        )
+
+    def put_uri(self, s3_uri, body):
+        bucket, _, key = s3_uri.removeprefix("s3://").partition("/")
+        self.s3.put(bucket, key, body)
+
+    # Synthetic operation request. Provisions new products, updates and terminates provisioned ones.
+    def operation_request(self):
+        with self.lock:
+            product_ids = list(self.products)
+        roll = self.random()
+        if not product_ids or roll < self.args.provision_share:
+            operation = "PROVISION_PRODUCT"
+            pp_id = "pp-" + uuid.uuid4().hex[:13]
+            product = {"productId": f"prod-{self.rand_index(5):013d}", "parameters": self.parameters()}
+        else:
+            pp_id = product_ids[self.rand_index(len(product_ids))]
+            with self.lock:
+                product = self.products.get(pp_id)
+            if product is None:
+                return self.operation_request()
+            if roll < self.args.provision_share + self.args.terminate_share:
+                operation = "TERMINATE_PROVISIONED_PRODUCT"
+            else:
+                operation = "UPDATE_PROVISIONED_PRODUCT"
+                if self.random() >= self.args.noop_update_share:
+                    product = dict(product, parameters=self.parameters())
+
+        with self.lock:
+            if operation == "TERMINATE_PROVISIONED_PRODUCT":
+                self.products.pop(pp_id, None)
+            else:
+                self.products[pp_id] = product
+
+        op_req = {
+            "token": str(uuid.uuid4()),
+            "operation": operation,
+            "provisionedProductId": pp_id,
+            "provisionedProductName": f"sim-{pp_id}",
+            "recordId": "rec-" + uuid.uuid4().hex[:13],
+            "launchRoleArn": "arn:aws:iam::111111111111:role/ServiceCatalogLaunchRole",
+            "identity": {"principal": "AROASGNG33TL2BDDOJDZK", "awsAccountId": "111111111111", "organizationId": None},
+        }
+        if operation != "TERMINATE_PROVISIONED_PRODUCT":
+            op_req.update(
+                {
+                    "productId": product["productId"],
+                    "provisioningArtifactId": "pa-qhjerwxbaulto",
+                    "artifact": {
+                        "path": "S3://sc-artifacts/out/60413ed8e0ba1e67a89ecd3b1f2280e9-"
+                        + hashlib.sha256(product["productId"].encode()).hexdigest()
+                        + "-"
+                        + hashlib.sha256(b"artifact").hexdigest()
+                        + f"-{now_ms()}-{uuid.uuid4()}",
+                        "type": "AWS_S3",
+                    },
+                    "parameters": product["parameters"],
+                    "tags": [{"key": "finops_project_name", "value": "project-a"}],
+                }
+            )
+
+        roll = self.random()
+        if roll < self.args.failure_rate:
+            op_req["simulatedFailure"] = "always"
+        elif roll < self.args.failure_rate + self.args.flaky_rate:
+            op_req["simulatedFailure"] = "once"
+        return op_req
+
+    def rand_index(self, n):
+        with self.rand_lock:
+            return self.rand.randrange(n)
+
+    def parameters(self):
+        return [{"key": f"var_{i}", "value": uuid.uuid4().hex} for i in range(self.args.parameters)]
+
+    def send_traffic(self):
+        interval = 1 / self.args.rate
+        next_send = time.monotonic()
+        deadline = next_send + self.args.duration
+        while next_send < deadline:
+            op_req = self.operation_request()
+            with self.lock:
+                self.sent[op_req["token"]] = op_req
+            self.queues[op_req["operation"]].send(json.dumps(op_req))
+            next_send += interval
+            time.sleep(max(0, next_send - time.monotonic()))
+
+    # Lambda event source mapping poller, one per concurrent execution environment of the function
+    def poll(self, queues, function_name, handler, batch_size):
+        while not self.stopping.is_set():
+            received = False
+            for queue in queues:
+                records = queue.receive(batch_size)
+                if not records:
+                    continue
+                received = True
+                try:
+                    # Function timeout as long as the visibility timeout of the queue
+                    resp = self.invoke(function_name, handler, {"Records": records}, queue.visibility_timeout)
+                    failed = {f["itemIdentifier"] for f in resp["batchItemFailures"]}
+                except Exception:
+                    failed = {r["messageId"] for r in records}
+                for record in records:
+                    if record["messageId"] not in failed:
+                        queue.delete(record["messageId"])
+            if not received:
+                time.sleep(0.01)
+
+    # EventBridge scheduled rule of release_stale_operations
+    def sweep(self):
+        import release_stale_operations
+
+        while not self.stopping.wait(self.args.sweep_interval):
+            self.invoke("release_stale_operations", release_stale_operations.handler, {}, 120)
+
+    def pending(self):
+        with self.lock:
+            running = sum(1 for e in self.executions.values() if e["status"] == "RUNNING")
+            unnotified = sum(1 for token in self.sent if token not in self.notifications)
+        queued = sum(len(q) for q in self.queues.values()) + len(self.notify_retry_queue)
+        # Operations holding a provisioned product in the scheduler, released by the sweep if their execution ended
+        if self.args.sweep_interval:
+            with self.s3.lock:
+                docs = [body for (_, key), (body, _) in self.s3.objects.items() if key.startswith("scheduler/")]
+            queued += sum(1 for body in docs if json.loads(body)["running"])
+        return running + queued, unnotified
+
+    def run(self):
+        import retry_notifications
+        import start_product_operation
+
+        start_args = (
+            list(self.queues.values()), "start_product_operation", start_product_operation.handler, self.args.batch_size
+        )
+        concurrency = self.args.concurrency
+        pollers = [threading.Thread(target=self.poll, args=start_args, daemon=True) for _ in range(concurrency)]
+        # Event source mapping batch_size and maximum_concurrency in lambda.tf
+        retry_args = ([self.notify_retry_queue], "retry_notifications", retry_notifications.handler, 5)
+        pollers += [threading.Thread(target=self.poll, args=retry_args, daemon=True) for _ in range(2)]
+        if self.args.sweep_interval:
+            pollers.append(threading.Thread(target=self.sweep, daemon=True))
+        for poller in pollers:
+            poller.start()
+
+        started = time.monotonic()
+        self.send_traffic()
+        sent_seconds = time.monotonic() - started
+
+        drain_deadline = time.monotonic() + self.args.drain_timeout
+        while time.monotonic() < drain_deadline:
+            in_flight, unnotified = self.pending()
+            if not in_flight or not unnotified:
+                break
+            time.sleep(0.05)
+        elapsed = time.monotonic() - started
+
+        self.stopping.set()
+        for poller in pollers:
+            poller.join()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        return sent_seconds, elapsed
+
+
+def percentiles(values):
+    values = sorted(values)
+    pick = lambda p: values[min(len(values) - 1, int(p / 100 * len(values)))]
+    return {"count": len(values), "p50": pick(50), "p90": pick(90), "p99": pick(99), "max": values[-1]}
+
+
+# Report lines. Returned rather than printed, executions still running after the drain timeout keep logging to stdout.
+def report(sim, capture, sent_seconds, elapsed):
+    import metrics
+
+    lines = []
+
+    with sim.lock:
+        sent = dict(sim.sent)
+        notifications = {token: list(n) for token, n in sim.notifications.items()}
+        executions = dict(sim.executions)
+
+    notified = [token for token in sent if token in notifications]
+    stuck = [op_req for token, op_req in sent.items() if token not in notifications]
+    statuses = collections.Counter(notifications[token][-1]["status"] for token in notified)
+    duplicates = sum(1 for token in notified if len(notifications[token]) > 1)
+
+    stage_values = collections.defaultdict(list)
+    units = {}
+    for values, _ in metrics.read(capture.lines):
+        for name, (value, unit) in values.items():
+            stage_values[name].append(value)
+            units[name] = unit
+
+    lines.append(f"sent {len(sent)} operations in {sent_seconds:.1f}s ({len(sent) / sent_seconds:.1f}/s)")
+    lines.append(
+        f"notified {len(notified)} operations in {elapsed:.1f}s: " + ", ".join(f"{k} {v}" for k, v in statuses.items())
+    )
+    if notified:
+        lines.append(f"throughput {len(notified) / elapsed:.1f} operations/s")
+    lines.append(f"operations notified more than once: {duplicates}")
+    lines.append(f"builds started while a build of the same provisioned product was running: {sim.overlapping_builds}")
+    if sim.args.build_quota:
+        lines.append(
+            f"concurrent builds: peak {sim.peak_running_builds} (quota {sim.args.build_quota}),"
+            f" timed out in the CodeBuild queue: {sim.timed_out_builds}"
+        )
+    reasons = collections.Counter(
+        # The end of the failure reason has the error, ids are replaced to group the same errors
+        re.sub(r"\b(pp|rec)-[0-9a-z]+", r"\1-*", "..." + notifications[token][-1]["failureReason"][-200:])
+        for token in notified
+        if notifications[token][-1]["failureReason"]
+    )
+    for reason, count in reasons.most_common(5):
+        lines.append(f"  {count} failed: {reason}")
+    lines.append("")
+
+    lines.append(f"{'stage':<22}{'unit':<14}{'count':>8}{'p50':>12}{'p90':>12}{'p99':>12}{'max':>12}")
+    for name in STAGES + sorted(set(stage_values) - set(STAGES)):
+        if not stage_values.get(name) or units[name] == "Count" or name in GAUGES:
+            continue
+        p = percentiles(stage_values[name])
+        lines.append(
+            f"{name:<22}{units[name]:<14}{p['count']:>8}"
+            + "".join(f"{p[k]:>12.1f}" for k in ["p50", "p90", "p99", "max"])
+        )
+    counts = {name: sum(values) for name, values in stage_values.items() if units[name] == "Count"}
+    counts = {name: count for name, count in counts.items() if name not in GAUGES}
+    if counts:
+        lines.append(f"counts: {counts}")
+    gauges = {name: max(stage_values[name]) for name in GAUGES if stage_values.get(name)}
+    if gauges:
+        lines.append(f"gauges (max): {gauges}")
+    lines.append("")
+
+    lines.append(f"stuck operations (never notified): {len(stuck)}")
+    dead_lettered = {json.loads(m["body"])["token"] for m in sim.dead_letter}
+    execution_status = {name.rsplit("-", 1)[-1]: e["status"] for name, e in executions.items()}
+    for op_req in stuck[: sim.args.show_stuck]:
+        record_id = op_req["recordId"].removeprefix("rec-")
+        where = "dead letter queue" if op_req["token"] in dead_lettered else "queue"
+        if record_id in execution_status:
+            where = f"state machine execution {execution_status[record_id]}"
+        lines.append(f"  {op_req['recordId']} {op_req['operation']} {op_req['provisionedProductId']}: {where}")
+    lines.append("")
+
+    lines.append(f"lambda errors: {dict(sim.lambda_errors) or 'none'}")
+    lines.append(f"api calls: {dict(sorted(sim.api_calls.items()))}")
+    if sim.unhandled_calls:
+        lines.append(f"api calls without a local stand-in (answered with {{}}): {dict(sim.unhandled_calls)}")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate the engine pipeline locally under synthetic load")
+    parser.add_argument("--rate", type=float, default=10, help="operation requests sent per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of traffic to send")
+    parser.add_argument("--drain-timeout", type=float, default=30, help="seconds to wait for in-flight operations")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--provision-share", type=float, default=0.5, help="share of provision operations")
+    parser.add_argument("--terminate-share", type=float, default=0.1, help="share of terminate operations")
+    parser.add_argument("--noop-update-share", type=float, default=0.3, help="share of updates with unchanged inputs")
+    parser.add_argument("--parameters", type=int, default=5, help="parameters per product")
+    parser.add_argument("--failure-rate", type=float, default=0.05, help="share of builds that always fail")
+    parser.add_argument("--flaky-rate", type=float, default=0.05, help="share of builds that fail once, then succeed")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of notify calls throttled")
+    parser.add_argument(
+        "--lambda-error-rate", type=float, default=0.0, help="share of succeeded/failed lambda invocations that fail"
+    )
+    parser.add_argument(
+        "--sweep-interval", type=float, default=1, help="seconds between stale operation sweeps, 0 disables them"
+    )
+    parser.add_argument("--notify-rate", type=float, default=100, help="notify rate limit per second")
+    parser.add_argument("--build-queue-seconds", type=float, default=0.05, help="mean simulated CodeBuild queue time")
+    parser.add_argument("--build-run-seconds", type=float, default=0.5, help="mean simulated CodeBuild run time")
+    parser.add_argument("--build-quota", type=int, default=0, help="CodeBuild concurrent build quota, 0 is unlimited")
+    parser.add_argument(
+        "--build-queued-timeout", type=float, default=0, help="seconds a build waits for the quota before failing"
+    )
+    parser.add_argument("--retry-interval", type=float, default=0.1, help="CodeBuild task retry interval seconds")
+    parser.add_argument("--concurrency", type=int, default=5, help="concurrent start_product_operation invocations")
+    parser.add_argument("--batch-size", type=int, default=10, help="SQS event source mapping batch size")
+    parser.add_argument("--visibility-timeout", type=float, default=5, help="SQS visibility timeout seconds")
+    parser.add_argument(
+        "--retry-visibility-timeout", type=float, default=10, help="notify retry queue SQS visibility timeout seconds"
+    )
+    parser.add_argument(
+        "--max-receive-count", type=int, help="SQS maxReceiveCount, default 50 with --max-in-flight else 3"
+    )
+    parser.add_argument("--max-in-flight", type=int, default=0, help="admission control budget, 0 disables it")
+    parser.add_argument("--defer-base-seconds", type=int, default=1, help="admission control deferral backoff base")
+    parser.add_argument("--defer-max-seconds", type=int, default=5, help="admission control maximum deferral")
+    parser.add_argument("--state-key-layout", default="flat", help="tfstate bucket key layout, flat or sharded")
+    parser.add_argument("--max-executions", type=int, default=200, help="concurrently running state machine executions")
+    parser.add_argument("--show-stuck", type=int, default=20, help="stuck operations to list")
+    parser.add_argument("--verbose", action="store_true", help="show handler logs")
+    args = parser.parse_args()
+    # sqs.tf
+    args.max_receive_count = args.max_receive_count or (50 if args.max_in_flight else 3)
+
+    os.environ.update(local_aws.ENV)
+    os.environ["SKIP_NOOP_UPDATES"] = "true"
+    os.environ["MAX_IN_FLIGHT_EXECUTIONS"] = str(args.max_in_flight)
+    os.environ["STATE_KEY_LAYOUT"] = args.state_key_layout
+    os.environ["NOTIFY_RATE_PER_SECOND"] = str(args.notify_rate)
+    os.environ["NOTIFY_BURST"] = str(args.notify_rate)
+    os.environ["NOTIFY_RETRY_QUEUE_URL"] = LocalQueue(NOTIFY_RETRY_QUEUE, 0, 0, None).url()
+    os.environ["ADMISSION_DEFER_BASE_SECONDS"] = str(args.defer_base_seconds)
+    os.environ["ADMISSION_DEFER_MAX_SECONDS"] = str(args.defer_max_seconds)
+    os.environ["ADMISSION_GAUGE_INTERVAL_SECONDS"] = "1"
+    # Redelivered messages start their execution first
+    os.environ["SCHEDULER_START_GRACE_SECONDS"] = str(int(args.visibility_timeout * 2))
+    sys.path.insert(0, cold_start.LAMBDA_DIR)
+    import clients
+    import metrics
+
+    sim = Simulator(args)
+    clients.session().events.register("before-send", sim.handle_request)
+    capture = metrics.stream = LineCapture()
+
+    out = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")
+    sent_seconds, elapsed = sim.run()
+    print("\n".join(report(sim, capture, sent_seconds, elapsed)), file=out)
+
+
+if __name__ == "__main__":
+    main()
@@ -55,10 +55,29 @@ resource "aws_iam_role_policy" "codebuild" {
           "${aws_s3_bucket.tfstate.arn}/*",
         ]
       },
+      {
+        # Provider cache hit metrics
+        Effect   = "Allow"
+        Action   = "cloudwatch:PutMetricData"
+        Resource = "*"
+        Condition = {
+          StringEquals = {
+            "cloudwatch:namespace" = "TerraformSvcCtlgEngine"
+          }
+        }
+      },
     ]
   })
 }
 
+# Provider cache key and manifest logic run by the build, see codebuild/provider_cache.py
+resource "aws_s3_object" "provider_cache_script" {
+  bucket = aws_s3_bucket.tfstate.id
+  key    = "codebuild/provider_cache.py"
+  source = "${path.module}/codebuild/provider_cache.py"
+  etag   = filemd5("${path.module}/codebuild/provider_cache.py")
+}
+
 resource "aws_cloudwatch_log_group" "codebuild" {
   name              = "/aws/codebuild/TerraformSvcCtlgEngine"
   retention_in_days = 14
@@ -88,6 +107,18 @@ resource "aws_codebuild_project" "terraform" {
       name  = "TF_LOG"
       value = "ERROR"
     }
+    environment_variable {
+      name  = "TERRAFORM_VERSION"
+      value = var.terraform_version
+    }
+    environment_variable {
+      name  = "PROVIDER_CACHE_S3_URI"
+      value = "s3://${aws_s3_bucket.tfstate.id}/${trimsuffix(local.provider_cache_prefix, "/")}"
+    }
+    environment_variable {
+      name  = "PROVIDER_CACHE_SCRIPT_S3_URI"
+      value = "s3://${aws_s3_bucket.tfstate.id}/${aws_s3_object.provider_cache_script.key}"
+    }
   }
 
   source {
@@ -103,6 +134,26 @@ resource "aws_codebuild_project" "terraform" {
           commands:
           - |
             set -eux
+
+            # Load the operation environment variables from the operation context in S3. The state machine only passes
+            # a reference to the context, keeping large parameter and tag sets out of Step Functions state. Names that
+            # are not shell identifiers, such as TF_VAR_ names of hyphenated terraform variables, cannot be exported:
+            # they are collected in TF_ENV and passed to terraform with env by the terraform function below.
+            TF_ENV=()
+            if [[ -n "$${CONTEXT_S3_URI:-}" ]]; then
+              aws s3 cp "$CONTEXT_S3_URI" /tmp/context.json
+              python3 -c 'import json, re, shlex; [
+                print("export " + v["Name"] + "=" + shlex.quote(v["Value"])
+                  if re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", v["Name"])
+                  else "TF_ENV+=(" + shlex.quote(v["Name"] + "=" + v["Value"]) + ")")
+                for v in json.load(open("/tmp/context.json"))["codebuild"]["environmentVariablesOverride"]
+              ]' > /tmp/context.env
+              . /tmp/context.env
+            fi
+            terraform() {
+              env $${TF_ENV[@]+"$${TF_ENV[@]}"} terraform "$@"
+            }
+
             env | sort
             aws sts get-caller-identity
 
@@ -114,10 +165,27 @@ resource "aws_codebuild_project" "terraform" {
 
             export STDERR_FILE="$CODEBUILD_SRC_DIR/stderr.txt"
 
-            # Install terraform at front of PATH
+            # The terraform binary and providers are cached in the tfstate bucket with the codebuild role, whatever
+            # AWS_PROFILE is set. Cache hits are published as 0 / 1 metrics, their average is the cache hit ratio.
+            codebuild_aws() {
+              env -u AWS_PROFILE aws "$@"
+            }
+            put_cache_metric() {
+              codebuild_aws cloudwatch put-metric-data --namespace TerraformSvcCtlgEngine \
+                --metric-name "$1" --value "$2" --unit None || true
+            }
+
+            # Install terraform at front of PATH, from the cache or releases.hashicorp.com
             mkdir -p /usr/local/bin
             export PATH="/usr/local/bin:$PATH"
-            curl -Lso /tmp/terraform.zip 'https://releases.hashicorp.com/terraform/1.9.8/terraform_1.9.8_linux_amd64.zip'
+            TERRAFORM_ZIP="terraform_$${TERRAFORM_VERSION}_linux_amd64.zip"
+            if codebuild_aws s3 cp --only-show-errors "$PROVIDER_CACHE_S3_URI/terraform/$TERRAFORM_ZIP" /tmp/terraform.zip; then
+              put_cache_metric TerraformBinaryCacheHit 1
+            else
+              curl -fLso /tmp/terraform.zip "https://releases.hashicorp.com/terraform/$TERRAFORM_VERSION/$TERRAFORM_ZIP"
+              codebuild_aws s3 cp --only-show-errors /tmp/terraform.zip "$PROVIDER_CACHE_S3_URI/terraform/$TERRAFORM_ZIP" || true
+              put_cache_metric TerraformBinaryCacheHit 0
+            fi
             unzip /tmp/terraform.zip terraform -d /usr/local/bin
             chmod +x /usr/local/bin/terraform
             terraform -version
@@ -161,8 +229,45 @@ resource "aws_codebuild_project" "terraform" {
             # Configure terraform s3 backend (provided to build in env var as .tf.json)
             echo "$S3_BACKEND_JSON" | tee generated_s3_backend.tf.json
 
+            # Install providers from a cached filesystem mirror keyed by the artifact provider requirements, see
+            # codebuild/provider_cache.py. Fall back to the Terraform registry if the cache has no mirror for the key,
+            # the mirror lacks a required provider or terraform init from the mirror fails, then cache the providers.
+            PROVIDER_CACHE_HIT=0
+            PROVIDER_CACHE_KEY=''
+            if codebuild_aws s3 cp --only-show-errors "$PROVIDER_CACHE_SCRIPT_S3_URI" /tmp/provider_cache.py; then
+              PROVIDER_CACHE_KEY="$(python3 /tmp/provider_cache.py key . "$TERRAFORM_VERSION" linux_amd64 || true)"
+            fi
+            PROVIDER_CACHE_ENTRY="$PROVIDER_CACHE_S3_URI/providers/$PROVIDER_CACHE_KEY"
+            if [[ -n "$PROVIDER_CACHE_KEY" ]] \
+              && codebuild_aws s3 cp --only-show-errors "$PROVIDER_CACHE_ENTRY.manifest.json" /tmp/provider-manifest.json \
+              && python3 /tmp/provider_cache.py check /tmp/provider-manifest.json . \
+              && codebuild_aws s3 cp --only-show-errors "$PROVIDER_CACHE_ENTRY.tar.gz" /tmp/providers.tar.gz; then
+              mkdir -p /tmp/provider-mirror
+              tar -xzf /tmp/providers.tar.gz -C /tmp/provider-mirror
+              printf 'provider_installation {\n  filesystem_mirror {\n    path = "/tmp/provider-mirror"\n  }\n}\n' > /tmp/provider-mirror.tfrc
+              if TF_CLI_CONFIG_FILE=/tmp/provider-mirror.tfrc terraform init 2> stderr.txt; then
+                PROVIDER_CACHE_HIT=1
+              else
+                echo "terraform init from the provider cache failed, installing providers from the registry"
+                cat stderr.txt
+                rm -rf .terraform
+              fi
+            fi
+
             # Run terraform commands, handle errors
-            if ! terraform init                              2> stderr.txt; then handle_tf_error; fi
+            if [[ "$PROVIDER_CACHE_HIT" == 0 ]]; then
+              mkdir -p /tmp/plugin-cache
+              if ! TF_PLUGIN_CACHE_DIR=/tmp/plugin-cache terraform init 2> stderr.txt; then handle_tf_error; fi
+              if [[ -n "$PROVIDER_CACHE_KEY" ]]; then
+                tar -czf /tmp/providers.tar.gz -C /tmp/plugin-cache . \
+                  && python3 /tmp/provider_cache.py manifest /tmp/plugin-cache "$PROVIDER_CACHE_KEY" \
+                    "$TERRAFORM_VERSION" linux_amd64 > /tmp/provider-manifest.json \
+                  && codebuild_aws s3 cp --only-show-errors /tmp/providers.tar.gz "$PROVIDER_CACHE_ENTRY.tar.gz" \
+                  && codebuild_aws s3 cp --only-show-errors /tmp/provider-manifest.json "$PROVIDER_CACHE_ENTRY.manifest.json" \
+                  || echo "Could not update the provider cache"
+              fi
+            fi
+            put_cache_metric ProviderCacheHit "$PROVIDER_CACHE_HIT"
             if ! terraform apply -auto-approve               2> stderr.txt; then handle_tf_error; fi
             if ! terraform output -json | tee tfoutputs.json 2> stderr.txt; then handle_tf_error; fi
 
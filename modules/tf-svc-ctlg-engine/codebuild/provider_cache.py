@@ -0,0 +1,234 @@
+# Terraform provider cache for the CodeBuild terraform run. Providers installed by `terraform init` are kept in the
+# tfstate bucket as a filesystem mirror archive, so later builds with the same provider requirements install them from
+# S3 instead of the Terraform registry. The buildspec (see codebuild.tf) downloads this script and runs:
+#
+#   python3 provider_cache.py key ARTIFACT_DIR TERRAFORM_VERSION PLATFORM
+#     Prints the cache key of the artifact: a hash of its provider requirements, the terraform version and platform.
+#     Requirements are the locked provider versions of .terraform.lock.hcl when the artifact has one, otherwise the
+#     source and version constraints of every required_providers block and the providers of provider blocks.
+#
+#   python3 provider_cache.py manifest MIRROR_DIR KEY TERRAFORM_VERSION PLATFORM
+#     Prints the manifest of a mirror populated by `terraform init` with TF_PLUGIN_CACHE_DIR=MIRROR_DIR, uploaded with
+#     the mirror archive.
+#
+#   python3 provider_cache.py check MANIFEST ARTIFACT_DIR
+#     Exits 1 if the cached mirror described by MANIFEST lacks a provider the artifact requires. Such a mirror was
+#     cached for an artifact with the same requirements that used fewer providers, for example providers only used by
+#     resources and not declared.
+#
+# Entries cached for unlocked constraints such as ">= 5.0" pin the provider version resolved by the first build until
+# the entry expires (see var.provider_cache_expiration_days).
+#
+# Standard library only, the CodeBuild image python has no extra packages.
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import re
+import sys
+
+KEY_VERSION = 1
+DEFAULT_HOST = "registry.terraform.io"
+DEFAULT_NAMESPACE = "hashicorp"
+LOCK_FILE = ".terraform.lock.hcl"
+SKIPPED_DIRS = {".terraform", ".git"}
+
+
+# Fully qualified lowercase provider source address, for example "aws" -> "registry.terraform.io/hashicorp/aws"
+def normalize_source(source):
+    parts = source.strip().lower().split("/")
+    if len(parts) == 1:
+        parts = [DEFAULT_NAMESPACE] + parts
+    if len(parts) == 2:
+        parts = [DEFAULT_HOST] + parts
+    return "/".join(parts)
+
+
+# [(source, version)] of the provider blocks of a dependency lock file
+def lock_file_providers(text):
+    providers = []
+    for match in re.finditer(r'^provider\s+"([^"]+)"\s*\{(.*?)^\}', text, re.MULTILINE | re.DOTALL):
+        version = re.search(r'^\s*version\s*=\s*"([^"]*)"', match.group(2), re.MULTILINE)
+        providers.append((normalize_source(match.group(1)), version.group(1) if version else ""))
+    return providers
+
+
+# [(source, version constraint)] of a .tf.json document
+def tf_json_providers(doc):
+    providers = []
+    for terraform in _blocks(doc.get("terraform") if isinstance(doc, dict) else None):
+        for required in _blocks(terraform.get("required_providers")):
+            for name, requirement in required.items():
+                providers.append(_requirement(name, requirement))
+    for provider in _blocks(doc.get("provider") if isinstance(doc, dict) else None):
+        providers.extend((normalize_source(name), "") for name in provider)
+    return providers
+
+
+# [(source, version constraint)] of a .tf file. Only required_providers and provider blocks are read, with regular
+# expressions rather than a full HCL parser.
+def tf_providers(text):
+    text = _strip_comments(text)
+    providers = []
+    for match in re.finditer(r"\brequired_providers\s*\{", text):
+        block = _block_body(text, match.end())
+        for entry in re.finditer(r'([A-Za-z][\w-]*)\s*=\s*(\{[^{}]*\}|"[^"]*")', block):
+            name, value = entry.groups()
+            if value.startswith('"'):
+                providers.append(_requirement(name, value.strip('"')))
+                continue
+            requirement = {}
+            for attribute in re.finditer(r'(source|version)\s*=\s*"([^"]*)"', value):
+                requirement[attribute.group(1)] = attribute.group(2)
+            providers.append(_requirement(name, requirement))
+    for match in re.finditer(r'^\s*provider\s+"([^"]+)"\s*\{', text, re.MULTILINE):
+        providers.append((normalize_source(match.group(1)), ""))
+    return providers
+
+
+# Provider requirements of an unzipped artifact: {"locked": bool, "providers": sorted [(source, version)]}
+def requirements(artifact_dir):
+    lock_file = os.path.join(artifact_dir, LOCK_FILE)
+    if os.path.isfile(lock_file):
+        with open(lock_file) as f:
+            return {"locked": True, "providers": sorted(set(lock_file_providers(f.read())))}
+
+    providers = set()
+    for root, dirs, files in os.walk(artifact_dir):
+        dirs[:] = sorted(d for d in dirs if d not in SKIPPED_DIRS)
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            try:
+                if name.endswith(".tf.json"):
+                    with open(path) as f:
+                        providers.update(tf_json_providers(json.load(f)))
+                elif name.endswith(".tf"):
+                    with open(path) as f:
+                        providers.update(tf_providers(f.read()))
+            except (OSError, ValueError, UnicodeDecodeError) as e:
+                print(f"skipping {path}: {e!r}", file=sys.stderr)
+
+    # A provider declared both with and without a constraint, keep the constrained declarations
+    constrained = {source for source, constraint in providers if constraint}
+    providers = {(s, c) for s, c in providers if c or s not in constrained}
+    return {"locked": False, "providers": sorted(providers)}
+
+
+def cache_key(artifact_dir, terraform_version, platform):
+    key_doc = {
+        "keyVersion": KEY_VERSION,
+        "terraformVersion": terraform_version,
+        "platform": platform,
+        **requirements(artifact_dir),
+    }
+    return hashlib.sha256(json.dumps(key_doc, sort_keys=True).encode()).hexdigest()
+
+
+# Providers of a TF_PLUGIN_CACHE_DIR / unpacked filesystem mirror: HOSTNAME/NAMESPACE/TYPE/VERSION/PLATFORM/
+def mirror_providers(mirror_dir):
+    providers = []
+    for root, dirs, _ in os.walk(mirror_dir):
+        dirs.sort()
+        parts = os.path.relpath(root, mirror_dir).split(os.sep)
+        if len(parts) == 5:
+            dirs[:] = []
+            host, namespace, provider_type, version, platform = parts
+            providers.append(
+                {"source": f"{host}/{namespace}/{provider_type}".lower(), "version": version, "platform": platform}
+            )
+    return providers
+
+
+def manifest(mirror_dir, key, terraform_version, platform):
+    return {
+        "key": key,
+        "keyVersion": KEY_VERSION,
+        "terraformVersion": terraform_version,
+        "platform": platform,
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "providers": mirror_providers(mirror_dir),
+    }
+
+
+# Required providers missing from a manifest. Locked providers must be cached with the locked version.
+def missing_providers(manifest_doc, artifact_dir):
+    platform = manifest_doc["platform"]
+    cached = {(p["source"], p["version"]) for p in manifest_doc["providers"] if p["platform"] == platform}
+    cached_sources = {source for source, _ in cached}
+    required = requirements(artifact_dir)
+    if required["locked"]:
+        return [f"{s} {v}" for s, v in required["providers"] if (s, v) not in cached]
+    return sorted({s for s, _ in required["providers"]} - cached_sources)
+
+
+def _blocks(value):
+    if isinstance(value, dict):
+        return [value]
+    if isinstance(value, list):
+        return [v for v in value if isinstance(v, dict)]
+    return []
+
+
+# (source, version constraint) of a required_providers entry, {"source": ..., "version": ...} or a legacy version string
+def _requirement(name, requirement):
+    if isinstance(requirement, str):
+        return normalize_source(name), requirement.strip()
+    return normalize_source(requirement.get("source") or name), str(requirement.get("version", "")).strip()
+
+
+# Body of the block whose opening brace ends at `start`
+def _block_body(text, start):
+    depth = 1
+    pos = start
+    while pos < len(text) and depth:
+        if text[pos] == '"':
+            pos = text.find('"', pos + 1)
+            if pos < 0:
+                break
+        elif text[pos] == "{":
+            depth += 1
+        elif text[pos] == "}":
+            depth -= 1
+        pos += 1
+    return text[start : pos - 1]
+
+
+def _strip_comments(text):
+    # Strings are kept as is, comment markers inside them are not comments
+    pattern = r'("(?:\\.|[^"\\])*")|/\*.*?\*/|(?://|#)[^\n]*'
+    return re.sub(pattern, lambda m: m.group(1) or "", text, flags=re.DOTALL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Terraform provider cache keys and manifests")
+    commands = parser.add_subparsers(dest="command", required=True)
+    key_parser = commands.add_parser("key")
+    key_parser.add_argument("artifact_dir")
+    key_parser.add_argument("terraform_version")
+    key_parser.add_argument("platform")
+    manifest_parser = commands.add_parser("manifest")
+    manifest_parser.add_argument("mirror_dir")
+    manifest_parser.add_argument("key")
+    manifest_parser.add_argument("terraform_version")
+    manifest_parser.add_argument("platform")
+    check_parser = commands.add_parser("check")
+    check_parser.add_argument("manifest")
+    check_parser.add_argument("artifact_dir")
+    args = parser.parse_args()
+
+    if args.command == "key":
+        print(cache_key(args.artifact_dir, args.terraform_version, args.platform))
+    elif args.command == "manifest":
+        print(json.dumps(manifest(args.mirror_dir, args.key, args.terraform_version, args.platform), indent=2))
+    elif args.command == "check":
+        with open(args.manifest) as f:
+            missing = missing_providers(json.load(f), args.artifact_dir)
+        if missing:
+            print("providers missing from the cached mirror:", ", ".join(missing))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
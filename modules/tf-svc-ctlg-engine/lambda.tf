@@ -51,22 +51,78 @@ resource "aws_iam_role_policy" "lambda" {
       {
         Effect = "Allow"
         Action = [
+          "sqs:ChangeMessageVisibility",
           "sqs:DeleteMessage",
           "sqs:GetQueueAttributes",
+          "sqs:GetQueueUrl",
           "sqs:ReceiveMessage",
         ]
-        Resource = [for q in aws_sqs_queue.product_operation : q.arn]
+        Resource = concat([for q in aws_sqs_queue.product_operation : q.arn], [aws_sqs_queue.notify_retry.arn])
       },
       {
         Effect   = "Allow"
-        Action   = "states:StartExecution"
+        Action   = "sqs:SendMessage"
+        Resource = aws_sqs_queue.notify_retry.arn
+      },
+      {
+        Effect   = "Allow"
+        Action = [
+          "states:ListExecutions",
+          "states:StartExecution",
+        ]
         Resource = aws_sfn_state_machine.product_operation.arn
       },
+      {
+        Effect   = "Allow"
+        Action   = "states:DescribeExecution"
+        Resource = "arn:${local.partition}:states:${local.region}:${local.acct_id}:execution:${aws_sfn_state_machine.product_operation.name}:*"
+      },
       {
         Effect   = "Allow"
         Action   = "s3:GetObject"
         Resource = "${aws_s3_bucket.tfstate.arn}/*"
       },
+      {
+        Effect   = "Allow"
+        Action   = "s3:PutObject"
+        Resource = "${aws_s3_bucket.tfstate.arn}/${local.parameter_cache_prefix}*"
+      },
+      {
+        Effect   = "Allow"
+        Action   = "s3:PutObject"
+        Resource = "${aws_s3_bucket.tfstate.arn}/${local.ledger_prefix}*"
+      },
+      {
+        Effect = "Allow"
+        Action = [
+          "s3:DeleteObject",
+          "s3:PutObject",
+        ]
+        Resource = "${aws_s3_bucket.tfstate.arn}/${local.scheduler_prefix}*"
+      },
+      {
+        Effect = "Allow"
+        Action = [
+          "s3:DeleteObject",
+          "s3:PutObject",
+        ]
+        Resource = "${aws_s3_bucket.tfstate.arn}/*.fingerprint.json"
+      },
+      {
+        Effect = "Allow"
+        Action = [
+          "s3:DeleteObject",
+          "s3:PutObject",
+          "s3:PutObjectTagging",
+        ]
+        Resource = "${aws_s3_bucket.tfstate.arn}/*.context.json"
+      },
+      {
+        # Missing objects are reported as NoSuchKey instead of AccessDenied
+        Effect   = "Allow"
+        Action   = "s3:ListBucket"
+        Resource = aws_s3_bucket.tfstate.arn
+      },
     ]
   })
 }
@@ -83,6 +139,8 @@ resource "aws_cloudwatch_log_group" "lambda" {
     aws_lambda_function.start_product_operation.function_name,
     aws_lambda_function.succeeded_product_operation.function_name,
     aws_lambda_function.failed_product_operation.function_name,
+    aws_lambda_function.retry_notifications.function_name,
+    aws_lambda_function.release_stale_operations.function_name,
   ])
   name              = "/aws/lambda/${each.key}"
   retention_in_days = 14
@@ -101,6 +159,10 @@ resource "aws_lambda_function" "parameter_parser" {
   environment {
     variables = {
       VARIABLES_TF_JSON_FILENAME = "variables.tf.json"
+      PARAMETER_CACHE_BUCKET     = aws_s3_bucket.tfstate.id
+      PARAMETER_CACHE_PREFIX     = local.parameter_cache_prefix
+      LOG_LEVEL                  = var.log_level
+      LOG_DEBUG_SAMPLE_RATE      = tostring(var.log_debug_sample_rate)
     }
   }
 }
@@ -112,6 +174,8 @@ resource "aws_lambda_permission" "parameter_parser_servicecatalog" {
 }
 
 # https://docs.aws.amazon.com/servicecatalog/latest/adminguide/external-engine.html#external-engine-provisioning
+# A batch of 10 records is dispatched by 10 threads, each doing S3, ledger and Step Functions calls and possibly
+# notifying FAILED with retries (NOTIFY_RETRY_SECONDS). The timeout is shorter than the queue visibility timeout.
 resource "aws_lambda_function" "start_product_operation" {
   function_name    = "TerraformSvcCtlgEngineStartProductOperation"
   role             = aws_iam_role.lambda.arn
@@ -119,12 +183,22 @@ resource "aws_lambda_function" "start_product_operation" {
   source_code_hash = data.archive_file.lambda.output_base64sha256
   handler          = "start_product_operation.handler"
   runtime          = local.lambda_runtime
-  timeout          = 10
+  timeout          = 60
 
   environment {
     variables = {
-      STATE_MACHINE_ARN   = aws_sfn_state_machine.product_operation.arn
-      TFSTATE_BUCKET_NAME = aws_s3_bucket.tfstate.id
+      STATE_MACHINE_ARN        = aws_sfn_state_machine.product_operation.arn
+      TFSTATE_BUCKET_NAME      = aws_s3_bucket.tfstate.id
+      LEDGER_PREFIX            = local.ledger_prefix
+      SCHEDULER_PREFIX         = local.scheduler_prefix
+      SKIP_NOOP_UPDATES        = tostring(var.skip_noop_updates)
+      MAX_IN_FLIGHT_EXECUTIONS = tostring(var.max_in_flight_operations)
+      STATE_KEY_LAYOUT         = var.state_key_layout
+      STATE_KEY_PARTITIONS     = tostring(var.state_key_partitions)
+      LOG_LEVEL                = var.log_level
+      LOG_DEBUG_SAMPLE_RATE    = tostring(var.log_debug_sample_rate)
+      NOTIFY_RETRY_QUEUE_URL   = aws_sqs_queue.notify_retry.url
+      NOTIFY_RATE_PER_SECOND   = tostring(var.notify_rate_per_second)
     }
   }
 }
@@ -134,9 +208,14 @@ resource "aws_lambda_event_source_mapping" "start_product_operation_sqs_queues"
 
   event_source_arn = each.value.arn
   function_name    = aws_lambda_function.start_product_operation.function_name
-  batch_size       = 1
+  batch_size       = 10
+
+  # Only failed messages in a batch are released back into the queue
+  function_response_types = ["ReportBatchItemFailures"]
 }
 
+# The succeeded and failed lambdas notify the operation result and the queued operations failing to start, each
+# notification retried for NOTIFY_RETRY_SECONDS at most and queued when the invocation is about to time out
 resource "aws_lambda_function" "succeeded_product_operation" {
   function_name    = "TerraformSvcCtlgEngineSucceededProductOperation"
   role             = aws_iam_role.lambda.arn
@@ -144,7 +223,19 @@ resource "aws_lambda_function" "succeeded_product_operation" {
   source_code_hash = data.archive_file.lambda.output_base64sha256
   handler          = "succeeded_product_operation.handler"
   runtime          = local.lambda_runtime
-  timeout          = 10
+  timeout          = 60
+
+  environment {
+    variables = {
+      TFSTATE_BUCKET_NAME    = aws_s3_bucket.tfstate.id
+      LEDGER_PREFIX          = local.ledger_prefix
+      SCHEDULER_PREFIX       = local.scheduler_prefix
+      LOG_LEVEL              = var.log_level
+      LOG_DEBUG_SAMPLE_RATE  = tostring(var.log_debug_sample_rate)
+      NOTIFY_RETRY_QUEUE_URL = aws_sqs_queue.notify_retry.url
+      NOTIFY_RATE_PER_SECOND = tostring(var.notify_rate_per_second)
+    }
+  }
 }
 
 resource "aws_lambda_function" "failed_product_operation" {
@@ -154,5 +245,97 @@ resource "aws_lambda_function" "failed_product_operation" {
   source_code_hash = data.archive_file.lambda.output_base64sha256
   handler          = "failed_product_operation.handler"
   runtime          = local.lambda_runtime
-  timeout          = 10
+  timeout          = 60
+
+  environment {
+    variables = {
+      TFSTATE_BUCKET_NAME    = aws_s3_bucket.tfstate.id
+      LEDGER_PREFIX          = local.ledger_prefix
+      SCHEDULER_PREFIX       = local.scheduler_prefix
+      LOG_LEVEL              = var.log_level
+      LOG_DEBUG_SAMPLE_RATE  = tostring(var.log_debug_sample_rate)
+      NOTIFY_RETRY_QUEUE_URL = aws_sqs_queue.notify_retry.url
+      NOTIFY_RATE_PER_SECOND = tostring(var.notify_rate_per_second)
+    }
+  }
+}
+
+resource "aws_lambda_function" "retry_notifications" {
+  function_name    = "TerraformSvcCtlgEngineRetryNotifications"
+  role             = aws_iam_role.lambda.arn
+  filename         = data.archive_file.lambda.output_path
+  source_code_hash = data.archive_file.lambda.output_base64sha256
+  handler          = "retry_notifications.handler"
+  runtime          = local.lambda_runtime
+  timeout          = 30
+
+  environment {
+    variables = {
+      NOTIFY_RATE_PER_SECOND = tostring(var.notify_rate_per_second)
+      LOG_LEVEL              = var.log_level
+      LOG_DEBUG_SAMPLE_RATE  = tostring(var.log_debug_sample_rate)
+    }
+  }
+}
+
+# Records of a batch are retried one after the other, small batches are notified within the function timeout, itself
+# shorter than the queue visibility timeout
+resource "aws_lambda_event_source_mapping" "retry_notifications_sqs_queue" {
+  event_source_arn = aws_sqs_queue.notify_retry.arn
+  function_name    = aws_lambda_function.retry_notifications.function_name
+  batch_size       = 5
+
+  # Few concurrent invocations, queued notifications were throttled
+  scaling_config {
+    maximum_concurrency = 2
+  }
+
+  # Only failed messages in a batch are released back into the queue
+  function_response_types = ["ReportBatchItemFailures"]
+}
+
+resource "aws_lambda_function" "release_stale_operations" {
+  function_name    = "TerraformSvcCtlgEngineReleaseStaleOperations"
+  role             = aws_iam_role.lambda.arn
+  filename         = data.archive_file.lambda.output_path
+  source_code_hash = data.archive_file.lambda.output_base64sha256
+  handler          = "release_stale_operations.handler"
+  runtime          = local.lambda_runtime
+  timeout          = 120
+
+  # One sweep at a time, a slow sweep must not overlap the next scheduled one
+  reserved_concurrent_executions = 1
+
+  environment {
+    variables = {
+      STATE_MACHINE_ARN      = aws_sfn_state_machine.product_operation.arn
+      TFSTATE_BUCKET_NAME    = aws_s3_bucket.tfstate.id
+      LEDGER_PREFIX          = local.ledger_prefix
+      SCHEDULER_PREFIX       = local.scheduler_prefix
+      LOG_LEVEL              = var.log_level
+      LOG_DEBUG_SAMPLE_RATE  = tostring(var.log_debug_sample_rate)
+      NOTIFY_RETRY_QUEUE_URL = aws_sqs_queue.notify_retry.url
+      NOTIFY_RATE_PER_SECOND = tostring(var.notify_rate_per_second)
+    }
+  }
+}
+
+# Products blocked by an operation that did not complete are released within minutes, without waiting for another
+# operation of the product
+resource "aws_cloudwatch_event_rule" "release_stale_operations" {
+  name                = "TerraformSvcCtlgEngineReleaseStaleOperations"
+  description         = "Release provisioned products whose running operation did not start the next queued operation"
+  schedule_expression = "rate(5 minutes)"
+}
+
+resource "aws_cloudwatch_event_target" "release_stale_operations" {
+  rule = aws_cloudwatch_event_rule.release_stale_operations.name
+  arn  = aws_lambda_function.release_stale_operations.arn
+}
+
+resource "aws_lambda_permission" "release_stale_operations_events" {
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.release_stale_operations.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.release_stale_operations.arn
 }
@@ -0,0 +1,130 @@
+# Admission control for state machine executions. Every execution runs a CodeBuild build, builds over the CodeBuild
+# concurrent build quota wait in the CodeBuild queue while the Service Catalog workflow token keeps running. During bulk
+# rollouts start_product_operation only starts an execution while fewer than MAX_IN_FLIGHT executions are running.
+# Messages over the budget are deferred: their visibility timeout is extended with exponential backoff and jitter, and
+# they are returned to the queue as batch item failures without notifying Service Catalog.
+#
+# The in-flight count is the number of RUNNING executions of the state machine, read at most once per batch.
+# ListExecutions is eventually consistent and concurrent invocations admit from their own count, so the budget is a soft
+# limit: it can be exceeded by up to the batch size per concurrent invocation. A batch whose count cannot be read, for
+# example when ListExecutions is throttled during a burst, is deferred rather than failed.
+#
+# Queue depth and in-flight gauges are emitted at most every GAUGE_INTERVAL_SECONDS per execution environment, and not
+# at all with admission control disabled.
+#
+# Each deferral is a receive of the message, the queue maxReceiveCount must allow for the deferrals (see sqs.tf).
+
+import os
+import random
+import threading
+import time
+
+import clients
+import metrics
+
+# 0 disables admission control
+MAX_IN_FLIGHT = int(os.environ.get("MAX_IN_FLIGHT_EXECUTIONS", "0"))
+DEFER_BASE_SECONDS = int(os.environ.get("ADMISSION_DEFER_BASE_SECONDS", "30"))
+DEFER_MAX_SECONDS = int(os.environ.get("ADMISSION_DEFER_MAX_SECONDS", "900"))
+GAUGE_INTERVAL_SECONDS = int(os.environ.get("ADMISSION_GAUGE_INTERVAL_SECONDS", "60"))
+
+# {queue arn: queue url}
+_queue_urls = {}
+# time.monotonic() of the last gauges
+_gauges_emitted = None
+
+
+class Deferred(Exception):
+    pass
+
+
+# Execution slots of one batch, shared by the threads handling its records
+class Budget:
+    def __init__(self, max_in_flight=None):
+        self.max_in_flight = MAX_IN_FLIGHT if max_in_flight is None else max_in_flight
+        self.lock = threading.Lock()
+        # Read on first use, batches that start no execution make no ListExecutions call
+        self.in_flight = None
+
+    # Takes a slot for an execution about to be started, raises Deferred if the budget is used up
+    def acquire(self):
+        if not self.max_in_flight:
+            return
+        with self.lock:
+            if self.in_flight is None:
+                try:
+                    self.in_flight = running_executions()
+                except Exception as e:
+                    raise Deferred(f"Could not count state machine executions in flight: {e!r}") from e
+            if self.in_flight >= self.max_in_flight:
+                raise Deferred(f"{self.in_flight} state machine executions in flight, budget is {self.max_in_flight}")
+            self.in_flight += 1
+
+    # Gives back a slot taken for an operation that did not start an execution
+    def release(self):
+        if not self.max_in_flight:
+            return
+        with self.lock:
+            self.in_flight -= 1
+
+    def count(self):
+        with self.lock:
+            if self.in_flight is None:
+                self.in_flight = running_executions()
+            return self.in_flight
+
+
+def running_executions():
+    paginator = clients.client("stepfunctions").get_paginator("list_executions")
+    pages = paginator.paginate(stateMachineArn=os.environ["STATE_MACHINE_ARN"], statusFilter="RUNNING")
+    return sum(len(page["executions"]) for page in pages)
+
+
+# Hides the message of a deferred record until it should be retried. Returns the delay in seconds.
+def defer(record):
+    receive_count = int(record["attributes"].get("ApproximateReceiveCount", "1"))
+    delay = min(DEFER_MAX_SECONDS, DEFER_BASE_SECONDS * 2 ** min(receive_count - 1, 16))
+    # Spread the messages deferred in a burst, so they don't all come back at once
+    delay = random.randint(max(1, delay // 2), max(1, delay))
+    clients.client("sqs").change_message_visibility(
+        QueueUrl=queue_url(record["eventSourceARN"]),
+        ReceiptHandle=record["receiptHandle"],
+        VisibilityTimeout=delay,
+    )
+    metrics.emit({"DeferredOperations": (1, "Count")}, {"Queue": record["eventSourceARN"].split(":")[-1]})
+    return delay
+
+
+# Queue depth gauges of the queues of the batch and the in-flight executions gauge
+def emit_gauges(records, budget):
+    global _gauges_emitted
+    if not budget.max_in_flight:
+        return
+    now = time.monotonic()
+    if _gauges_emitted is not None and now - _gauges_emitted < GAUGE_INTERVAL_SECONDS:
+        return
+    _gauges_emitted = now
+
+    for queue_arn in sorted({r["eventSourceARN"] for r in records if "eventSourceARN" in r}):
+        attributes = clients.client("sqs").get_queue_attributes(
+            QueueUrl=queue_url(queue_arn),
+            AttributeNames=["ApproximateNumberOfMessages", "ApproximateNumberOfMessagesNotVisible"],
+        )["Attributes"]
+        metrics.emit(
+            {
+                "QueueDepth": (int(attributes["ApproximateNumberOfMessages"]), "Count"),
+                "QueueInFlightMessages": (int(attributes["ApproximateNumberOfMessagesNotVisible"]), "Count"),
+            },
+            {"Queue": queue_arn.split(":")[-1]},
+        )
+    metrics.emit({"InFlightExecutions": (budget.count(), "Count")}, {})
+
+
+def queue_url(queue_arn):
+    if queue_arn not in _queue_urls:
+        account_id, name = queue_arn.split(":")[4:6]
+        _queue_urls[queue_arn] = clients.client("sqs").get_queue_url(
+            QueueName=name,
+            QueueOwnerAWSAccountId=account_id,
+        )["QueueUrl"]
+    return _queue_urls[queue_arn]
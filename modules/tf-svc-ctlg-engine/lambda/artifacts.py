@@ -0,0 +1,16 @@
+import re
+
+# Service Catalog copies provisioning artifacts to a new path for every request, but the path embeds content hashes of
+# the product version:
+#   s3://sc-<hash>-<region>/out/<hash>/<hash>-<sha256>-<sha256>-<timestamp>-<uuid>
+# The "<hash>-<sha256>-<sha256>" portion is stable for a product version.
+ARTIFACT_PATH_CONTENT_HASH_PATTERN = re.compile(
+    r"(?i)s3://[^/]+/(?:.+/)?([0-9a-f]{32}-[0-9a-f]{64}-[0-9a-f]{64})-\d+-[0-9a-f]{8}(?:-[0-9a-f]{4}){3}-[0-9a-f]{12}"
+)
+
+
+def content_hash(artifact_path):
+    match = ARTIFACT_PATH_CONTENT_HASH_PATTERN.fullmatch(artifact_path)
+    if not match:
+        return None
+    return match.group(1).lower()
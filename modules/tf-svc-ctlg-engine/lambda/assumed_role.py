@@ -0,0 +1,71 @@
+# Cache of assumed role credentials and clients, shared by engine lambdas that call AWS APIs using the product launch
+# role. Credentials are kept per role ARN across warm invocations and refreshed before they expire. Each (role, service)
+# pair gets one client, which pools its connections. Concurrent refreshes for the same role (threads within one
+# invocation) wait on a per-role lock, so they share a single sts:AssumeRole call.
+
+import datetime
+import os
+import threading
+
+import clients
+
+# Refresh credentials when they are this close to expiring
+REFRESH_BEFORE_EXPIRY = datetime.timedelta(seconds=int(os.environ.get("ASSUMED_ROLE_REFRESH_SECONDS", "300")))
+
+_lock = threading.Lock()
+# {role arn: threading.Lock}
+_role_locks = {}
+# {role arn: {"credentials": sts credentials, "clients": {service name: client}}}
+_roles = {}
+
+counters = {
+    "assume_role_calls": 0,
+}
+
+
+def client(role_arn, service_name):
+    role = _role(role_arn)
+    service_client = role["clients"].get(service_name)
+    if service_client is None:
+        with _role_lock(role_arn):
+            service_client = role["clients"].get(service_name)
+            if service_client is None:
+                service_client = role["clients"][service_name] = clients.client_with_credentials(
+                    service_name, role["credentials"]
+                )
+    return service_client
+
+
+def _role(role_arn):
+    role = _roles.get(role_arn)
+    if role is not None and not _expiring(role["credentials"]):
+        return role
+
+    with _role_lock(role_arn):
+        # Another thread may have refreshed the credentials while this thread waited for the lock
+        role = _roles.get(role_arn)
+        if role is not None and not _expiring(role["credentials"]):
+            return role
+
+        print("assuming role", role_arn)
+        creds = clients.client("sts").assume_role(
+            RoleArn=role_arn,
+            RoleSessionName=os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "cross-acct"),
+        )["Credentials"]
+        counters["assume_role_calls"] += 1
+
+        role = _roles[role_arn] = {
+            "credentials": creds,
+            # Clients hold the credentials they were created with, create new clients with refreshed credentials
+            "clients": {},
+        }
+        return role
+
+
+def _role_lock(role_arn):
+    with _lock:
+        return _role_locks.setdefault(role_arn, threading.Lock())
+
+
+def _expiring(creds):
+    return creds["Expiration"] - datetime.datetime.now(datetime.timezone.utc) <= REFRESH_BEFORE_EXPIRY
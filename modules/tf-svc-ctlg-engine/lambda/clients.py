@@ -0,0 +1,72 @@
+# Lazily created boto3 clients shared by the engine lambdas. Clients are created on first use instead of at import time,
+# so code paths that don't call a service don't pay to create its client on cold start. All clients are created from one
+# botocore session, which loads each service model and endpoint data once, and share connection pool, keep-alive and
+# retry settings.
+
+import os
+import threading
+
+import boto3
+import botocore.config
+
+CONFIG = botocore.config.Config(
+    # start_product_operation dispatches batch records on a thread pool
+    max_pool_connections=int(os.environ.get("AWS_MAX_POOL_CONNECTIONS", "20")),
+    tcp_keepalive=True,
+    connect_timeout=5,
+    retries={
+        "mode": "standard",
+        "max_attempts": int(os.environ.get("AWS_MAX_ATTEMPTS", "5")),
+    },
+)
+
+_lock = threading.RLock()
+_session = None
+# {service name: client}
+_clients = {}
+
+
+def session():
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = boto3.session.Session()
+    return _session
+
+
+def client(service_name):
+    service_client = _clients.get(service_name)
+    if service_client is None:
+        with _lock:
+            service_client = _clients.get(service_name)
+            if service_client is None:
+                service_client = _clients[service_name] = session().client(service_name, config=CONFIG)
+    return service_client
+
+
+# Client making a single attempt per api call, for callers that retry themselves
+def client_without_retries(service_name):
+    key = f"{service_name}:without-retries"
+    service_client = _clients.get(key)
+    if service_client is None:
+        with _lock:
+            service_client = _clients.get(key)
+            if service_client is None:
+                # "max_attempts" counts retries, "total_max_attempts" the first attempt too
+                retries = {"mode": "standard", "total_max_attempts": 1}
+                config = CONFIG.merge(botocore.config.Config(retries=retries))
+                service_client = _clients[key] = session().client(service_name, config=config)
+    return service_client
+
+
+# Client using explicit credentials, for example assumed role credentials, sharing the session and settings above
+def client_with_credentials(service_name, creds):
+    with _lock:
+        return session().client(
+            service_name,
+            config=CONFIG,
+            aws_access_key_id=creds["AccessKeyId"],
+            aws_secret_access_key=creds["SecretAccessKey"],
+            aws_session_token=creds["SessionToken"],
+        )
@@ -2,33 +2,63 @@
 # ServiceCatalog Notify*ProductEngineWorkflowResult api is called manually.
 
 import json
-import boto3
 import os
+import re
+import time
 
-sc = boto3.client("servicecatalog")
-s3 = boto3.resource("s3")
+import clients
+import fingerprint
+import ledger
+import log
+import notify
+import op_context
+import op_trace
+import scheduler
+
+# Only the end of terraform stderr is read, runaway provider errors can produce multi-MB stderr
+STDERR_TAIL_BYTES = int(os.environ.get("STDERR_TAIL_BYTES", str(16 * 1024)))
+FAILURE_REASON_MAX_CHARS = 2048
 
 
 def handler(event, context):
-    print(json.dumps(event, default=str))
+    log.start_invocation()
+    log.info("lambda invocation event", event=event)
+    deadline = notify.invocation_deadline(context)
     op_req = event["State"]["productOperationRequest"]
     operation = op_req["operation"]
+    trace = event["State"].get("trace", {})
+
+    # Skip retried invocations, Service Catalog has already been notified of the result of this operation
+    try:
+        op_state = ledger.state(op_req)
+    except Exception as e:
+        print("Could not load operation state from ledger", repr(e))
+    else:
+        if op_state in ledger.COMPLETED:
+            print(f"product operation '{op_req['recordId']}' already {op_state}, skipping notification")
+            # A previous invocation may have failed before starting the next queued operation
+            scheduler.complete(op_req, deadline)
+            return
 
     try:
         error_cause = json.loads(event["State"]["Error"]["Cause"])
-        print(json.dumps(error_cause))
+        log.info("state machine error cause", errorCause=error_cause)
+        # CodeBuild task failures carry the failed build as the error cause
+        op_trace.emit_build(error_cause.get("Build", error_cause).get("Phases", []), op_req)
     except Exception as e:
         print("Could not load error cause from event:", repr(e))
 
-    addl_failure_info = ""
+    execution_id = event["Context"]["Execution"]["Id"]
+    failure_reason = f"Terraform provisioning Step Functions State Machine failed: {execution_id} "
 
-    # Attempt to load terraform stderr
+    # Attempt to load the end of terraform stderr, the last errors are the most useful part of the failure reason
     try:
-        cb_env_vars = event["State"]["codebuild"]["environmentVariablesOverride"]
-        tf_stderr_s3_uri = {v["Name"]: v["Value"] for v in cb_env_vars}["STDERR_S3_URI"]
-        print("loading terraform stderr:", tf_stderr_s3_uri)
-        tf_stderr = s3_get_object(tf_stderr_s3_uri)
-        addl_failure_info += tf_stderr
+        tf_stderr_s3_uri = op_context.env_vars(event["State"])["STDERR_S3_URI"]
+        print("loading terraform stderr tail:", tf_stderr_s3_uri)
+        s3_read_started = time.perf_counter()
+        tf_stderr = s3_get_object_tail(tf_stderr_s3_uri, STDERR_TAIL_BYTES)
+        op_trace.emit_s3_read(s3_read_started, op_req)
+        failure_reason += failure_details(tf_stderr, FAILURE_REASON_MAX_CHARS - len(failure_reason))
     except Exception as e:
         print("Could not load terraform stderr from s3", repr(e))
 
@@ -39,27 +69,87 @@ def handler(event, context):
         # FailureReason does not render for the user on PROVISION_PRODUCT operations (Service Catalog bug?).
         # UPDATE_PROVISIONED_PRODUCT and TERMINATE_PROVISIONED_PRODUCT successfully render FailureReason for the user.
         # This can be verified using `aws servicecatalog describe-record --id rec-aaaaaaaa`
-        "FailureReason": (
-            f"Terraform provisioning Step Functions State Machine failed: {event['Context']['Execution']['Id']} "
-            + addl_failure_info
-        )[:2048],
+        "FailureReason": failure_reason[:FAILURE_REASON_MAX_CHARS],
     }
 
-    print(f"Notifying servicecatalog of product operation result for operation '{operation}' with args:")
-    print(json.dumps(notify_args, default=str))
+    log.info("notifying servicecatalog of product operation result", operation=operation, notifyArgs=notify_args)
 
-    if operation == "PROVISION_PRODUCT":
-        sc.notify_provision_product_engine_workflow_result(**notify_args)
-    elif operation == "UPDATE_PROVISIONED_PRODUCT":
-        sc.notify_update_provisioned_product_engine_workflow_result(**notify_args)
-    elif operation == "TERMINATE_PROVISIONED_PRODUCT":
-        sc.notify_terminate_provisioned_product_engine_workflow_result(**notify_args)
-    else:
-        raise Exception(f"Unknown product operation '{operation}'")
+    notify_started = time.perf_counter()
+    notify.result(operation, notify_args, deadline=deadline)
+    op_trace.emit_notified(notify_started, trace, op_req)
 
+    # Resources may be partially changed by the failed apply, the next update must run terraform
+    try:
+        if "fingerprint" in event["State"]:
+            fingerprint.delete(event["State"]["fingerprint"]["s3Uri"])
+    except Exception as e:
+        print("Could not delete fingerprint of applied inputs", repr(e))
+
+    try:
+        ledger.record(op_req, ledger.FAILED)
+    except Exception as e:
+        print("Could not record operation result in ledger", repr(e))
 
-def s3_get_object(s3_uri):
+    try:
+        if "context" in event["State"]:
+            op_context.delete(event["State"]["context"]["s3Uri"])
+    except Exception as e:
+        print("Could not delete product operation context", repr(e))
+
+    # Start the next operation queued for the provisioned product
+    scheduler.complete(op_req, deadline)
+
+
+# Read at most the last max_bytes of an object. Memory use and latency do not depend on the object size.
+def s3_get_object_tail(s3_uri, max_bytes):
     parts = s3_uri.removeprefix("s3://").split("/")
     bucket = parts.pop(0)
     key = "/".join(parts)
-    return s3.Object(bucket, key).get()["Body"].read().decode("utf-8")
+    resp = clients.client("s3").get_object(Bucket=bucket, Key=key, Range=f"bytes=-{max_bytes}")
+    data = resp["Body"].read()
+
+    # "bytes 1000-1999/2000"
+    if not resp.get("ContentRange", "bytes 0-").startswith("bytes 0-"):
+        # The range may start in the middle of a multi-byte UTF-8 character, skip its continuation bytes (10xxxxxx)
+        start = 0
+        while start < min(3, len(data)) and data[start] & 0xC0 == 0x80:
+            start += 1
+        data = data[start:]
+    return data.decode("utf-8", errors="replace")
+
+
+# Terraform error diagnostics from the end of terraform stderr that fit in max_chars, most recent errors last.
+# CodeBuild runs terraform with -no-color, diagnostics are blocks starting with "Error:" or "Warning:" after a blank
+# line:
+#
+#   Error: creating S3 Bucket (...): operation error S3: CreateBucket, ...
+#
+#     with aws_s3_bucket.bucket,
+#     on main.tf line 63, in resource "aws_s3_bucket" "bucket":
+#     63: resource "aws_s3_bucket" "bucket" {
+#
+# Without -no-color the same blocks are drawn in a box (╷ │ ╵), the box is removed first.
+def failure_details(tf_stderr, max_chars):
+    text = re.sub(r"^╷[ \t]*\n", "", tf_stderr, flags=re.MULTILINE)
+    text = re.sub(r"^╵[ \t]*$", "", text, flags=re.MULTILINE)
+    text = re.sub(r"^│ ?", "", text, flags=re.MULTILINE).lstrip()
+
+    # Text before the first diagnostic is the end of a diagnostic cut by the tail, or other output
+    starts = [m.start(1) for m in re.finditer(r"(?:\A|\n[ \t]*\n)((?:Error|Warning):)", text)]
+    blocks = [text[start:end].strip() for start, end in zip(starts, starts[1:] + [len(text)])]
+    errors = [block for block in blocks if block.startswith("Error:")]
+    if not errors:
+        # No recognizable error, the end of stderr is the most relevant part
+        return tf_stderr.strip()[-max_chars:]
+
+    # Keep every error that fits, preferring the last ones. The first line of an error is its summary, if even the last
+    # error does not fit, keep its beginning.
+    kept = []
+    size = -1
+    for error in reversed(errors):
+        if size + 1 + len(error) <= max_chars:
+            kept.insert(0, error)
+            size += 1 + len(error)
+    if not kept:
+        return errors[-1][:max_chars]
+    return "\n".join(kept)
@@ -0,0 +1,62 @@
+# Fingerprint of the inputs of a terraform apply. The fingerprint of the last successful apply is stored next to the
+# provisioned product terraform outputs. An UPDATE_PROVISIONED_PRODUCT operation with the same fingerprint would apply
+# the same artifact, parameters, tags and launch role again, so the CodeBuild terraform run can be skipped.
+
+import hashlib
+import json
+
+import botocore.exceptions
+
+import artifacts
+import clients
+
+
+# CodeBuild env vars that don't change what terraform applies. The artifact path changes on every request, the artifact
+# content hash is used instead.
+IGNORED_ENV_VARS = ["OPERATION", "STDERR_S3_URI", "ARTIFACT_S3_URI"]
+
+
+def compute(codebuild_env_vars, artifact_path):
+    if not artifact_path:
+        return None
+    artifact_content_hash = artifacts.content_hash(artifact_path)
+    if not artifact_content_hash:
+        return None
+
+    inputs = {v["Name"]: v["Value"] for v in codebuild_env_vars if v["Name"] not in IGNORED_ENV_VARS}
+    inputs["ARTIFACT_CONTENT_HASH"] = artifact_content_hash
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+
+def load(s3_uri):
+    bucket, key = _parse_s3_uri(s3_uri)
+    try:
+        resp = clients.client("s3").get_object(Bucket=bucket, Key=key)
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in ["NoSuchKey", "404"]:
+            return None
+        raise
+    return json.loads(resp["Body"].read())["fingerprint"]
+
+
+def save(s3_uri, fingerprint, op_req):
+    print("saving fingerprint of applied inputs to", s3_uri)
+    bucket, key = _parse_s3_uri(s3_uri)
+    clients.client("s3").put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=json.dumps({"fingerprint": fingerprint, "recordId": op_req["recordId"]}).encode("utf-8"),
+        ContentType="application/json",
+    )
+
+
+def delete(s3_uri):
+    print("deleting fingerprint of applied inputs", s3_uri)
+    bucket, key = _parse_s3_uri(s3_uri)
+    clients.client("s3").delete_object(Bucket=bucket, Key=key)
+
+
+def _parse_s3_uri(s3_uri):
+    parts = s3_uri.removeprefix("s3://").split("/")
+    bucket = parts.pop(0)
+    return bucket, "/".join(parts)
@@ -0,0 +1,130 @@
+# JSON documents stored as objects under a prefix in an S3 bucket. Documents shared by concurrent lambdas are updated
+# with optimistic concurrency: read the document and its version with get_versioned(), then write it with put_if(),
+# which fails with ConditionFailed if the document changed in between. Versions are S3 ETags and writes use S3
+# conditional writes (If-Match / If-None-Match).
+
+import copy
+import json
+import threading
+
+import botocore.exceptions
+
+import clients
+
+
+class ConditionFailed(Exception):
+    pass
+
+
+class S3JsonStore:
+    def __init__(self, bucket, prefix):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def get(self, key):
+        try:
+            resp = clients.client("s3").get_object(Bucket=self.bucket, Key=self.prefix + key)
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ["NoSuchKey", "404"]:
+                return None
+            raise
+        return json.loads(resp["Body"].read())
+
+    # Returns (document, version), (None, None) if there is no document
+    def get_versioned(self, key):
+        try:
+            resp = clients.client("s3").get_object(Bucket=self.bucket, Key=self.prefix + key)
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ["NoSuchKey", "404"]:
+                return None, None
+            raise
+        return json.loads(resp["Body"].read()), resp["ETag"]
+
+    # Writes the document if its version is still `version`, None if the document must not exist yet
+    def put_if(self, key, doc, version):
+        condition = {"IfMatch": version} if version else {"IfNoneMatch": "*"}
+        try:
+            clients.client("s3").put_object(
+                Bucket=self.bucket,
+                Key=self.prefix + key,
+                Body=json.dumps(doc, default=str).encode("utf-8"),
+                ContentType="application/json",
+                **condition,
+            )
+        except botocore.exceptions.ClientError as e:
+            # 409 ConditionalRequestConflict: a concurrent conditional write to the same key is in progress
+            if e.response["Error"]["Code"] in ["PreconditionFailed", "ConditionalRequestConflict"]:
+                raise ConditionFailed(f"document '{key}' changed since version {version}") from e
+            raise
+
+    def put(self, key, doc):
+        clients.client("s3").put_object(
+            Bucket=self.bucket,
+            Key=self.prefix + key,
+            Body=json.dumps(doc, default=str).encode("utf-8"),
+            ContentType="application/json",
+        )
+
+    def delete(self, key):
+        clients.client("s3").delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+    # Deletes the document if its version is still `version`
+    def delete_if(self, key, version):
+        try:
+            clients.client("s3").delete_object(Bucket=self.bucket, Key=self.prefix + key, IfMatch=version)
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ["PreconditionFailed", "ConditionalRequestConflict"]:
+                raise ConditionFailed(f"document '{key}' changed since version {version}") from e
+            raise
+
+    # Yields the keys of all documents
+    def list(self):
+        paginator = clients.client("s3").get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for obj in page.get("Contents", []):
+                yield obj["Key"].removeprefix(self.prefix)
+
+
+# In-memory stand-in for S3JsonStore, for running handlers locally without S3
+class MemoryJsonStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # {key: (document, version)}
+        self.docs = {}
+        self.versions = 0
+
+    def get(self, key):
+        return self.get_versioned(key)[0]
+
+    def get_versioned(self, key):
+        with self.lock:
+            doc, version = self.docs.get(key, (None, None))
+            return copy.deepcopy(doc), version
+
+    def put_if(self, key, doc, version):
+        with self.lock:
+            if self.docs.get(key, (None, None))[1] != version:
+                raise ConditionFailed(f"document '{key}' changed since version {version}")
+            self._put(key, doc)
+
+    def put(self, key, doc):
+        with self.lock:
+            self._put(key, doc)
+
+    def delete(self, key):
+        with self.lock:
+            self.docs.pop(key, None)
+
+    def delete_if(self, key, version):
+        with self.lock:
+            if self.docs.get(key, (None, None))[1] != version:
+                raise ConditionFailed(f"document '{key}' changed since version {version}")
+            self.docs.pop(key, None)
+
+    def list(self):
+        with self.lock:
+            return sorted(self.docs)
+
+    def _put(self, key, doc):
+        self.versions += 1
+        self.docs[key] = (json.loads(json.dumps(doc, default=str)), str(self.versions))
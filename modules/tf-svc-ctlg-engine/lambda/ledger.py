@@ -0,0 +1,45 @@
+# Idempotency ledger for product operations, keyed by Service Catalog record id. SQS delivers messages at least once,
+# and Step Functions and Lambda may retry invocations, so the same operation can reach a handler more than once.
+# Handlers check the ledger before doing work and record the operation state after:
+# - STARTED: state machine execution started. Redelivered messages start the execution again, which is a no-op because
+#   execution names are unique per record id (ExecutionAlreadyExists).
+# - SUCCEEDED / FAILED: Service Catalog has been notified of the result. Any further work for the record is skipped.
+
+import datetime
+import os
+
+import json_store
+
+STARTED = "STARTED"
+SUCCEEDED = "SUCCEEDED"
+FAILED = "FAILED"
+COMPLETED = [SUCCEEDED, FAILED]
+
+# Replace with any object implementing get(key) and put(key, doc) to use a different store
+store = json_store.S3JsonStore(os.environ.get("TFSTATE_BUCKET_NAME"), os.environ.get("LEDGER_PREFIX", "ledger/"))
+
+
+def state(op_req):
+    entry = store.get(_key(op_req))
+    if entry is None or entry["token"] != op_req["token"]:
+        return None
+    return entry["state"]
+
+
+def record(op_req, op_state):
+    print("recording operation", op_req["recordId"], "state", op_state, "in ledger")
+    store.put(
+        _key(op_req),
+        {
+            "recordId": op_req["recordId"],
+            "token": op_req["token"],
+            "operation": op_req["operation"],
+            "provisionedProductId": op_req["provisionedProductId"],
+            "state": op_state,
+            "updated": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        },
+    )
+
+
+def _key(op_req):
+    return f"{op_req['recordId']}.json"
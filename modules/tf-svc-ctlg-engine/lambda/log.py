@@ -0,0 +1,116 @@
+# Structured json log lines for engine lambdas. Payloads (events, operation requests, notify args) are large and mostly
+# repeated, so they are logged size-capped by default:
+# - strings are truncated to MAX_FIELD_CHARS
+# - lists and objects keep the first MAX_ITEMS items, with a count of the items left out
+# - nesting deeper than MAX_DEPTH is replaced with a summary
+# Payloads are only walked and serialized when the log line is emitted, debug payloads cost nothing when debug logging
+# is off.
+#
+# Sensitive values are always redacted, including in debug mode:
+# - product parameter values, the operation request does not say which parameters are isNoEcho
+# - TF_VAR_* CodeBuild environment variable values, which carry the parameter values (except default tags)
+# - parameter parser defaultValue of isNoEcho parameters
+# - credentials
+#
+# LOG_LEVEL=DEBUG logs full payloads. LOG_DEBUG_SAMPLE_RATE (0 to 1) turns on debug logging for a sample of invocations.
+
+import json
+import os
+import random
+import time
+
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+LEVEL = LEVELS[os.environ.get("LOG_LEVEL", "INFO").upper()]
+DEBUG_SAMPLE_RATE = float(os.environ.get("LOG_DEBUG_SAMPLE_RATE", "0"))
+
+MAX_FIELD_CHARS = int(os.environ.get("LOG_MAX_FIELD_CHARS", "512"))
+MAX_ITEMS = int(os.environ.get("LOG_MAX_ITEMS", "20"))
+MAX_DEPTH = 8
+
+REDACTED = "(redacted)"
+CREDENTIAL_KEYS = {"AccessKeyId", "SecretAccessKey", "SessionToken", "Credentials"}
+# Built from product tags, not parameters
+NOT_SENSITIVE_ENV_VARS = {"TF_VAR_default_tags_json"}
+
+# Level of the current invocation, see start_invocation()
+_level = LEVEL
+
+
+# Call at the start of each invocation, decides whether this invocation is sampled for debug logging
+def start_invocation():
+    global _level
+    _level = LEVELS["DEBUG"] if DEBUG_SAMPLE_RATE and random.random() < DEBUG_SAMPLE_RATE else LEVEL
+
+
+def debug_enabled():
+    return _level <= LEVELS["DEBUG"]
+
+
+def debug(message, **fields):
+    _log("DEBUG", message, fields)
+
+
+def info(message, **fields):
+    _log("INFO", message, fields)
+
+
+def warning(message, **fields):
+    _log("WARNING", message, fields)
+
+
+def error(message, **fields):
+    _log("ERROR", message, fields)
+
+
+def _log(level, message, fields):
+    if LEVELS[level] < _level:
+        return
+    full = debug_enabled()
+    line = {"timestamp": int(time.time() * 1000), "level": level, "message": message}
+    for name, value in fields.items():
+        line[name] = _prepare(value, full, 0, name)
+    print(json.dumps(line, default=str))
+
+
+# Copy of `value` for logging, redacted and, unless `full`, size-capped. `name` is the key of the value in its parent
+# object, list items have the name of their list.
+def _prepare(value, full, depth, name):
+    if isinstance(value, str):
+        if not full and len(value) > MAX_FIELD_CHARS:
+            return value[:MAX_FIELD_CHARS] + f"... [{len(value)} characters]"
+        return value
+    if isinstance(value, (bool, int, float)) or value is None:
+        return value
+    if not full and depth >= MAX_DEPTH:
+        return f"[{type(value).__name__} nested too deep]"
+
+    if isinstance(value, dict):
+        prepared = {}
+        for i, (k, v) in enumerate(value.items()):
+            if not full and i >= MAX_ITEMS:
+                prepared["..."] = f"[{len(value) - i} more keys]"
+                break
+            prepared[k] = REDACTED if _sensitive(value, k, name) else _prepare(v, full, depth + 1, k)
+        return prepared
+    if isinstance(value, (list, tuple)):
+        items = value if full else value[:MAX_ITEMS]
+        prepared = [_prepare(v, full, depth + 1, name) for v in items]
+        if len(items) < len(value):
+            prepared.append(f"[{len(value) - len(items)} more items]")
+        return prepared
+    return _prepare(str(value), full, depth, name)
+
+
+def _sensitive(obj, key, name):
+    if key in CREDENTIAL_KEYS:
+        return True
+    # Product operation request parameters {"key": ..., "value": ...}
+    if name == "parameters" and key == "value":
+        return True
+    # CodeBuild environment variables {"Name": "TF_VAR_...", "Value": ...}
+    if key == "Value" and str(obj.get("Name", "")).startswith("TF_VAR_") and obj["Name"] not in NOT_SENSITIVE_ENV_VARS:
+        return True
+    # Parameter parser response parameters
+    if key == "defaultValue" and obj.get("isNoEcho"):
+        return True
+    return False
@@ -0,0 +1,55 @@
+# CloudWatch metrics published as Embedded Metric Format (EMF) log lines. Lambda ships stdout to CloudWatch Logs, which
+# extracts the metrics, so publishing a metric costs no API call.
+# https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+
+import json
+import time
+
+NAMESPACE = "TerraformSvcCtlgEngine"
+
+# File object metric lines are written to, None writes to stdout. Replace to capture metrics offline.
+stream = None
+
+
+# metrics: {metric name: (value, unit)}
+# dimensions: {dimension name: dimension value}
+def emit(metrics, dimensions):
+    print(
+        json.dumps(
+            {
+                "_aws": {
+                    "Timestamp": int(time.time() * 1000),
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": NAMESPACE,
+                            "Dimensions": [list(dimensions)],
+                            "Metrics": [{"Name": name, "Unit": unit} for name, (_, unit) in metrics.items()],
+                        }
+                    ],
+                },
+                **dimensions,
+                **{name: value for name, (value, _) in metrics.items()},
+            }
+        ),
+        file=stream,
+    )
+
+
+# Metrics in captured log lines, such as lines written to `stream` or messages of a CloudWatch log stream. Other log
+# lines are skipped. Yields (metrics {metric name: (value, unit)}, dimensions {dimension name: dimension value}) for
+# each EMF line, the same arguments emit() was called with.
+def read(lines):
+    for line in lines:
+        start = line.find("{")
+        if start < 0 or '"_aws"' not in line:
+            continue
+        try:
+            record = json.loads(line[start:])
+        except ValueError:
+            continue
+        for directive in record.get("_aws", {}).get("CloudWatchMetrics", []):
+            if directive.get("Namespace") != NAMESPACE:
+                continue
+            metrics = {m["Name"]: (record[m["Name"]], m.get("Unit")) for m in directive["Metrics"]}
+            dimensions = {name: record[name] for dimension_set in directive["Dimensions"] for name in dimension_set}
+            yield metrics, dimensions
@@ -0,0 +1,154 @@
+# Notify Service Catalog of the result of a product operation with the Notify*ProductEngineWorkflowResult api matching
+# the operation. When many operations finish at once, for example a bulk termination, many lambdas notify at the same
+# time and Service Catalog throttles them. A notification that is never delivered leaves the provisioned product stuck
+# until it is notified manually, so notifications are:
+# - rate limited by a token bucket shared by the threads of the execution environment (NOTIFY_RATE_PER_SECOND,
+#   NOTIFY_BURST). Buckets are not shared between execution environments. A throttled call empties the bucket, which
+#   slows down every thread of the environment, not only the throttled one.
+# - retried with exponential backoff and full jitter for throttling and transient errors, for at most
+#   NOTIFY_RETRY_SECONDS and until the `deadline` of the invocation (see invocation_deadline()). Permanent errors, such
+#   as an invalid or expired workflow token, are raised without retrying.
+# - queued on the notify retry queue (NOTIFY_RETRY_QUEUE_URL) if they still fail after the retries, and delivered later
+#   by retry_notifications.py. result() then returns False instead of raising.
+
+import json
+import os
+import random
+import threading
+import time
+
+import botocore.exceptions
+
+import clients
+import metrics
+
+NOTIFY_APIS = {
+    "PROVISION_PRODUCT": "notify_provision_product_engine_workflow_result",
+    "UPDATE_PROVISIONED_PRODUCT": "notify_update_provisioned_product_engine_workflow_result",
+    "TERMINATE_PROVISIONED_PRODUCT": "notify_terminate_provisioned_product_engine_workflow_result",
+}
+
+RATE_PER_SECOND = float(os.environ.get("NOTIFY_RATE_PER_SECOND", "5"))
+BURST = float(os.environ.get("NOTIFY_BURST", "5"))
+RETRY_SECONDS = float(os.environ.get("NOTIFY_RETRY_SECONDS", "4"))
+BACKOFF_BASE_SECONDS = 0.1
+BACKOFF_MAX_SECONDS = 2
+RETRY_QUEUE_URL = os.environ.get("NOTIFY_RETRY_QUEUE_URL")
+# Time kept after the retries to queue the notification and finish the invocation
+DEADLINE_MARGIN_SECONDS = 2
+
+THROTTLING_ERRORS = {
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestThrottledException",
+    "TooManyRequestsException",
+    "RequestLimitExceeded",
+}
+
+THROTTLED = "throttled"
+TRANSIENT = "transient"
+PERMANENT = "permanent"
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Waits for a token until `deadline` (time.monotonic()). Returns False if no token is available in time.
+    def acquire(self, deadline):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    # Called when the api throttles, the next calls wait for the bucket to refill
+    def drain(self):
+        with self.lock:
+            self.tokens = min(self.tokens, 0)
+
+
+limiter = TokenBucket(RATE_PER_SECOND, BURST)
+
+
+# Deadline (time.monotonic()) for the notifications of a lambda invocation. A handler may notify several operations
+# (scheduler.complete() notifies queued operations that fail to start), retries past the deadline would time out the
+# invocation instead of queueing the notification.
+def invocation_deadline(context):
+    return time.monotonic() + context.get_remaining_time_in_millis() / 1000 - DEADLINE_MARGIN_SECONDS
+
+
+# Returns True if Service Catalog was notified, False if the notification was queued to be delivered later. With
+# `fallback` False, notifications that fail after the retries raise instead of being queued. Retries stop at
+# `deadline` (time.monotonic()) if it comes before NOTIFY_RETRY_SECONDS.
+def result(operation, notify_args, fallback=True, deadline=None):
+    if operation not in NOTIFY_APIS:
+        raise Exception(f"Unknown product operation '{operation}'")
+    try:
+        _notify_with_retries(operation, notify_args, deadline)
+        return True
+    except Exception as e:
+        if not fallback or not RETRY_QUEUE_URL or classify(e) == PERMANENT:
+            raise
+        print("Could not notify servicecatalog, queueing the notification for retry:", repr(e))
+        clients.client("sqs").send_message(
+            QueueUrl=RETRY_QUEUE_URL,
+            MessageBody=json.dumps({"operation": operation, "notifyArgs": notify_args, "error": repr(e)}, default=str),
+        )
+        metrics.emit({"NotificationsQueued": (1, "Count")}, {"Operation": operation})
+        return False
+
+
+def classify(e):
+    if isinstance(e, botocore.exceptions.ClientError):
+        if e.response["Error"].get("Code") in THROTTLING_ERRORS:
+            return THROTTLED
+        if e.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0) >= 500:
+            return TRANSIENT
+        return PERMANENT
+    if isinstance(e, (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError)):
+        return TRANSIENT
+    # Limiter timeout
+    if isinstance(e, TimeoutError):
+        return THROTTLED
+    return PERMANENT
+
+
+def _notify_with_retries(operation, notify_args, deadline=None):
+    notify_api = getattr(clients.client_without_retries("servicecatalog"), NOTIFY_APIS[operation])
+    retry_seconds = RETRY_SECONDS if deadline is None else max(0, min(RETRY_SECONDS, deadline - time.monotonic()))
+    deadline = time.monotonic() + retry_seconds
+    attempt = 0
+    while True:
+        attempt += 1
+        if not limiter.acquire(deadline):
+            raise TimeoutError(f"No notify rate limit token within {retry_seconds:.1f}s after {attempt - 1} attempts")
+        try:
+            notify_api(**notify_args)
+            if attempt > 1:
+                metrics.emit({"NotifyRetries": (attempt - 1, "Count")}, {"Operation": operation})
+            return
+        except Exception as e:
+            kind = classify(e)
+            if kind == THROTTLED:
+                limiter.drain()
+                metrics.emit({"NotifyThrottled": (1, "Count")}, {"Operation": operation})
+            if kind == PERMANENT:
+                raise
+            backoff = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2**attempt))
+            if time.monotonic() + backoff > deadline:
+                raise
+            print(f"notify attempt {attempt} {kind}, retrying in {backoff:.2f}s:", repr(e))
+            time.sleep(backoff)
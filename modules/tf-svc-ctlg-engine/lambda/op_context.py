@@ -0,0 +1,79 @@
+# Claim-check for product operation context. The full product operation request and CodeBuild environment variables
+# are written once to the tfstate bucket. State machine input carries only a reference to the context object and the
+# few operation request fields every state needs, keeping large parameter and tag sets out of Step Functions state
+# payloads and lambda invocations. Lambdas load the context only when they need it.
+#
+# Contexts include NoEcho parameter values. They are deleted once Service Catalog has been notified of the result, and
+# tagged so that the tfstate bucket lifecycle expires the contexts of operations that never finish (see s3.tf).
+
+import json
+
+import clients
+
+# Operation request fields passed through state machine state, enough to notify Service Catalog of the result
+STATE_OP_REQ_FIELDS = ["token", "operation", "recordId", "provisionedProductId", "productId", "provisioningArtifactId"]
+
+# Object tag matched by the lifecycle rule expiring contexts
+TAGGING = "svc-ctlg-engine-object=op-context"
+
+# {context s3 uri: context}, loaded contexts for the current invocation
+_loaded = {}
+
+
+def put(s3_uri, op_req, codebuild_env_vars):
+    print("saving product operation context to", s3_uri)
+    bucket, key = _parse_s3_uri(s3_uri)
+    clients.client("s3").put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=json.dumps(
+            {
+                "productOperationRequest": op_req,
+                "codebuild": {
+                    "environmentVariablesOverride": codebuild_env_vars,
+                },
+            },
+            default=str,
+        ).encode("utf-8"),
+        ContentType="application/json",
+        Tagging=TAGGING,
+    )
+
+
+def state_op_req(op_req):
+    return {k: op_req[k] for k in STATE_OP_REQ_FIELDS if k in op_req}
+
+
+# CodeBuild environment variables of the operation as {name: value}. `state` is the state machine state passed to the
+# lambda. Executions started before the claim-check was introduced carry the environment variables inline.
+def env_vars(state):
+    if "context" in state:
+        cb_env_vars = load(state["context"]["s3Uri"])["codebuild"]["environmentVariablesOverride"]
+    else:
+        cb_env_vars = state["codebuild"]["environmentVariablesOverride"]
+    return {v["Name"]: v["Value"] for v in cb_env_vars}
+
+
+def load(s3_uri):
+    context = _loaded.get(s3_uri)
+    if context is None:
+        print("loading product operation context from", s3_uri)
+        bucket, key = _parse_s3_uri(s3_uri)
+        context = json.loads(clients.client("s3").get_object(Bucket=bucket, Key=key)["Body"].read())
+        # Keep only the latest context. Threads handling other operations may replace it, return the local reference.
+        _loaded.clear()
+        _loaded[s3_uri] = context
+    return context
+
+
+def delete(s3_uri):
+    print("deleting product operation context", s3_uri)
+    bucket, key = _parse_s3_uri(s3_uri)
+    clients.client("s3").delete_object(Bucket=bucket, Key=key)
+    _loaded.pop(s3_uri, None)
+
+
+def _parse_s3_uri(s3_uri):
+    parts = s3_uri.removeprefix("s3://").split("/")
+    bucket = parts.pop(0)
+    return bucket, "/".join(parts)
@@ -0,0 +1,101 @@
+# Trace context of a product operation, used to measure where time goes between Service Catalog enqueueing an operation
+# request and the engine notifying Service Catalog of the result. The context starts from the SQS message timestamps in
+# start_product_operation and is passed through the state machine input as "trace" to the succeeded and failed
+# lambdas. Each boundary emits EMF metrics (see metrics.py) with dimensions Operation and ProductId:
+#
+# start_product_operation
+#   QueueWait          SQS sent -> first received by the lambda
+#   DispatchTime       first received -> state machine execution started, including redeliveries
+# succeeded_product_operation / failed_product_operation
+#   CodeBuildQueueTime build QUEUED phase
+#   CodeBuildRunTime   build phases after QUEUED
+#   S3ReadTime         read terraform outputs or stderr from s3
+# any lambda notifying Service Catalog
+#   NotifyLatency      Notify*ProductEngineWorkflowResult call
+#   EndToEndLatency    SQS sent -> Service Catalog notified
+#
+# All timestamps are epoch milliseconds. Executions started without a trace context, or with a malformed one, only emit
+# metrics that don't depend on it.
+
+import time
+
+import metrics
+
+# CodeBuild phases before the build runs
+BUILD_QUEUE_PHASES = ["SUBMITTED", "QUEUED"]
+
+
+def from_sqs_record(record):
+    attributes = record.get("attributes") or {}
+    trace = {}
+    sent = _timestamp(attributes, "SentTimestamp")
+    if sent is not None:
+        trace["sentTimestamp"] = sent
+    first_receive = _timestamp(attributes, "ApproximateFirstReceiveTimestamp")
+    if first_receive is not None:
+        trace["firstReceiveTimestamp"] = first_receive
+    return trace
+
+
+def now():
+    return int(time.time() * 1000)
+
+
+def dimensions(op_req):
+    # Terminate operation requests don't include the product id
+    return {"Operation": op_req["operation"], "ProductId": op_req.get("productId", "none")}
+
+
+def emit_dispatched(trace, op_req):
+    dispatched = now()
+    sent = _timestamp(trace, "sentTimestamp")
+    first_receive = _timestamp(trace, "firstReceiveTimestamp")
+    values = {}
+    if sent is not None and first_receive is not None:
+        values["QueueWait"] = (first_receive - sent, "Milliseconds")
+    if first_receive is not None:
+        values["DispatchTime"] = (dispatched - first_receive, "Milliseconds")
+    if values:
+        metrics.emit(values, dimensions(op_req))
+
+
+# phases: CodeBuild build "Phases", [{"PhaseType": ..., "DurationInSeconds": ...}]
+def emit_build(phases, op_req):
+    # The last phase (COMPLETED) has no duration
+    durations = [(p.get("PhaseType"), p["DurationInSeconds"]) for p in phases if "DurationInSeconds" in p]
+    if not durations:
+        return
+    metrics.emit(
+        {
+            "CodeBuildQueueTime": (sum(d for t, d in durations if t in BUILD_QUEUE_PHASES), "Seconds"),
+            "CodeBuildRunTime": (sum(d for t, d in durations if t not in BUILD_QUEUE_PHASES), "Seconds"),
+        },
+        dimensions(op_req),
+    )
+
+
+# started: time.perf_counter() before the s3 read
+def emit_s3_read(started, op_req):
+    metrics.emit({"S3ReadTime": (_elapsed_ms(started), "Milliseconds")}, dimensions(op_req))
+
+
+# started: time.perf_counter() before the notify call
+def emit_notified(started, trace, op_req):
+    values = {"NotifyLatency": (_elapsed_ms(started), "Milliseconds")}
+    sent = _timestamp(trace, "sentTimestamp")
+    if sent is not None:
+        values["EndToEndLatency"] = (now() - sent, "Milliseconds")
+    metrics.emit(values, dimensions(op_req))
+
+
+def _elapsed_ms(started):
+    return round((time.perf_counter() - started) * 1000, 3)
+
+
+# Timestamp `name` of a trace context or SQS attributes, None if missing or malformed. The context travels through the
+# state machine input, a malformed context must not fail the operation.
+def _timestamp(trace, name):
+    try:
+        return int(trace[name])
+    except (TypeError, KeyError, ValueError):
+        return None
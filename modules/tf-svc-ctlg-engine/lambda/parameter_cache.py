@@ -0,0 +1,108 @@
+# Cache of parameter parser responses keyed by provisioning artifact content. Service Catalog passes a new artifact path
+# for every DescribeProvisioningParameters call, but the content hash portion of the path (see artifacts.py) is stable
+# for a product version, so parsed parameters can be reused without assuming the launch role or downloading the
+# artifact.
+#
+# Two tiers:
+# - in-process LRU, kept across warm invocations of the same Lambda execution environment
+# - S3 objects under PARAMETER_CACHE_PREFIX in the engine bucket, shared by all execution environments. Objects are
+#   expired by an S3 lifecycle rule.
+
+import collections
+import hashlib
+import json
+import os
+
+import artifacts
+import clients
+
+MAX_ENTRIES = int(os.environ.get("PARAMETER_CACHE_MAX_ENTRIES", "256"))
+MAX_BYTES = int(os.environ.get("PARAMETER_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+MAX_ENTRY_BYTES = int(os.environ.get("PARAMETER_CACHE_MAX_ENTRY_BYTES", str(256 * 1024)))
+
+counters = {
+    "memory_hits": 0,
+    "s3_hits": 0,
+    "misses": 0,
+    "evictions": 0,
+}
+
+# {cache key: response json string}
+_entries = collections.OrderedDict()
+_entries_bytes = 0
+
+
+def key_from_artifact_path(artifact_path, variables_filename):
+    artifact_content_hash = artifacts.content_hash(artifact_path)
+    if not artifact_content_hash:
+        return None
+    return _key("content", artifact_content_hash, variables_filename)
+
+
+def key_from_etag(etag, variables_filename):
+    return _key("etag", etag.strip('"'), variables_filename)
+
+
+def _key(kind, value, variables_filename):
+    return hashlib.sha256(f"{kind}:{value}:{variables_filename}".encode("utf-8")).hexdigest()
+
+
+def get(cache_key):
+    resp_json = _entries.get(cache_key)
+    if resp_json is not None:
+        _entries.move_to_end(cache_key)
+        counters["memory_hits"] += 1
+        return json.loads(resp_json)
+
+    bucket = os.environ.get("PARAMETER_CACHE_BUCKET")
+    if bucket:
+        try:
+            resp = clients.client("s3").get_object(Bucket=bucket, Key=_s3_key(cache_key))
+            resp_json = resp["Body"].read().decode("utf-8")
+        except Exception as e:
+            # Missing objects are reported as AccessDenied without s3:ListBucket, treat any error as a miss
+            print("parameter cache s3 miss:", repr(e))
+        else:
+            counters["s3_hits"] += 1
+            _remember(cache_key, resp_json)
+            return json.loads(resp_json)
+
+    counters["misses"] += 1
+    return None
+
+
+def put(cache_key, resp):
+    resp_json = json.dumps(resp, default=str)
+    if len(resp_json) > MAX_ENTRY_BYTES:
+        print("parameter cache entry too large to cache:", len(resp_json), "bytes")
+        return
+    _remember(cache_key, resp_json)
+
+    bucket = os.environ.get("PARAMETER_CACHE_BUCKET")
+    if bucket:
+        try:
+            clients.client("s3").put_object(
+                Bucket=bucket,
+                Key=_s3_key(cache_key),
+                Body=resp_json.encode("utf-8"),
+                ContentType="application/json",
+            )
+        except Exception as e:
+            # The cache must never fail the parameter parser
+            print("Could not write parameter cache entry to s3:", repr(e))
+
+
+def _remember(cache_key, resp_json):
+    global _entries_bytes
+    if cache_key in _entries:
+        _entries_bytes -= len(_entries.pop(cache_key))
+    _entries[cache_key] = resp_json
+    _entries_bytes += len(resp_json)
+    while len(_entries) > MAX_ENTRIES or _entries_bytes > MAX_BYTES:
+        _, evicted_json = _entries.popitem(last=False)
+        _entries_bytes -= len(evicted_json)
+        counters["evictions"] += 1
+
+
+def _s3_key(cache_key):
+    return os.environ.get("PARAMETER_CACHE_PREFIX", "parameter-cache/") + cache_key + ".json"
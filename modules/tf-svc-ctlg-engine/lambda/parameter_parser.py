@@ -1,10 +1,10 @@
 import json
-import boto3
 import os
-import zipfile
-import shutil
 
-sts = boto3.client("sts")
+import assumed_role
+import log
+import parameter_cache
+import s3_zip
 
 
 # Example event:
@@ -16,47 +16,51 @@ sts = boto3.client("sts")
 #     "launchRoleArn": "arn:aws:iam::111111111111:role/ServiceCatalogLaunchRole"
 # }
 def handler(event, context):
-    print(json.dumps(event, default=str))
+    log.start_invocation()
+    log.info("lambda invocation event", event=event)
 
     if event["artifact"]["type"] != "AWS_S3":
         raise Exception(f"Error: Unknown artifact type '{event['artifact']['type']}', expected 'AWS_S3'")
 
-    session = assume_role(event["launchRoleArn"])
-    s3 = session.client("s3")
+    variables_filename = os.environ["VARIABLES_TF_JSON_FILENAME"]
+
+    # Product versions are parsed repeatedly as users open the launch form. Return cached parameters when the artifact
+    # path identifies the artifact content, skipping the assume role call and artifact download.
+    cache_key = parameter_cache.key_from_artifact_path(event["artifact"]["path"], variables_filename)
+    if cache_key:
+        resp = parameter_cache.get(cache_key)
+        if resp is not None:
+            print("parameter cache hit", cache_key, "cache counters:", parameter_cache.counters)
+            log.info("returning response", response=resp)
+            return resp
+
+    # Launch role credentials and client are reused across warm invocations
+    s3 = assumed_role.client(event["launchRoleArn"], "s3")
 
     s3_uri_parts = event["artifact"]["path"].removeprefix("s3://").split("/")
     bucket = s3_uri_parts.pop(0)
     object_key = "/".join(s3_uri_parts)
-    local_artifact_path = "/tmp/" + context.aws_request_id
-    local_artifact_path_zip = local_artifact_path + ".zip"
-
-    print("downloading file from bucket", bucket, "key", object_key, "to local path", local_artifact_path_zip)
-    s3.download_file(bucket, object_key, local_artifact_path_zip)
-
-    print("extracting files from", local_artifact_path_zip, "to", local_artifact_path)
-    with zipfile.ZipFile(local_artifact_path_zip, "r") as zip_ref:
-        zip_ref.extractall(local_artifact_path)
-
-    print("delete zip artifact", local_artifact_path_zip)
-    os.remove(local_artifact_path_zip)
 
-    print("extracted files to", local_artifact_path)
-    for dirpath, dirnames, filenames in os.walk(local_artifact_path):
-        print(dirpath, "dirnames:", dirnames, "filenames:", filenames)
-
-    variables_file_path = os.path.join(local_artifact_path, os.environ["VARIABLES_TF_JSON_FILENAME"])
-    print("loading variables from file", variables_file_path)
+    # Artifact path does not contain content hashes, fall back to the object ETag as the cache key
+    if not cache_key:
+        etag = s3.head_object(Bucket=bucket, Key=object_key)["ETag"]
+        cache_key = parameter_cache.key_from_etag(etag, variables_filename)
+        resp = parameter_cache.get(cache_key)
+        if resp is not None:
+            print("parameter cache hit", cache_key, "cache counters:", parameter_cache.counters)
+            log.info("returning response", response=resp)
+            return resp
+
+    # Read only the variables file out of the artifact zip using ranged gets, nothing is written to local storage
+    print("loading variables file", variables_filename, "from bucket", bucket, "key", object_key)
     try:
-        with open(variables_file_path) as vars_file:
-            artifact_variables = json.load(vars_file).get("variable", {})
+        variables_json = s3_zip.read_member(s3, bucket, object_key, variables_filename)
+        artifact_variables = json.loads(variables_json).get("variable", {})
     except Exception as e:
         raise Exception(
-            f"Provisioning artifact (product version) parameters could not be loaded from file '{os.environ['VARIABLES_TF_JSON_FILENAME']}'"
+            f"Provisioning artifact (product version) parameters could not be loaded from file '{variables_filename}'"
         ) from e
 
-    print("deleting directory", local_artifact_path)
-    shutil.rmtree(local_artifact_path)
-
     resp = {"parameters": []}
     for var_name, var_block in artifact_variables.items():
         # return non-string default values as json string
@@ -76,20 +80,9 @@ def handler(event, context):
 
         resp["parameters"].append(p)
 
-    print("returning response", resp)
-    return resp
+    parameter_cache.put(cache_key, resp)
+    print("parameter cache miss", cache_key, "cache counters:", parameter_cache.counters)
 
+    log.info("returning response", response=resp)
+    return resp
 
-def assume_role(role_arn):
-    # create client in each account for assume role
-    creds = sts.assume_role(
-        RoleArn=role_arn,
-        RoleSessionName=os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "cross-acct"),
-    )["Credentials"]
-
-    # create a license manager boto3 session using credentials in other account
-    return boto3.Session(
-        aws_access_key_id=creds["AccessKeyId"],
-        aws_secret_access_key=creds["SecretAccessKey"],
-        aws_session_token=creds["SessionToken"],
-    )
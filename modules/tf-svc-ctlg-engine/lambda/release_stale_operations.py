@@ -0,0 +1,32 @@
+# Releases provisioned products whose running operation will never start the next queued operation, see
+# scheduler.sweep(). Invoked on a schedule by an EventBridge rule: without it, a product whose succeeded / failed lambda
+# failed, or whose execution was never started, stays blocked until another operation is submitted for it and
+# SCHEDULER_STALE_SECONDS have passed, and its queued operations are never started.
+
+import time
+
+import log
+import scheduler
+
+# Time kept after the sweep to return, products not swept in time are swept by the next run
+MARGIN_MILLIS = 10000
+
+# Event example from EventBridge scheduled rule
+# {
+#     "version": "0",
+#     "id": "53dc4d37-cffa-4f76-80c9-8b7d4a4d2eaa",
+#     "detail-type": "Scheduled Event",
+#     "source": "aws.events",
+#     "time": "2024-11-20T12:00:00Z",
+#     "resources": ["arn:aws:events:us-east-1:123456789012:rule/TerraformSvcCtlgEngineReleaseStaleOperations"],
+#     "detail": {}
+# }
+
+
+def handler(event, context):
+    log.start_invocation()
+    log.info("lambda invocation event", event=event)
+
+    deadline = time.monotonic() + (context.get_remaining_time_in_millis() - MARGIN_MILLIS) / 1000
+    released = scheduler.sweep(deadline)
+    print("released", released, "stale operations")
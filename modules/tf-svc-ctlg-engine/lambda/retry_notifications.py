@@ -0,0 +1,58 @@
+# Delivers Service Catalog notifications queued on the notify retry queue by notify.py, after the engine lambda that
+# produced them could not deliver them within its retries. Notifications that fail again are released back into the
+# queue and retried after its visibility timeout, then sent to the dead letter queue after "maxReceiveCount" attempts.
+# Dead-lettered notifications must be sent manually or the provisioned product stays stuck in a change status.
+#
+# Records are notified one after the other, each retried for up to NOTIFY_RETRY_SECONDS. Records left when the
+# invocation would time out before their retries end are released without being notified: a timed out invocation
+# releases the whole batch, and notifications already delivered would be delivered again.
+
+import json
+
+import log
+import notify
+
+# Time kept after the notify retries of a record to return the batch item failures
+MARGIN_MILLIS = 1000
+
+# Event example from SQS queue event source mapping, message body written by notify.result()
+# {
+#     "Records": [
+#         {
+#             "messageId": "0f4b2b2e-3a4f-4c1e-9f5e-1f0d6f1a2b3c",
+#             "body": "{\"operation\":\"TERMINATE_PROVISIONED_PRODUCT\",\"notifyArgs\":{\"WorkflowToken\":\"8b905837-1775-4ddb-9128-e25c6623bee6\",\"RecordId\":\"rec-kojanzxest74o\",\"Status\":\"SUCCEEDED\"},\"error\":\"ClientError('An error occurred (ThrottlingException) ...')\"}",
+#             "attributes": {
+#                 "ApproximateReceiveCount": "1",
+#                 ...
+#             },
+#             "eventSource": "aws:sqs",
+#             ...
+#         }
+#     ]
+# }
+
+
+def handler(event, context):
+    log.start_invocation()
+    log.info("lambda invocation event", event=event)
+
+    batch_item_failures = []
+    for record in event["Records"]:
+        if context.get_remaining_time_in_millis() < notify.RETRY_SECONDS * 1000 + MARGIN_MILLIS:
+            print(f"Not enough time left to deliver queued notification '{record['messageId']}', releasing it")
+            batch_item_failures.append({"itemIdentifier": record["messageId"]})
+            continue
+        try:
+            message = json.loads(record["body"])
+            log.info(
+                "notifying servicecatalog of queued product operation result",
+                operation=message["operation"],
+                notifyArgs=message["notifyArgs"],
+                receiveCount=record.get("attributes", {}).get("ApproximateReceiveCount"),
+            )
+            notify.result(message["operation"], message["notifyArgs"], fallback=False)
+        except Exception as e:
+            print(f"Error delivering queued notification '{record['messageId']}':", repr(e))
+            batch_item_failures.append({"itemIdentifier": record["messageId"]})
+
+    return {"batchItemFailures": batch_item_failures}
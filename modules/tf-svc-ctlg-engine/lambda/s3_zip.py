@@ -0,0 +1,106 @@
+# Read a single member out of a zip archive in S3 without downloading or extracting the whole archive. zipfile only
+# needs the end of central directory record, the central directory, and the local header + data of the member being
+# read, so a seekable file object backed by S3 ranged GET requests lets zipfile fetch just those byte ranges.
+
+import collections
+import io
+import zipfile
+
+# Ranged GETs are rounded up to at least this many bytes so zipfile's many small reads (end of central directory record,
+# local file headers, file names) are served from a few requests.
+MIN_RANGE_SIZE = 64 * 1024
+# Only the most recently fetched ranges are kept in memory
+MAX_CACHED_RANGES = 4
+
+
+def read_member(s3, bucket, key, member_name):
+    with zipfile.ZipFile(S3RangeReader(s3, bucket, key)) as zip_ref:
+        print("artifact contains", len(zip_ref.infolist()), "members, reading member", member_name)
+        return zip_ref.read(member_name)
+
+
+class S3RangeReader(io.RawIOBase):
+    def __init__(self, s3, bucket, key):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.pos = 0
+        # {start offset: bytes}
+        self.ranges = collections.OrderedDict()
+        self.get_count = 0
+        self.ranges_limit = MAX_CACHED_RANGES
+
+        # The archive tail holds the end of central directory record and (usually) the entire central directory. The
+        # response also reveals the object size. If the server ignores the Range header (some S3 compatible stores), the
+        # full object is returned instead and every later read is served from memory.
+        resp = self.s3.get_object(Bucket=self.bucket, Key=self.key, Range=f"bytes=-{MIN_RANGE_SIZE}")
+        self.get_count += 1
+        data = resp["Body"].read()
+        content_range = resp.get("ContentRange")
+        if content_range:
+            # "bytes 1000-1999/2000"
+            self.size = int(content_range.rsplit("/", 1)[1])
+            self.ranges[self.size - len(data)] = data
+        else:
+            print("ranged get not supported for", f"s3://{self.bucket}/{self.key}", "- read full object into memory")
+            self.size = len(data)
+            self.ranges[0] = data
+            # Keep the full object regardless of MAX_CACHED_RANGES
+            self.ranges_limit = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        elif whence == io.SEEK_END:
+            self.pos = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence '{whence}'")
+        if self.pos < 0:
+            raise ValueError(f"Negative seek position {self.pos}")
+        return self.pos
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.pos
+        end = min(self.pos + size, self.size)
+        if end <= self.pos:
+            return b""
+
+        data = self._cached(self.pos, end)
+        if data is None:
+            data = self._fetch(self.pos, end)
+        self.pos = end
+        return data
+
+    def _cached(self, start, end):
+        for range_start, range_data in self.ranges.items():
+            if range_start <= start and end <= range_start + len(range_data):
+                return range_data[start - range_start : end - range_start]
+        return None
+
+    def _fetch(self, start, end):
+        fetch_end = min(max(end, start + MIN_RANGE_SIZE), self.size)
+        resp = self.s3.get_object(Bucket=self.bucket, Key=self.key, Range=f"bytes={start}-{fetch_end - 1}")
+        self.get_count += 1
+        range_data = resp["Body"].read()
+
+        self.ranges[start] = range_data
+        while self.ranges_limit and len(self.ranges) > self.ranges_limit:
+            self.ranges.popitem(last=False)
+        return range_data[: end - start]
@@ -0,0 +1,315 @@
+# Per provisioned product scheduling of state machine executions. Provision, update and terminate operations arrive on
+# separate queues and are started independently, so operations for the same provisioned product could run concurrently
+# and contend for its terraform state, or be applied out of order. The scheduler keeps at most one running execution
+# per provisioned product:
+# - submit(): the operation runs now if the product has no running operation, otherwise it is queued behind it
+# - complete(): called when Service Catalog has been notified of the result of the running operation. Starts the next
+#   queued operation.
+#
+# Queued updates are coalesced. An update or terminate queued behind other queued updates supersedes them: only the
+# newest operation is applied, Service Catalog is notified that the superseded updates failed.
+#
+# State is one document per provisioned product {"running": entry, "queue": [entry]}, updated with conditional writes
+# (see json_store.py). A running operation older than STALE_SECONDS, for example an execution that failed without
+# notifying, no longer blocks the product.
+#
+# sweep() runs on a schedule (see release_stale_operations.py) and releases products whose running operation will never
+# call complete(), even if no other operation is submitted for the product.
+
+import datetime
+import os
+import time
+
+import clients
+import json_store
+import ledger
+import metrics
+import notify
+import op_context
+import op_trace
+
+RUNNING = "RUNNING"
+QUEUED = "QUEUED"
+
+# CodeBuild build timeout is 60 minutes and the build is retried once
+STALE_SECONDS = int(os.environ.get("SCHEDULER_STALE_SECONDS", str(3 * 60 * 60)))
+MAX_UPDATE_ATTEMPTS = 10
+SUPERSEDED_OPERATIONS = ["UPDATE_PROVISIONED_PRODUCT"]
+SUPERSEDING_OPERATIONS = ["UPDATE_PROVISIONED_PRODUCT", "TERMINATE_PROVISIONED_PRODUCT"]
+# Running operations without a state machine execution are left to the redelivered SQS message (visibility timeout 300s)
+# for START_GRACE_SECONDS before sweep() starts them
+START_GRACE_SECONDS = int(os.environ.get("SCHEDULER_START_GRACE_SECONDS", str(15 * 60)))
+
+# Replace with any object implementing get_versioned(key), put_if(key, doc, version), delete_if(key, version) and
+# list(), such as
+# json_store.MemoryJsonStore, to use a different store
+store = json_store.S3JsonStore(os.environ.get("TFSTATE_BUCKET_NAME"), os.environ.get("SCHEDULER_PREFIX", "scheduler/"))
+
+
+# Returns RUNNING if the operation should be started now, QUEUED if it waits for the running operation of the product.
+# Notifications of released and superseded operations are retried until `deadline` (see notify.result()).
+def submit(op_req, start_execution_args, deadline=None):
+    entry = {
+        "productOperationRequest": op_context.state_op_req(op_req),
+        "startExecution": start_execution_args,
+        "submitted": _now(),
+    }
+
+    def change(doc):
+        doc = doc or {"running": None, "queue": []}
+        running = doc["running"]
+        # Redelivered message
+        if running and _record_id(running) == op_req["recordId"]:
+            return None, {"status": RUNNING}
+        if any(_record_id(e) == op_req["recordId"] for e in doc["queue"]):
+            return None, {"status": QUEUED}
+
+        if running and _stale(running):
+            return None, {"stale": running}
+        if not running:
+            doc["running"] = dict(entry, started=_now())
+            return doc, {"status": RUNNING}
+
+        superseded = []
+        if op_req["operation"] in SUPERSEDING_OPERATIONS:
+            superseded = [e for e in doc["queue"] if _operation(e) in SUPERSEDED_OPERATIONS]
+            doc["queue"] = [e for e in doc["queue"] if _operation(e) not in SUPERSEDED_OPERATIONS]
+        doc["queue"].append(entry)
+        return doc, {"status": QUEUED, "queued": True, "superseded": superseded}
+
+    while True:
+        result = _update(op_req["provisionedProductId"], change)
+        if "stale" not in result:
+            break
+        stale = result["stale"]
+        print("operation", _record_id(stale), "running since", stale["started"], "is stale, releasing it")
+        complete(stale["productOperationRequest"], deadline)
+
+    if result.get("queued"):
+        metrics.emit({"QueuedOperations": (1, "Count")}, op_trace.dimensions(op_req))
+    for superseded_entry in result.get("superseded", []):
+        _notify_superseded(superseded_entry, op_req, deadline)
+    return result["status"]
+
+
+# Releases the provisioned product if `op_req` is its running operation and starts the next queued operation. Queued
+# operations that fail to start are notified FAILED, retried until `deadline` (see notify.result()).
+def complete(op_req, deadline=None):
+    while True:
+
+        def change(doc):
+            if not doc or not doc["running"] or _record_id(doc["running"]) != op_req["recordId"]:
+                return None, None
+            doc["running"] = doc["queue"].pop(0) if doc["queue"] else None
+            if doc["running"]:
+                doc["running"]["started"] = _now()
+            return doc, doc["running"]
+
+        next_entry = _update(op_req["provisionedProductId"], change)
+        if next_entry is None:
+            return
+
+        next_op_req = next_entry["productOperationRequest"]
+        print("starting queued operation", next_op_req["recordId"], "after", op_req["recordId"])
+        try:
+            started = start_execution(next_entry["startExecution"])
+        except Exception as e:
+            print("Could not start queued operation", next_op_req["recordId"], repr(e))
+            notify.result(
+                next_op_req["operation"],
+                {
+                    "WorkflowToken": next_op_req["token"],
+                    "RecordId": next_op_req["recordId"],
+                    "Status": "FAILED",
+                    "FailureReason": f"Error encountered starting queued Terraform provisioning: {repr(e)}",
+                },
+                deadline=deadline,
+            )
+            ledger.record(next_op_req, ledger.FAILED)
+            # Release the failed operation and start the one after it
+            op_req = next_op_req
+            continue
+
+        # The execution is running and will notify Service Catalog, later errors must not notify FAILED
+        if started:
+            try:
+                ledger.record(next_op_req, ledger.STARTED)
+            except Exception as e:
+                print("Could not record started operation in ledger", repr(e))
+        return
+
+
+# Returns False if the execution already exists, the operation was started before
+def start_execution(start_execution_args):
+    sfn = clients.client("stepfunctions")
+    try:
+        sfn.start_execution(**start_execution_args)
+    except sfn.exceptions.ExecutionAlreadyExists:
+        # The message was redelivered after the execution was started, the operation is already running or finished
+        print("state machine execution already exists:", start_execution_args["name"])
+        return False
+    return True
+
+
+# Releases the provisioned products whose running operation did not complete:
+# - the execution ended without calling complete(): the succeeded / failed lambda failed after notifying, or the
+#   execution failed, timed out or was aborted before notifying. Service Catalog is notified FAILED if the ledger has no
+#   result for the operation.
+# - the execution was never started: the start lambda failed after submit(), or complete() failed before starting the
+#   next queued operation. The execution is started, or the product released if the operation was notified without an
+#   execution (no-op update).
+# Idle product documents are deleted. Stops before `deadline` (time.monotonic()), the remaining products are swept by
+# the next run. Returns the number of released operations.
+def sweep(deadline=None):
+    released = 0
+    for key in store.list():
+        if deadline and time.monotonic() > deadline:
+            print("sweep deadline reached, remaining provisioned products are swept by the next run")
+            break
+        try:
+            released += _sweep_product(key, deadline)
+        except Exception as e:
+            print("Could not sweep scheduler document", key, repr(e))
+    return released
+
+
+def _sweep_product(key, deadline):
+    doc, version = store.get_versioned(key)
+    if not doc:
+        return 0
+    running = doc["running"]
+    if not running:
+        if not doc["queue"]:
+            try:
+                # A concurrent submit() creates the document again
+                store.delete_if(key, version)
+            except json_store.ConditionFailed:
+                pass
+        return 0
+
+    op_req = running["productOperationRequest"]
+    status = _execution_status(running["startExecution"])
+    if status == "RUNNING":
+        return 0
+    if status is None:
+        if ledger.state(op_req) not in ledger.COMPLETED:
+            if _age_seconds(running) < START_GRACE_SECONDS:
+                return 0
+            print("operation", op_req["recordId"], "has no state machine execution, starting it")
+            if start_execution(running["startExecution"]):
+                ledger.record(op_req, ledger.STARTED)
+            return 0
+        print("operation", op_req["recordId"], "was notified without an execution, releasing it")
+    else:
+        print("operation", op_req["recordId"], "execution", status, "without releasing the provisioned product")
+        if status != "SUCCEEDED" and ledger.state(op_req) not in ledger.COMPLETED:
+            _notify_ended(op_req, status, _execution_arn(running["startExecution"]), deadline)
+
+    complete(op_req, deadline)
+    metrics.emit({"ReleasedOperations": (1, "Count")}, op_trace.dimensions(op_req))
+    return 1
+
+
+# Returns the status of the state machine execution, None if it does not exist
+def _execution_status(start_execution_args):
+    sfn = clients.client("stepfunctions")
+    try:
+        resp = sfn.describe_execution(executionArn=_execution_arn(start_execution_args))
+    except sfn.exceptions.ExecutionDoesNotExist:
+        return None
+    return resp["status"]
+
+
+def _execution_arn(start_execution_args):
+    execution_prefix = start_execution_args["stateMachineArn"].replace(":stateMachine:", ":execution:", 1)
+    return f"{execution_prefix}:{start_execution_args['name']}"
+
+
+def _notify_ended(op_req, status, execution_arn, deadline):
+    try:
+        notify.result(
+            op_req["operation"],
+            {
+                "WorkflowToken": op_req["token"],
+                "RecordId": op_req["recordId"],
+                "Status": "FAILED",
+                "FailureReason": (
+                    f"Terraform provisioning Step Functions State Machine {status} before notifying the result:"
+                    f" {execution_arn}"
+                ),
+            },
+            deadline=deadline,
+        )
+    except Exception as e:
+        # Expired or already used workflow token, the product can be released
+        if notify.classify(e) != notify.PERMANENT:
+            raise
+        print("Could not notify servicecatalog of ended operation", op_req["recordId"], repr(e))
+    ledger.record(op_req, ledger.FAILED)
+
+
+# Reads the product document, applies change(doc) -> (new doc or None to leave it unchanged, result) and writes it back
+# if no other lambda changed it in the meantime. Returns the result.
+def _update(provisioned_product_id, change):
+    key = f"{provisioned_product_id}.json"
+    for _ in range(MAX_UPDATE_ATTEMPTS):
+        doc, version = store.get_versioned(key)
+        new_doc, result = change(doc)
+        if new_doc is None:
+            return result
+        try:
+            store.put_if(key, new_doc, version)
+            return result
+        except json_store.ConditionFailed as e:
+            print("scheduler document changed concurrently, retrying:", repr(e))
+    raise Exception(f"Could not update scheduler document '{key}' after {MAX_UPDATE_ATTEMPTS} attempts")
+
+
+def _notify_superseded(entry, op_req, deadline):
+    superseded_op_req = entry["productOperationRequest"]
+    print("operation", superseded_op_req["recordId"], "superseded by", op_req["recordId"])
+    # The submitted operation is already queued in place of the superseded one, errors must not fail it: the start
+    # lambda would notify it FAILED and it would still be started from the queue later
+    try:
+        notify.result(
+            superseded_op_req["operation"],
+            {
+                "WorkflowToken": superseded_op_req["token"],
+                "RecordId": superseded_op_req["recordId"],
+                "Status": "FAILED",
+                "FailureReason": (
+                    f"Superseded by newer operation {op_req['recordId']} ({op_req['operation']}) for the same"
+                    " provisioned product before it started. Only the newest queued operation is applied."
+                ),
+            },
+            deadline=deadline,
+        )
+    except Exception as e:
+        # Expired or already used workflow token, or the notify retry queue is unavailable
+        print("Could not notify servicecatalog of superseded operation", superseded_op_req["recordId"], repr(e))
+    try:
+        ledger.record(superseded_op_req, ledger.FAILED)
+    except Exception as e:
+        print("Could not record superseded operation in ledger", repr(e))
+    metrics.emit({"SupersededOperations": (1, "Count")}, op_trace.dimensions(superseded_op_req))
+
+
+def _record_id(entry):
+    return entry["productOperationRequest"]["recordId"]
+
+
+def _operation(entry):
+    return entry["productOperationRequest"]["operation"]
+
+
+def _stale(entry):
+    return _age_seconds(entry) > STALE_SECONDS
+
+
+def _age_seconds(entry):
+    started = datetime.datetime.fromisoformat(entry["started"])
+    return (datetime.datetime.now(datetime.timezone.utc) - started).total_seconds()
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
@@ -1,12 +1,28 @@
 # Handle external engine operations PROVISION_PRODUCT, UPDATE_PROVISIONED_PRODUCT, and TERMINATE_PROVISIONED_PRODUCT. These
 # events are read from sqs queue and start step function state machines for each of these events.
 
+import concurrent.futures
 import json
-import boto3
 import os
+import time
 
-sfn = boto3.client("stepfunctions")
-sc = boto3.client("servicecatalog")
+import admission
+import clients
+import fingerprint
+import ledger
+import log
+import metrics
+import notify
+import op_context
+import op_trace
+import scheduler
+import state_keys
+import tf_outputs
+
+# Maximum number of messages in a batch handled concurrently
+MAX_DISPATCH_WORKERS = int(os.environ.get("MAX_DISPATCH_WORKERS", "10"))
+# Notify SUCCEEDED without running terraform for updates with the same inputs as the last successful apply
+SKIP_NOOP_UPDATES = os.environ.get("SKIP_NOOP_UPDATES", "true").lower() == "true"
 
 # Event example from SQS queue event source mapping
 # {
@@ -84,48 +100,109 @@ sc = boto3.client("servicecatalog")
 
 
 def handler(event, context):
-    print("lambda invocation event payload:")
-    print(json.dumps(event, default=str))
+    log.start_invocation()
+    # Message bodies are logged once per record after parsing, see handle_record()
+    log.info(
+        "lambda invocation event",
+        records=[{k: v for k, v in record.items() if k != "body"} for record in event["Records"]],
+    )
 
-    # Lambda will be invoked with 1 or more messages from the SQS queues. If function fails, the message is released
-    # back into the queue for reprocessing. After "maxReceiveCount" attempts the message will be sent to dead letter
-    # queue.
-    for record in event["Records"]:
-        op_req = json.loads(record["body"])
-        print("sqs message operation request received:")
-        print(json.dumps(op_req, default=str))
+    # Lambda will be invoked with 1 or more messages from the SQS queues. Messages are processed concurrently. Messages
+    # that fail are reported in "batchItemFailures" and released back into the queue for reprocessing, the rest of the
+    # batch is deleted from the queue. After "maxReceiveCount" attempts the message will be sent to dead letter queue.
+    budget = admission.Budget()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_DISPATCH_WORKERS) as executor:
+        futures = {executor.submit(handle_record, record, context, budget): record for record in event["Records"]}
 
+    batch_item_failures = []
+    for future, record in futures.items():
         try:
-            handle_op_req(op_req)
+            future.result()
+        except admission.Deferred as e:
+            # Released back into the queue after the deferral instead of the visibility timeout
+            try:
+                delay = admission.defer(record)
+                print(f"sqs message '{record['messageId']}' deferred for {delay}s:", e)
+            except Exception as defer_error:
+                print(f"Could not defer sqs message '{record['messageId']}':", repr(defer_error))
+            batch_item_failures.append({"itemIdentifier": record["messageId"]})
         except Exception as e:
-            notify_args = {
-                "WorkflowToken": op_req["token"],
-                "RecordId": op_req["recordId"],
-                "Status": "FAILED",
-                "FailureReason": (
-                    f"Error encountered in Lambda function {context.invoked_function_arn} starting"
-                    f" Terraform provisioning: {repr(e)}"
-                ),
-            }
-            operation = op_req["operation"]
+            print(f"Error processing sqs message '{record['messageId']}':", repr(e))
+            batch_item_failures.append({"itemIdentifier": record["messageId"]})
+
+    try:
+        admission.emit_gauges(event["Records"], budget)
+    except Exception as e:
+        print("Could not emit queue depth and in-flight gauges:", repr(e))
+
+    return {"batchItemFailures": batch_item_failures}
 
-            print(f"Notifying servicecatalog of product operation result for operation '{operation}' with args:")
-            print(json.dumps(notify_args, default=str))
 
-            if operation == "PROVISION_PRODUCT":
-                sc.notify_provision_product_engine_workflow_result(**notify_args)
-            elif operation == "UPDATE_PROVISIONED_PRODUCT":
-                sc.notify_update_provisioned_product_engine_workflow_result(**notify_args)
-            elif operation == "TERMINATE_PROVISIONED_PRODUCT":
-                sc.notify_terminate_provisioned_product_engine_workflow_result(**notify_args)
+def handle_record(record, context, budget=None):
+    op_req = json.loads(record["body"])
+    trace = op_trace.from_sqs_record(record)
+    log.info("sqs message operation request received", messageId=record["messageId"], operationRequest=op_req)
+    deadline = notify.invocation_deadline(context)
 
-            raise e
+    # Service Catalog has already been notified of the result of this operation, the message is a redelivery. Without
+    # the ledger, redelivered messages find their state machine execution already exists.
+    try:
+        op_state = ledger.state(op_req)
+    except Exception as e:
+        print("Could not load operation state from ledger", repr(e))
+        op_state = None
+    if op_state in ledger.COMPLETED:
+        print(f"product operation '{op_req['recordId']}' already {op_state}, skipping redelivered message")
+        # A previous delivery may have failed before starting the next queued operation
+        scheduler.complete(op_req, deadline)
+        return
 
+    # handle_op_req() only raises before the state machine execution is started, the execution notifies the result of
+    # started operations
+    try:
+        handle_op_req(op_req, op_state, trace, budget, deadline)
+    except admission.Deferred:
+        raise
+    except Exception as e:
+        notify_args = {
+            "WorkflowToken": op_req["token"],
+            "RecordId": op_req["recordId"],
+            "Status": "FAILED",
+            "FailureReason": (
+                f"Error encountered in Lambda function {context.invoked_function_arn} starting"
+                f" Terraform provisioning: {repr(e)}"
+            ),
+        }
+        operation = op_req["operation"]
+
+        log.info("notifying servicecatalog of product operation result", operation=operation, notifyArgs=notify_args)
+
+        notify_started = time.perf_counter()
+        notify.result(operation, notify_args, deadline=deadline)
+        op_trace.emit_notified(notify_started, trace, op_req)
+
+        try:
+            ledger.record(op_req, ledger.FAILED)
+        except Exception as ledger_error:
+            print("Could not record operation result in ledger", repr(ledger_error))
+            # A redelivered message would not be skipped and would start the operation notified FAILED, delete it
+            scheduler.complete(op_req, deadline)
+            return
+        # Release the provisioned product if this operation was scheduled to run
+        scheduler.complete(op_req, deadline)
+        raise e
 
-def handle_op_req(op_req):
+
+def handle_op_req(op_req, op_state=None, trace=None, budget=None, deadline=None):
+    trace = trace or {}
+    budget = budget or admission.Budget(0)
     # Build codebuild env vars for terraform execution (state machine will pass this to codebuild). This is much easier
     # to build in this lambda function before running state machine rather than in state machine language.
-    s3_prefix = f"{op_req['identity']['awsAccountId']}/{op_req['provisionedProductId']}"
+    s3_prefix = state_keys.resolve(
+        os.environ["TFSTATE_BUCKET_NAME"],
+        op_req["identity"]["awsAccountId"],
+        op_req["provisionedProductId"],
+    )
     codebuild_env_vars = [
         {
             "Name": "LAUNCH_ROLE_ARN",
@@ -194,22 +271,55 @@ def handle_op_req(op_req):
             }
         )
 
-    # Build step function input json
-    sfn_input_json = json.dumps(
-        {
-            **{
-                "productOperationRequest": op_req,
+    # Fingerprint of the terraform inputs, saved by succeeded_product_operation after a successful apply
+    fingerprint_s3_uri = f"s3://{os.environ['TFSTATE_BUCKET_NAME']}/{s3_prefix}.fingerprint.json"
+    op_fingerprint = fingerprint.compute(codebuild_env_vars, op_req.get("artifact", {}).get("path"))
+
+    # An update with exactly the inputs of the last successful apply would not change anything, skip terraform. If the
+    # last fingerprint cannot be loaded, the update runs terraform.
+    noop_update = False
+    if op_req["operation"] == "UPDATE_PROVISIONED_PRODUCT" and SKIP_NOOP_UPDATES and op_fingerprint:
+        try:
+            noop_update = fingerprint.load(fingerprint_s3_uri) == op_fingerprint
+        except Exception as e:
+            print("Could not load fingerprint of the last successful apply", repr(e))
+
+    # Write the operation context once to s3, state machine input only references it. CodeBuild loads the environment
+    # variables from the context.
+    context_s3_uri = f"s3://{os.environ['TFSTATE_BUCKET_NAME']}/{s3_prefix}-{op_req['recordId']}.context.json"
+    op_context.put(context_s3_uri, op_req, codebuild_env_vars)
+
+    # Build step function input
+    sfn_input = {
+        **{
+            "productOperationRequest": op_context.state_op_req(op_req),
+        },
+        **{
+            "context": {
+                "s3Uri": context_s3_uri,
             },
-            **{
-                "codebuild": {
-                    "environmentVariablesOverride": codebuild_env_vars,
-                },
+        },
+        **{
+            "codebuild": {
+                "environmentVariablesOverride": [
+                    {
+                        "Name": "CONTEXT_S3_URI",
+                        "Value": context_s3_uri,
+                    },
+                ],
             },
         },
-        default=str,
-    )
-    print("state machine input json:")
-    print(sfn_input_json)
+        **{
+            "fingerprint": {
+                "s3Uri": fingerprint_s3_uri,
+                "value": op_fingerprint,
+            },
+        },
+        **{
+            "trace": trace,
+        },
+    }
+    log.debug("state machine input", input=sfn_input)
 
     if op_req["operation"] == "PROVISION_PRODUCT":
         operation_short_name = "provision"
@@ -226,8 +336,85 @@ def handle_op_req(op_req):
         # setting name makes execution easier to find in sfn execution history
         "name": f"{operation_short_name}-{op_req['provisionedProductId']}-{op_req['recordId']}",
         # merge product operation with generated
-        "input": sfn_input_json,
+        "input": json.dumps(sfn_input, default=str),
+    }
+
+    # Defer the operation if the execution budget is used up. No-op updates usually don't start an execution.
+    if not noop_update:
+        budget.acquire()
+
+    # Run one operation at a time per provisioned product, later operations are started by the succeeded / failed
+    # lambdas when the running operation completes
+    if scheduler.submit(op_req, start_sfn_args, deadline) == scheduler.QUEUED:
+        print("operation", op_req["recordId"], "queued behind the running operation of", op_req["provisionedProductId"])
+        if not noop_update:
+            budget.release()
+        return
+
+    if noop_update:
+        tf_outputs_s3_uri = {v["Name"]: v["Value"] for v in codebuild_env_vars}["OUTPUTS_S3_URI"]
+        if notify_noop_update(op_req, tf_outputs_s3_uri, trace, deadline):
+            # Service Catalog has been notified, later errors must not notify again
+            try:
+                op_context.delete(context_s3_uri)
+            except Exception as e:
+                print("Could not delete product operation context", repr(e))
+            try:
+                scheduler.complete(op_req, deadline)
+            except Exception as e:
+                print("Could not start the next operation queued for the provisioned product", repr(e))
+            return
+
+    log.info(
+        "starting state machine execution",
+        stateMachineArn=start_sfn_args["stateMachineArn"],
+        name=start_sfn_args["name"],
+    )
+    if not scheduler.start_execution(start_sfn_args):
+        if not noop_update:
+            budget.release()
+        return
+
+    # The execution is running and will notify Service Catalog, later errors must not notify FAILED
+    try:
+        op_trace.emit_dispatched(trace, op_req)
+        if op_state is None:
+            ledger.record(op_req, ledger.STARTED)
+    except Exception as e:
+        print("Could not record started operation in ledger", repr(e))
+
+
+# Notify SUCCEEDED with the outputs of the last successful apply. Returns False if the outputs could not be loaded, the
+# update should then run terraform.
+def notify_noop_update(op_req, tf_outputs_s3_uri, trace, deadline=None):
+    print("update inputs match the last successful apply, skipping terraform. loading outputs:", tf_outputs_s3_uri)
+    try:
+        parts = tf_outputs_s3_uri.removeprefix("s3://").split("/")
+        bucket = parts.pop(0)
+        tf_outputs_stream = clients.client("s3").get_object(Bucket=bucket, Key="/".join(parts))["Body"]
+        sc_outputs = tf_outputs.to_sc_outputs(tf_outputs_stream)
+    except Exception as e:
+        print("Could not load terraform outputs of the last successful apply", repr(e))
+        return False
+
+    notify_args = {
+        "WorkflowToken": op_req["token"],
+        "RecordId": op_req["recordId"],
+        "Status": "SUCCEEDED",
+        "Outputs": sc_outputs,
     }
-    print("starting state machine execution with arguments:")
-    print(json.dumps(start_sfn_args, default=str))
-    sfn.start_execution(**start_sfn_args)
+    log.info(
+        "notifying servicecatalog of product operation result",
+        operation="UPDATE_PROVISIONED_PRODUCT",
+        notifyArgs=notify_args,
+    )
+    notify_started = time.perf_counter()
+    notify.result("UPDATE_PROVISIONED_PRODUCT", notify_args, deadline=deadline)
+    op_trace.emit_notified(notify_started, trace, op_req)
+
+    try:
+        ledger.record(op_req, ledger.SUCCEEDED)
+        metrics.emit({"SkippedBuilds": (1, "Count")}, {"Operation": op_req["operation"]})
+    except Exception as e:
+        print("Could not record operation result in ledger", repr(e))
+    return True
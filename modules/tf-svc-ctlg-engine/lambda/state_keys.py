@@ -0,0 +1,62 @@
+# Key layout of the per provisioned product objects in the tfstate bucket: terraform state, outputs, fingerprint and
+# the per operation context and stderr objects. Keys start with a prefix built by prefix():
+# - flat: "<account id>/<provisioned product id>". All products of an account share the account prefix, bursts of a
+#   few very active accounts concentrate on one S3 prefix and are throttled by per-prefix request limits.
+# - sharded: "<shard>/<account id>/<provisioned product id>". The shard is a short hash of the account and product ids
+#   in a fixed number of PARTITIONS, spreading requests over PARTITIONS prefixes.
+#
+# With the sharded layout, products not migrated yet (see tools/migrate_state_keys.py) keep their flat keys: a product
+# whose flat terraform state exists uses the flat prefix, so switching the layout does not orphan existing state.
+
+import hashlib
+import os
+
+import botocore.exceptions
+
+import clients
+
+FLAT = "flat"
+SHARDED = "sharded"
+
+LAYOUT = os.environ.get("STATE_KEY_LAYOUT", FLAT)
+# Changing the partition count moves every product to another shard, migrate the state first
+PARTITIONS = int(os.environ.get("STATE_KEY_PARTITIONS", "256"))
+
+STATE_SUFFIX = ".tfstate"
+
+
+def flat_prefix(account_id, provisioned_product_id):
+    return f"{account_id}/{provisioned_product_id}"
+
+
+def sharded_prefix(account_id, provisioned_product_id, partitions=None):
+    partitions = partitions or PARTITIONS
+    digest = hashlib.sha256(flat_prefix(account_id, provisioned_product_id).encode("utf-8")).hexdigest()
+    # Fixed width, every shard of the partition count has the same length
+    width = len(f"{partitions - 1:x}")
+    return f"{int(digest[:8], 16) % partitions:0{width}x}/{flat_prefix(account_id, provisioned_product_id)}"
+
+
+def prefix(account_id, provisioned_product_id, layout=None, partitions=None):
+    layout = layout or LAYOUT
+    if layout == FLAT:
+        return flat_prefix(account_id, provisioned_product_id)
+    if layout == SHARDED:
+        return sharded_prefix(account_id, provisioned_product_id, partitions)
+    raise Exception(f"Unknown state key layout '{layout}'")
+
+
+# Prefix of the objects of a provisioned product in `bucket` for the configured layout, the flat prefix for products
+# whose terraform state was not migrated to the sharded layout yet
+def resolve(bucket, account_id, provisioned_product_id):
+    if LAYOUT == FLAT:
+        return flat_prefix(account_id, provisioned_product_id)
+    legacy = flat_prefix(account_id, provisioned_product_id)
+    try:
+        clients.client("s3").head_object(Bucket=bucket, Key=legacy + STATE_SUFFIX)
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in ["NoSuchKey", "404"]:
+            return prefix(account_id, provisioned_product_id)
+        raise
+    print("terraform state of", provisioned_product_id, "not migrated to the", LAYOUT, "layout, using", legacy)
+    return legacy
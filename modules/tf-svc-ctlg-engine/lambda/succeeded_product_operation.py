@@ -1,14 +1,38 @@
-import json
-import boto3
 
-sc = boto3.client("servicecatalog")
-s3 = boto3.resource("s3")
+import time
+
+import clients
+import fingerprint
+import ledger
+import log
+import notify
+import op_context
+import op_trace
+import scheduler
+import tf_outputs
 
 
 def handler(event, context):
-    print(json.dumps(event, default=str))
+    log.start_invocation()
+    log.info("lambda invocation event", event=event)
+    deadline = notify.invocation_deadline(context)
     op_req = event["productOperationRequest"]
     operation = op_req["operation"]
+    trace = event.get("trace", {})
+
+    # Skip retried invocations, Service Catalog has already been notified of the result of this operation
+    try:
+        op_state = ledger.state(op_req)
+    except Exception as e:
+        print("Could not load operation state from ledger", repr(e))
+    else:
+        if op_state in ledger.COMPLETED:
+            print(f"product operation '{op_req['recordId']}' already {op_state}, skipping notification")
+            # A previous invocation may have failed before starting the next queued operation
+            scheduler.complete(op_req, deadline)
+            return
+
+    op_trace.emit_build(event.get("codebuild", {}).get("build", {}).get("Phases", []), op_req)
 
     notify_args = {
         "WorkflowToken": op_req["token"],
@@ -18,30 +42,13 @@ def handler(event, context):
 
     # For provision + update operations, download tfoutputs.json from S3 and build Outputs into notify args
     if operation in ["PROVISION_PRODUCT", "UPDATE_PROVISIONED_PRODUCT"]:
-        cb_env_vars = event["codebuild"]["environmentVariablesOverride"]
-        tf_outputs_s3_uri = {v["Name"]: v["Value"] for v in cb_env_vars}["OUTPUTS_S3_URI"]
+        tf_outputs_s3_uri = op_context.env_vars(event)["OUTPUTS_S3_URI"]
 
+        # Outputs are converted while streaming the object, the full outputs json is never held in memory
         print("loading terraform outputs json from s3 uri:", tf_outputs_s3_uri)
-        tf_outputs_json = s3_get_object(tf_outputs_s3_uri)
-
-        print("terraform outputs json:")
-        print(tf_outputs_json)
-        tf_outputs = json.loads(tf_outputs_json)
-        sc_outputs = []
-        for tf_output_key, tf_output in tf_outputs.items():
-            value = tf_output["value"]
-            # return non-string values as json string
-            if value.__class__ != str:
-                value = json.dumps(value, default=str)
-            sc_outputs.append(
-                {
-                    "OutputKey": tf_output_key,
-                    "OutputValue": value,
-                    "Description": tf_output.get("description", "No description provided"),
-                }
-            )
-
-        notify_args["Outputs"] = sc_outputs
+        s3_read_started = time.perf_counter()
+        notify_args["Outputs"] = tf_outputs.to_sc_outputs(s3_get_object_stream(tf_outputs_s3_uri))
+        op_trace.emit_s3_read(s3_read_started, op_req)
 
     # PROVISION_PRODUCT operation requires at least one ResourceIdentifier:
     #   InvalidParametersException: A ResourceIdentifier is required for a workflow Status of 'SUCCEEDED'.
@@ -52,21 +59,39 @@ def handler(event, context):
             "UniqueTag": {"Key": "Arn", "Value": "arn:placeholder:not:a:real:arn"},
         }
 
-    print(f"Notifying servicecatalog of product operation result for operation '{operation}' with args:")
-    print(json.dumps(notify_args, default=str))
+    log.info("notifying servicecatalog of product operation result", operation=operation, notifyArgs=notify_args)
 
-    if operation == "PROVISION_PRODUCT":
-        sc.notify_provision_product_engine_workflow_result(**notify_args)
-    elif operation == "UPDATE_PROVISIONED_PRODUCT":
-        sc.notify_update_provisioned_product_engine_workflow_result(**notify_args)
-    elif operation == "TERMINATE_PROVISIONED_PRODUCT":
-        sc.notify_terminate_provisioned_product_engine_workflow_result(**notify_args)
-    else:
-        raise Exception(f"Unknown product operation '{operation}'")
+    notify_started = time.perf_counter()
+    notify.result(operation, notify_args, deadline=deadline)
+    op_trace.emit_notified(notify_started, trace, op_req)
+
+    # Save the fingerprint of the applied inputs, later updates with the same inputs skip terraform. Terminated products
+    # have nothing to compare against.
+    try:
+        if operation == "TERMINATE_PROVISIONED_PRODUCT":
+            fingerprint.delete(event["fingerprint"]["s3Uri"])
+        elif event.get("fingerprint", {}).get("value"):
+            fingerprint.save(event["fingerprint"]["s3Uri"], event["fingerprint"]["value"], op_req)
+    except Exception as e:
+        print("Could not update fingerprint of applied inputs", repr(e))
+
+    try:
+        ledger.record(op_req, ledger.SUCCEEDED)
+    except Exception as e:
+        print("Could not record operation result in ledger", repr(e))
+
+    try:
+        if "context" in event:
+            op_context.delete(event["context"]["s3Uri"])
+    except Exception as e:
+        print("Could not delete product operation context", repr(e))
+
+    # Start the next operation queued for the provisioned product
+    scheduler.complete(op_req, deadline)
 
 
-def s3_get_object(s3_uri):
+def s3_get_object_stream(s3_uri):
     parts = s3_uri.removeprefix("s3://").split("/")
     bucket = parts.pop(0)
     key = "/".join(parts)
-    return s3.Object(bucket, key).get()["Body"].read().decode("utf-8")
+    return clients.client("s3").get_object(Bucket=bucket, Key=key)["Body"]
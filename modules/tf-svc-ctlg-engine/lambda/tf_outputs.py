@@ -0,0 +1,302 @@
+# Convert `terraform output -json` into Service Catalog Outputs. The outputs json is read from a stream one output at a
+# time, so modules with large outputs (subnet tables, rendered policies) do not have to be held in memory:
+# - each output value is kept to at most MAX_VALUE_CHARS, longer values are truncated with TRUNCATED_MARKER
+# - all output values together are kept to at most MAX_TOTAL_CHARS. Outputs that do not fit, not even truncated, are
+#   omitted and reported once in an OMITTED_OUTPUTS_KEY output.
+# - sensitive output values are skipped without being read into memory and replaced with REDACTED_VALUE
+#
+# `terraform output -json` example:
+# {
+#   "bucket_name": {
+#     "sensitive": false,
+#     "type": "string",
+#     "value": "svc-ctlg-bucket-20241126145208"
+#   }
+# }
+
+import codecs
+import itertools
+import json
+import os
+import re
+
+MAX_VALUE_CHARS = int(os.environ.get("TF_OUTPUT_MAX_VALUE_CHARS", "4096"))
+MAX_TOTAL_CHARS = int(os.environ.get("TF_OUTPUTS_MAX_TOTAL_CHARS", "65536"))
+TRUNCATED_MARKER = "... [truncated, {} characters total]"
+OMITTED_OUTPUTS_KEY = "_omitted_outputs"
+OMITTED_MARKER = "{} outputs omitted, output values are limited to {} characters in total"
+REDACTED_VALUE = "(sensitive value)"
+
+# Output names and other object keys are never expected to be this large
+MAX_KEY_CHARS = 1024
+# Raw json characters per value character at most, the longest escape sequences are \uXXXX
+MAX_ESCAPED_CHARS = 6
+READ_SIZE = 64 * 1024
+
+# Possessive quantifiers: the patterns are unambiguous, and without backtracking the regex engine does not keep state
+# for every escape sequence of the buffer
+#
+# Characters and complete escape sequences of a string, up to its closing quote
+_STRING_RUN = re.compile(r'[^"\\]*+(?:\\.[^"\\]*+)*+')
+_STRING = re.compile(r'"[^"\\]*+(?:\\.[^"\\]*+)*+"')
+# Characters outside of strings and complete strings
+_CONTAINER_RUN = re.compile(r'[^"]*+(?:"[^"\\]*+(?:\\.[^"\\]*+)*+"[^"]*+)*+')
+_CONTAINER_TOKEN = re.compile(r'"[^"\\]*+(?:\\.[^"\\]*+)*+"|[{}\[\]]')
+_NON_BRACKETS = re.compile(r"[^{}\[\]]+")
+_BRACKET_DEPTH = {"{": 1, "[": 1, "}": -1, "]": -1}
+_SCALAR_END = re.compile(r"[,}\]\s]")
+_WHITESPACE = re.compile(r"\s*")
+
+
+# stream: binary file object with read(size), such as an S3 get_object response body
+def to_sc_outputs(stream, max_value_chars=MAX_VALUE_CHARS, max_total_chars=MAX_TOTAL_CHARS):
+    scanner = _Scanner(stream)
+    sc_outputs = []
+    total_chars = 0
+    omitted = 0
+
+    scanner.expect("{")
+    while scanner.peek() != "}":
+        if sc_outputs or omitted:
+            scanner.expect(",")
+        tf_output_key = scanner.read_key()
+        scanner.expect(":")
+        # Once the total is used up, values are skipped without keeping any of them
+        total_chars_left = max_total_chars - total_chars
+        tf_output = _read_output(scanner, max_value_chars if total_chars_left > 0 else 0)
+        print("terraform output", tf_output_key, "value characters:", tf_output["value_chars"])
+
+        value = tf_output["value"]
+        if len(value) > total_chars_left:
+            value = _truncate(value, total_chars_left, tf_output["value_chars"])
+            # Not even the truncated marker fits
+            if len(value) > total_chars_left:
+                omitted += 1
+                continue
+        total_chars += len(value)
+
+        sc_outputs.append(
+            {
+                "OutputKey": tf_output_key,
+                "OutputValue": value,
+                "Description": tf_output["description"],
+            }
+        )
+    scanner.expect("}")
+
+    if omitted:
+        print(omitted, "terraform outputs omitted, output values are limited to", max_total_chars, "characters")
+        sc_outputs.append(
+            {
+                "OutputKey": OMITTED_OUTPUTS_KEY,
+                "OutputValue": OMITTED_MARKER.format(omitted, max_total_chars),
+                "Description": "Terraform outputs over the output size limit of the engine",
+            }
+        )
+    return sc_outputs
+
+
+def _read_output(scanner, max_value_chars):
+    tf_output = {
+        "sensitive": False,
+        "value": "",
+        "value_chars": 0,
+        "description": "No description provided",
+    }
+
+    scanner.expect("{")
+    first = True
+    while scanner.peek() != "}":
+        if not first:
+            scanner.expect(",")
+        first = False
+        field = scanner.read_key()
+        scanner.expect(":")
+
+        if field == "sensitive":
+            tf_output["sensitive"] = json.loads(scanner.read_key_value())
+        elif field == "description":
+            tf_output["description"] = json.loads(scanner.read_key_value())
+        elif field == "value" and not tf_output["sensitive"]:
+            # Quotes and escapes make the raw json longer than the value, read enough raw json for any string of
+            # max_value_chars
+            raw, raw_chars = scanner.read_value(max_value_chars * MAX_ESCAPED_CHARS + 2)
+            if len(raw) == raw_chars:
+                value = json.loads(raw)
+                # return non-string values as json string
+                if value.__class__ != str:
+                    value = json.dumps(value, default=str)
+                tf_output["value"] = _truncate(value, max_value_chars, len(value))
+                tf_output["value_chars"] = len(value)
+            elif raw.startswith('"'):
+                # Too large to load, decode the beginning of the string
+                tf_output["value"] = _truncate(_decode_string_prefix(raw), max_value_chars, scanner.string_chars)
+                tf_output["value_chars"] = scanner.string_chars
+            else:
+                # Too large to load, keep the beginning of the raw json of the list, map or object
+                tf_output["value"] = _truncate(raw, max_value_chars, raw_chars)
+                tf_output["value_chars"] = raw_chars
+        else:
+            # "type" and sensitive values are not needed
+            scanner.read_value(0)
+    scanner.expect("}")
+
+    if tf_output["sensitive"]:
+        tf_output["value"] = REDACTED_VALUE
+    return tf_output
+
+
+def _truncate(value, max_chars, value_chars):
+    if len(value) <= max_chars and len(value) == value_chars:
+        return value
+    marker = TRUNCATED_MARKER.format(value_chars)
+    return value[: max(0, max_chars - len(marker))] + marker
+
+
+# Decodes the beginning of a raw json string, which may end in the middle of an escape sequence or surrogate pair
+def _decode_string_prefix(raw):
+    for end in range(len(raw), max(0, len(raw) - MAX_ESCAPED_CHARS), -1):
+        try:
+            value = json.loads(raw[:end] + '"')
+        except ValueError:
+            continue
+        if value and "\ud800" <= value[-1] <= "\udbff":
+            value = value[:-1]
+        return value
+    return ""
+
+
+# Minimal incremental json scanner. Values are read as raw json text, keeping at most `limit` characters while the rest
+# of the value is skipped. After reading a string, `string_chars` is the number of characters of the decoded string.
+class _Scanner:
+    def __init__(self, stream):
+        self.stream = stream
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buf = ""
+        self.pos = 0
+
+    def peek(self):
+        self._skip_whitespace()
+        self._ensure(1)
+        return self.buf[self.pos]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Invalid terraform outputs json: expected '{char}', found '{self.buf[self.pos]}'")
+        self.pos += 1
+
+    def read_key(self):
+        return json.loads(self.read_key_value())
+
+    def read_key_value(self):
+        raw, raw_chars = self.read_value(MAX_KEY_CHARS)
+        if len(raw) != raw_chars:
+            raise ValueError(f"Invalid terraform outputs json: value longer than {MAX_KEY_CHARS} characters")
+        return raw
+
+    # Returns (first `limit` characters of the raw json value, total characters of the raw json value)
+    def read_value(self, limit):
+        self._skip_whitespace()
+        self.captured = []
+        self.captured_chars = 0
+        self.raw_chars = 0
+        self.escaped_chars = 0
+        self.limit = limit
+
+        char = self.peek()
+        if char == '"':
+            self._consume(1)
+            self._scan_string()
+            self.string_chars = self.raw_chars - 2 - self.escaped_chars
+        elif char in "{[":
+            self._scan_container()
+        else:
+            self._scan_scalar()
+        return "".join(self.captured), self.raw_chars
+
+    def _scan_string(self):
+        # Opening quote already consumed
+        while True:
+            run_end = _STRING_RUN.match(self.buf, self.pos).end()
+            self.escaped_chars += self._escaped_chars(run_end)
+            self._consume(run_end - self.pos)
+            if self.pos < len(self.buf) and self.buf[self.pos] == '"':
+                self._consume(1)
+                return
+            # The string or an escape sequence continues past the end of the buffer
+            self._ensure(len(self.buf) - self.pos + 1)
+
+    # Characters saved by decoding the escape sequences of a string run. Escape sequences decode to one character. A run
+    # of n backslashes has n // 2 escaped backslashes, and an escape sequence after them if n is odd.
+    def _escaped_chars(self, run_end):
+        escapes = self.buf.count("\\", self.pos, run_end) - self.buf.count("\\\\", self.pos, run_end)
+        # \uXXXX escape sequences end the backslash runs of odd length before a u. Counting "\u", subtracting "\\u",
+        # adding "\\\u" and so on counts a run of length n 1 - 1 + 1 ... (n terms) times: once if n is odd, else 0.
+        unicode_escapes = 0
+        for n in itertools.count(1):
+            runs = self.buf.count("\\" * n + "u", self.pos, run_end)
+            if not runs:
+                break
+            unicode_escapes += runs if n % 2 else -runs
+        return escapes + 4 * unicode_escapes
+
+    def _scan_container(self):
+        depth = 0
+        while True:
+            # Skip runs of complete strings and other characters at once, only counting brackets outside of strings.
+            # Brackets are walked one at a time only in the run where the container closes.
+            run_end = _CONTAINER_RUN.match(self.buf, self.pos).end()
+            brackets = _NON_BRACKETS.sub("", _STRING.sub("", self.buf[self.pos : run_end]))
+            depths = list(itertools.accumulate((_BRACKET_DEPTH[b] for b in brackets), initial=depth))
+            if min(depths[1:], default=depth) > 0:
+                depth = depths[-1]
+                self._consume(run_end - self.pos)
+            else:
+                for match in _CONTAINER_TOKEN.finditer(self.buf, self.pos, run_end):
+                    depth += _BRACKET_DEPTH.get(match.group(), 0)
+                    if depth == 0:
+                        self._consume(match.end() - self.pos)
+                        return
+
+            # Run ended at the start of a string that continues past the end of the buffer, or at the end of the buffer
+            if self.pos < len(self.buf):
+                self._consume(1)
+                self._scan_string()
+            else:
+                self._ensure(1)
+
+    def _scan_scalar(self):
+        while True:
+            match = _SCALAR_END.search(self.buf, self.pos)
+            if match:
+                self._consume(match.start() - self.pos)
+                return
+            self._consume(len(self.buf) - self.pos)
+            if not self._fill():
+                return
+
+    def _consume(self, chars):
+        if self.captured_chars < self.limit:
+            segment = self.buf[self.pos : self.pos + min(chars, self.limit - self.captured_chars)]
+            self.captured.append(segment)
+            self.captured_chars += len(segment)
+        self.raw_chars += chars
+        self.pos += chars
+
+    def _skip_whitespace(self):
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or not self._fill():
+                return
+
+    def _ensure(self, chars):
+        while len(self.buf) - self.pos < chars:
+            if not self._fill():
+                raise ValueError("Invalid terraform outputs json: unexpected end of json")
+
+    def _fill(self):
+        data = self.stream.read(READ_SIZE)
+        # Drop consumed characters, only the unread part of the buffer is kept in memory
+        self.buf = self.buf[self.pos :] + self.decoder.decode(data, final=not data)
+        self.pos = 0
+        return bool(data)
@@ -15,6 +15,67 @@ variable "svc_ctlg_launch_role_path" {
 variable "svc_ctlg_launch_role_name" {
   type = string
 }
+variable "parameter_cache_expiration_days" {
+  description = "Days to keep cached parameter parser responses in the tfstate bucket"
+  type        = number
+  default     = 30
+}
+variable "terraform_version" {
+  description = "Terraform CLI version run by the CodeBuild project"
+  type        = string
+  default     = "1.9.8"
+}
+variable "provider_cache_expiration_days" {
+  description = "Days to keep cached terraform binaries and provider mirrors in the tfstate bucket. Artifacts without a .terraform.lock.hcl get the provider versions cached by the first build with the same version constraints until the cache entry expires."
+  type        = number
+  default     = 7
+}
+variable "skip_noop_updates" {
+  description = "Notify success without running terraform for product updates with the same artifact, parameters, tags and launch role as the last successful apply. Disable to always run terraform, for example to correct drift."
+  type        = bool
+  default     = true
+}
+
+variable "max_in_flight_operations" {
+  description = "Maximum number of product operations (state machine executions) running at once. Operations over the budget are deferred in their SQS queue with backoff. Keep it below the CodeBuild concurrent build quota. 0 disables admission control."
+  type        = number
+  default     = 0
+}
+
+variable "state_key_layout" {
+  description = "Key layout of provisioned product objects (terraform state, outputs) in the tfstate bucket. \"flat\" keys start with the account id, \"sharded\" keys start with a short hash spreading requests over state_key_partitions S3 prefixes. Products keep their flat keys until migrated with tools/migrate_state_keys.py."
+  type        = string
+  default     = "flat"
+
+  validation {
+    condition     = contains(["flat", "sharded"], var.state_key_layout)
+    error_message = "state_key_layout must be \"flat\" or \"sharded\"."
+  }
+}
+
+variable "state_key_partitions" {
+  description = "Number of hash partitions of the sharded state key layout. Changing it moves every product to another partition, migrate the state first."
+  type        = number
+  default     = 256
+}
+
+variable "notify_rate_per_second" {
+  description = "Maximum rate of Service Catalog Notify*ProductEngineWorkflowResult calls per engine lambda execution environment. Throttled notifications are retried with backoff, then queued and retried by the TerraformSvcCtlgEngineRetryNotifications lambda."
+  type        = number
+  default     = 5
+}
+
+variable "log_level" {
+  description = "Engine lambda log level. DEBUG logs full event payloads, sensitive parameter values are redacted at every level."
+  type        = string
+  default     = "INFO"
+}
+
+variable "log_debug_sample_rate" {
+  description = "Fraction (0 to 1) of engine lambda invocations logged at DEBUG level regardless of log_level."
+  type        = number
+  default     = 0
+}
 
 data "aws_partition" "current" {}
 data "aws_region" "current" {}
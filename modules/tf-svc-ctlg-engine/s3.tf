@@ -1,3 +1,80 @@
 resource "aws_s3_bucket" "tfstate" {
   bucket_prefix = "tfstate-${local.acct_id}-${local.region}-"
 }
+
+locals {
+  # Parameter parser responses cached by provisioning artifact content hash
+  parameter_cache_prefix = "parameter-cache/"
+
+  # Idempotency ledger of product operation states keyed by record id
+  ledger_prefix = "ledger/"
+
+  # Per provisioned product scheduler state, not expired
+  scheduler_prefix = "scheduler/"
+
+  # Terraform binaries and provider mirrors used by the CodeBuild terraform run, see codebuild/provider_cache.py
+  provider_cache_prefix = "provider-cache/"
+}
+
+resource "aws_s3_bucket_lifecycle_configuration" "tfstate" {
+  bucket = aws_s3_bucket.tfstate.id
+
+  rule {
+    id     = "expire-parameter-cache"
+    status = "Enabled"
+
+    filter {
+      prefix = local.parameter_cache_prefix
+    }
+
+    expiration {
+      days = var.parameter_cache_expiration_days
+    }
+  }
+
+  rule {
+    id     = "expire-ledger"
+    status = "Enabled"
+
+    filter {
+      prefix = local.ledger_prefix
+    }
+
+    # Entries only need to outlive SQS message retention and Step Functions retries
+    expiration {
+      days = 30
+    }
+  }
+
+  rule {
+    id     = "expire-op-context"
+    status = "Enabled"
+
+    filter {
+      tag {
+        key   = "svc-ctlg-engine-object"
+        value = "op-context"
+      }
+    }
+
+    # Contexts are deleted when Service Catalog is notified, this expires the contexts of operations that never finish.
+    # Operations are deferred for at most 11 hours and builds time out after 2 hours.
+    expiration {
+      days = 3
+    }
+  }
+
+  rule {
+    id     = "expire-provider-cache"
+    status = "Enabled"
+
+    filter {
+      prefix = local.provider_cache_prefix
+    }
+
+    # Mirrors cached for version constraints pin the resolved provider versions until they expire
+    expiration {
+      days = var.provider_cache_expiration_days
+    }
+  }
+}
@@ -67,6 +67,7 @@ resource "aws_sfn_state_machine" "product_operation" {
   # start codebuild sync wait
   # invoke lambda succeeded_product_operation
   # any failure at any time invoke lambda failed_product_operation
+  # lambda release_stale_operations releases the provisioned product if the lambdas still fail after their retries
 
   definition = jsonencode({
     StartAt = "StartCodeBuildTerraformOperation"
@@ -87,8 +88,13 @@ resource "aws_sfn_state_machine" "product_operation" {
             IntervalSeconds = 10
           }
         ]
-        # TODO: get this OutputPath working to not pass messy API resp data into future states
-        # OutputPath = "$.Build"
+        # Keep only the build fields later states need, the full startBuild.sync response includes every environment
+        # variable and log link of the build. Phase durations are reported as CodeBuild queue and run time metrics.
+        ResultSelector = {
+          "Id.$"          = "$.Build.Id"
+          "BuildStatus.$" = "$.Build.BuildStatus"
+          "Phases.$"      = "$.Build.Phases"
+        }
         ResultPath = "$.codebuild.build"
         Next       = "LambdaSucceededProductOperation"
         Catch = [
@@ -108,6 +114,21 @@ resource "aws_sfn_state_machine" "product_operation" {
           FunctionName = aws_lambda_function.succeeded_product_operation.arn
           "Payload.$"  = "$"
         }
+        # Retry lambda service errors and function errors (including timeouts). Handlers skip operations the ledger
+        # records as notified, retries do not notify twice.
+        Retry = [
+          {
+            ErrorEquals     = ["Lambda.ServiceException", "Lambda.AWSLambdaException", "Lambda.SdkClientException", "Lambda.TooManyRequestsException"]
+            MaxAttempts     = 6
+            IntervalSeconds = 2
+            BackoffRate     = 2
+          },
+          {
+            ErrorEquals     = ["States.TaskFailed"]
+            MaxAttempts     = 2
+            IntervalSeconds = 10
+          },
+        ]
         Next = "Succeed"
       }
 
@@ -127,6 +148,21 @@ resource "aws_sfn_state_machine" "product_operation" {
             "Context.$" = "$$"
           }
         }
+        # Retry lambda service errors and function errors (including timeouts). Handlers skip operations the ledger
+        # records as notified, retries do not notify twice.
+        Retry = [
+          {
+            ErrorEquals     = ["Lambda.ServiceException", "Lambda.AWSLambdaException", "Lambda.SdkClientException", "Lambda.TooManyRequestsException"]
+            MaxAttempts     = 6
+            IntervalSeconds = 2
+            BackoffRate     = 2
+          },
+          {
+            ErrorEquals     = ["States.TaskFailed"]
+            MaxAttempts     = 2
+            IntervalSeconds = 10
+          },
+        ]
         Next = "Fail"
       }
 
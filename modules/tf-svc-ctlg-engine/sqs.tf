@@ -17,7 +17,24 @@ resource "aws_sqs_queue" "product_operation" {
 
   redrive_policy = jsonencode({
     deadLetterTargetArn = aws_sqs_queue.product_operation_deadletter.arn
-    maxReceiveCount     = 1 # `receive count = 5` allows 4 retries before sending message to deadletter queue
+    # Each deferral by admission control (see lambda/admission.py) is a receive. With admission control, 50 receives
+    # allow deferring for 8 to 11 hours with the default backoff. Without it, records reported in batchItemFailures
+    # are retried twice before going to the dead letter queue. Redelivered messages of notified operations are skipped
+    # (see ledger.py).
+    maxReceiveCount = var.max_in_flight_operations > 0 ? 50 : 3
+  })
+}
+
+# Service Catalog notifications that failed after the retries of an engine lambda, see lambda/notify.py
+resource "aws_sqs_queue" "notify_retry" {
+  name                       = "TerraformSvcCtlgEngine-NotifyRetry"
+  sqs_managed_sse_enabled    = true
+  visibility_timeout_seconds = 60
+  message_retention_seconds  = 1209600 # max retention, undelivered notifications leave products stuck
+
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.product_operation_deadletter.arn
+    maxReceiveCount     = 20
   })
 }
 
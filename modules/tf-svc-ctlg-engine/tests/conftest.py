@@ -0,0 +1,102 @@
+# Tests run the engine modules in process against local stand-ins, no AWS account or network access is needed. AWS api
+# calls are answered by a botocore "before-send" hook (see the `aws` fixture): S3 by the in-memory S3 of local_aws.py,
+# other apis by handlers registered by each test. Api calls without a handler fail the test.
+#
+# Usage, from the repository root:
+#   python -m pytest -q modules/tf-svc-ctlg-engine/tests
+
+import collections
+import json
+import os
+import sys
+import threading
+
+import pytest
+
+MODULE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+for source_dir in ["lambda", "codebuild", "tools"]:
+    sys.path.insert(0, os.path.join(MODULE_DIR, source_dir))
+# Pipeline simulator, run as a subprocess
+SIMULATOR = os.path.join(MODULE_DIR, "benchmarks", "simulator.py")
+
+import local_aws
+
+# Lambda modules read their configuration from the environment at import time
+os.environ.update(local_aws.ENV)
+
+import botocore.awsrequest
+
+import assumed_role
+import clients
+
+
+class LocalAws:
+    def __init__(self):
+        self.s3 = local_aws.LocalS3()
+        self.lock = threading.Lock()
+        # {"service.Operation": calls}
+        self.calls = collections.Counter()
+        # {"service.Operation": handler(request) -> (status, headers, body)}
+        self.handlers = {}
+        # [(api, url part)]
+        self.denied = []
+        self.unexpected = []
+
+    # Answer `api`, for example "sfn.StartExecution", with handler(request). Json protocol request parameters are
+    # json.loads(request.body).
+    def on(self, api, handler):
+        self.handlers[api] = handler
+
+    # Answer requests of `api` whose url contains `url_part` with AccessDenied, for example to make an S3 prefix
+    # unavailable
+    def deny(self, api, url_part):
+        self.denied.append((api, url_part))
+
+    def handle_request(self, request, event_name, **kwargs):
+        _, service, operation = event_name.split(".", 2)
+        api = f"{service}.{operation}"
+        with self.lock:
+            self.calls[api] += 1
+
+        response = None
+        if any(api == denied_api and url_part in request.url for denied_api, url_part in self.denied):
+            response = 403, {}, local_aws.xml_error("AccessDenied", "Access Denied")
+        elif api in self.handlers:
+            response = self.handlers[api](request)
+        elif service == "s3":
+            response = self.s3.handle(operation, request)
+        if response is None:
+            with self.lock:
+                self.unexpected.append(api)
+            response = 400, {}, local_aws.json_error("UnexpectedApiCall", f"No local stand-in for {api}")
+
+        status, headers, body = response
+        headers = dict(headers, **{"Content-Length": str(len(body))})
+        return botocore.awsrequest.AWSResponse(request.url, status, headers, local_aws.RawResponse(body))
+
+
+def json_response(doc):
+    return 200, {}, json.dumps(doc, default=str).encode()
+
+
+def reset_clients():
+    # Clients copy the session event hooks when they are created, clients created before the hook was registered would
+    # reach AWS
+    clients._clients.clear()
+    assumed_role._roles.clear()
+
+
+@pytest.fixture
+def aws():
+    local = LocalAws()
+    reset_clients()
+    clients.session().events.register("before-send", local.handle_request)
+    yield local
+    clients.session().events.unregister("before-send", local.handle_request)
+    reset_clients()
+    assert not local.unexpected, f"api calls without a local stand-in: {local.unexpected}"
+
+
+@pytest.fixture
+def context():
+    return local_aws.LambdaContext()
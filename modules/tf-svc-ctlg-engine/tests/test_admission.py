@@ -0,0 +1,96 @@
+import re
+import subprocess
+import sys
+
+import botocore.config
+import pytest
+
+import admission
+import clients
+import local_aws
+from conftest import SIMULATOR, json_response
+
+QUEUE_ARN = "arn:aws:sqs:us-east-1:111111111111:ServiceCatalogExternalProvisionOperationQueue"
+
+
+def records(n):
+    return [{"messageId": f"m-{i}", "eventSourceARN": QUEUE_ARN, "attributes": {}} for i in range(n)]
+
+
+def running(n):
+    return lambda request: json_response({"executions": [{"executionArn": f"arn-{i}"} for i in range(n)]})
+
+
+def test_budget_defers_over_the_limit(aws):
+    aws.on("sfn.ListExecutions", running(3))
+    budget = admission.Budget(5)
+
+    budget.acquire()
+    budget.acquire()
+    with pytest.raises(admission.Deferred):
+        budget.acquire()
+    budget.release()
+    budget.acquire()
+
+    # Counted once per batch
+    assert aws.calls["sfn.ListExecutions"] == 1
+
+
+def test_budget_defers_when_executions_cannot_be_counted(aws, monkeypatch):
+    # Client retries are not under test
+    monkeypatch.setattr(
+        clients, "CONFIG", clients.CONFIG.merge(botocore.config.Config(retries={"mode": "standard", "max_attempts": 1}))
+    )
+    throttled = 400, {}, local_aws.json_error("ThrottlingException", "Rate exceeded")
+    aws.on("sfn.ListExecutions", lambda request: throttled)
+
+    with pytest.raises(admission.Deferred, match="ThrottlingException"):
+        admission.Budget(5).acquire()
+
+
+def test_disabled_budget_makes_no_api_calls(aws, monkeypatch):
+    monkeypatch.setattr(admission, "_gauges_emitted", None)
+    budget = admission.Budget(0)
+
+    for _ in range(3):
+        budget.acquire()
+    admission.emit_gauges(records(10), budget)
+
+    assert not aws.calls
+
+
+def test_gauges_are_emitted_at_most_once_per_interval(aws, monkeypatch):
+    monkeypatch.setattr(admission, "_gauges_emitted", None)
+    aws.on("sfn.ListExecutions", running(2))
+    aws.on("sqs.GetQueueUrl", lambda request: json_response({"QueueUrl": "https://sqs.local/provision"}))
+    attributes = {"ApproximateNumberOfMessages": "7", "ApproximateNumberOfMessagesNotVisible": "1"}
+    aws.on("sqs.GetQueueAttributes", lambda request: json_response({"Attributes": attributes}))
+
+    for _ in range(5):
+        admission.emit_gauges(records(10), admission.Budget(5))
+
+    assert aws.calls["sqs.GetQueueAttributes"] == 1
+    assert aws.calls["sfn.ListExecutions"] == 1
+
+
+# Burst of provisions larger than the CodeBuild quota, in the local pipeline simulator
+def simulate_burst(*args):
+    argv = [
+        *("--rate", "40", "--duration", "0.5", "--provision-share", "1", "--failure-rate", "0", "--flaky-rate", "0"),
+        *("--build-quota", "3", "--build-run-seconds", "0.3", "--build-queued-timeout", "1"),
+        *("--retry-interval", "0.5", "--defer-max-seconds", "2", "--drain-timeout", "30", *args),
+    ]
+    report = subprocess.run([sys.executable, SIMULATOR, *argv], capture_output=True, text=True, check=True)
+    report = report.stdout
+    timed_out = int(re.search(r"timed out in the CodeBuild queue: (\d+)", report)[1])
+    stuck = int(re.search(r"stuck operations \(never notified\): (\d+)", report)[1])
+    return timed_out, stuck, report
+
+
+def test_burst_waits_in_the_queue_instead_of_the_codebuild_queue():
+    timed_out, stuck, report = simulate_burst()
+    assert timed_out > 0, report
+
+    timed_out, stuck, report = simulate_burst("--max-in-flight", "3")
+    assert (timed_out, stuck) == (0, 0), report
+    assert re.search(r"'DeferredOperations': [1-9]", report), report
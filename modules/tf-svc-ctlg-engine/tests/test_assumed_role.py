@@ -0,0 +1,86 @@
+import concurrent.futures
+import datetime
+import io
+import threading
+import time
+import zipfile
+
+import assumed_role
+import parameter_cache
+import parameter_parser
+
+ROLE_ARN = "arn:aws:iam::111111111111:role/ServiceCatalogLaunchRole"
+OTHER_ROLE_ARN = "arn:aws:iam::222222222222:role/ServiceCatalogLaunchRole"
+
+
+def assume_role(expires_in=datetime.timedelta(hours=1), delay=0):
+    def handler(request):
+        time.sleep(delay)
+        expiration = (datetime.datetime.now(datetime.timezone.utc) + expires_in).isoformat()
+        body = (
+            "<AssumeRoleResponse><AssumeRoleResult><Credentials>"
+            "<AccessKeyId>ASIAEXAMPLE</AccessKeyId><SecretAccessKey>secret</SecretAccessKey>"
+            f"<SessionToken>token</SessionToken><Expiration>{expiration}</Expiration>"
+            "</Credentials></AssumeRoleResult></AssumeRoleResponse>"
+        )
+        return 200, {}, body.encode()
+
+    return handler
+
+
+def test_invocations_for_the_same_role_share_one_assume_role_call(aws, context):
+    aws.on("sts.AssumeRole", assume_role())
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        zf.writestr("variables.tf.json", '{"variable": {"name": {"type": "string"}}}')
+    aws.s3.put("artifact-bucket", "out/product.zip", buf.getvalue())
+    event = {
+        "artifact": {"path": "s3://artifact-bucket/out/product.zip", "type": "AWS_S3"},
+        "launchRoleArn": ROLE_ARN,
+    }
+
+    for _ in range(20):
+        # Parameter cache hits skip the launch role entirely
+        parameter_cache._entries.clear()
+        assert parameter_parser.handler(event, context)["parameters"][0]["key"] == "name"
+
+    assert aws.calls["sts.AssumeRole"] == 1
+    assert aws.calls["s3.HeadObject"] == 20
+
+
+def test_concurrent_refreshes_collapse_into_one_call(aws):
+    aws.on("sts.AssumeRole", assume_role(delay=0.1))
+    start = threading.Barrier(16)
+
+    def get_client():
+        start.wait()
+        return assumed_role.client(ROLE_ARN, "s3")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+        s3_clients = list(executor.map(lambda _: get_client(), range(16)))
+
+    assert aws.calls["sts.AssumeRole"] == 1
+    # One pooled client per (role, service)
+    assert len({id(c) for c in s3_clients}) == 1
+
+
+def test_expiring_credentials_are_refreshed(aws):
+    aws.on("sts.AssumeRole", assume_role(expires_in=assumed_role.REFRESH_BEFORE_EXPIRY / 2))
+
+    first = assumed_role.client(ROLE_ARN, "s3")
+    second = assumed_role.client(ROLE_ARN, "s3")
+
+    assert aws.calls["sts.AssumeRole"] == 2
+    # Clients hold the credentials they were created with
+    assert first is not second
+
+
+def test_roles_are_cached_separately(aws):
+    aws.on("sts.AssumeRole", assume_role())
+
+    for _ in range(3):
+        assumed_role.client(ROLE_ARN, "s3")
+        assumed_role.client(OTHER_ROLE_ARN, "s3")
+        assumed_role.client(OTHER_ROLE_ARN, "servicecatalog")
+
+    assert aws.calls["sts.AssumeRole"] == 2
@@ -0,0 +1,138 @@
+import json
+
+import failed_product_operation
+from conftest import json_response
+
+BUCKET = "tfstate-bucket"
+STDERR_KEY = "111111111111/pp-1-rec-1.stderr.txt"
+
+# terraform -no-color output, as written by CodeBuild
+PLAIN_STDERR = """
+Warning: Argument is deprecated
+
+  with aws_s3_bucket.bucket,
+  on main.tf line 10, in resource "aws_s3_bucket" "bucket":
+  10:   acl = "private"
+
+Use the aws_s3_bucket_acl resource instead
+
+Error: creating S3 Bucket (the-prefix-bucket): operation error S3: CreateBucket, BucketAlreadyExists
+
+  with aws_s3_bucket.bucket,
+  on main.tf line 8, in resource "aws_s3_bucket" "bucket":
+   8: resource "aws_s3_bucket" "bucket" {
+
+Error: creating IAM Role (the-role): operation error IAM: CreateRole, EntityAlreadyExists: Role exists
+
+  with aws_iam_role.role,
+  on main.tf line 20, in resource "aws_iam_role" "role":
+  20: resource "aws_iam_role" "role" {
+
+"""
+
+BUCKET_ERROR = """Error: creating S3 Bucket (the-prefix-bucket): operation error S3: CreateBucket, BucketAlreadyExists
+
+  with aws_s3_bucket.bucket,
+  on main.tf line 8, in resource "aws_s3_bucket" "bucket":
+   8: resource "aws_s3_bucket" "bucket" {"""
+
+ROLE_ERROR = """Error: creating IAM Role (the-role): operation error IAM: CreateRole, EntityAlreadyExists: Role exists
+
+  with aws_iam_role.role,
+  on main.tf line 20, in resource "aws_iam_role" "role":
+  20: resource "aws_iam_role" "role" {"""
+
+
+# The same diagnostics as terraform prints them without -no-color
+def boxed(plain):
+    boxes = []
+    for block in plain.strip().split("\n\n"):
+        if block.startswith(("Error:", "Warning:")):
+            boxes.append(["╷"])
+        boxes[-1] += [f"│ {line}" if line else "│ " for line in block.splitlines()] + ["│ "]
+    return "\n".join("\n".join(box[:-1] + ["╵"]) for box in boxes) + "\n"
+
+
+def test_plain_diagnostics_keep_every_error():
+    details = failed_product_operation.failure_details(PLAIN_STDERR, 2048)
+
+    assert details == BUCKET_ERROR + "\n" + ROLE_ERROR
+
+
+def test_boxed_diagnostics():
+    assert boxed(PLAIN_STDERR).startswith("╷\n│ Warning: Argument is deprecated\n│ \n")
+
+    assert failed_product_operation.failure_details(boxed(PLAIN_STDERR), 2048) == BUCKET_ERROR + "\n" + ROLE_ERROR
+
+
+def test_errors_that_do_not_fit_are_skipped():
+    large_error = "Error: " + "x" * 3000
+    stderr = "\n\n".join([BUCKET_ERROR, large_error, ROLE_ERROR])
+
+    assert failed_product_operation.failure_details(stderr, 2048) == BUCKET_ERROR + "\n" + ROLE_ERROR
+    # Only the last error fits
+    assert failed_product_operation.failure_details(stderr, len(ROLE_ERROR) + 10) == ROLE_ERROR
+    # The beginning of the last error, with its summary, if even the last error does not fit
+    assert failed_product_operation.failure_details(stderr, 40) == ROLE_ERROR[:40]
+
+
+def test_tail_starting_inside_a_diagnostic():
+    tail = PLAIN_STDERR[PLAIN_STDERR.index("BucketAlreadyExists") :]
+
+    assert failed_product_operation.failure_details(tail, 2048) == ROLE_ERROR
+    assert failed_product_operation.failure_details(boxed(PLAIN_STDERR)[-len(tail) :], 2048) == ROLE_ERROR
+
+
+def test_stderr_without_errors_keeps_its_end():
+    stderr = "Initializing the backend...\n" + "provider log line\n" * 200
+
+    assert failed_product_operation.failure_details(stderr, 100) == stderr.strip()[-100:]
+    assert failed_product_operation.failure_details("\nWarning: only a warning\n", 100) == "Warning: only a warning"
+
+
+def test_tail_of_a_small_object(aws):
+    aws.s3.put(BUCKET, STDERR_KEY, PLAIN_STDERR.encode())
+
+    assert failed_product_operation.s3_get_object_tail(f"s3://{BUCKET}/{STDERR_KEY}", 16 * 1024) == PLAIN_STDERR
+
+
+def test_tail_cutting_a_multi_byte_character(aws):
+    # "é" is 2 bytes and "│€" 6 bytes in UTF-8, the last 7 bytes start with the second byte of "é"
+    aws.s3.put(BUCKET, STDERR_KEY, "│ Error: é│€".encode())
+
+    tail = failed_product_operation.s3_get_object_tail(f"s3://{BUCKET}/{STDERR_KEY}", 7)
+
+    assert tail == "│€"
+    assert "�" not in tail
+
+
+def test_failure_reason_of_the_notification(aws, context):
+    notifications = []
+
+    def notify(request):
+        notifications.append(json.loads(request.body))
+        return json_response({})
+
+    aws.on("service-catalog.NotifyUpdateProvisionedProductEngineWorkflowResult", notify)
+    aws.s3.put(BUCKET, STDERR_KEY, ("provider log line\n" * 5000 + PLAIN_STDERR).encode())
+    event = {
+        "State": {
+            "productOperationRequest": {
+                "token": "token-1",
+                "operation": "UPDATE_PROVISIONED_PRODUCT",
+                "provisionedProductId": "pp-1",
+                "recordId": "rec-1",
+            },
+            "codebuild": {
+                "environmentVariablesOverride": [{"Name": "STDERR_S3_URI", "Value": f"s3://{BUCKET}/{STDERR_KEY}"}]
+            },
+            "Error": {"Error": "States.TaskFailed", "Cause": "{}"},
+        },
+        "Context": {"Execution": {"Id": "arn:aws:states:us-east-1:111111111111:execution:sm:update-pp-1-rec-1"}},
+    }
+
+    failed_product_operation.handler(event, context)
+
+    assert [n["Status"] for n in notifications] == ["FAILED"]
+    assert notifications[0]["FailureReason"].endswith(BUCKET_ERROR + "\n" + ROLE_ERROR)
+    assert len(notifications[0]["FailureReason"]) <= failed_product_operation.FAILURE_REASON_MAX_CHARS
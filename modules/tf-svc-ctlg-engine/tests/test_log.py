@@ -0,0 +1,83 @@
+import json
+
+import pytest
+
+import log
+
+
+@pytest.fixture
+def lines(capsys, monkeypatch):
+    monkeypatch.setattr(log, "_level", log.LEVELS["INFO"])
+
+    def read():
+        return [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+
+    return read
+
+
+def test_payloads_are_capped(lines):
+    log.info(
+        "capped",
+        text="x" * 10000,
+        items=list(range(100)),
+        keys={f"k{i}": i for i in range(100)},
+        nested=[[[[[[[[[["deep"]]]]]]]]]],
+    )
+    line = lines()[0]
+
+    assert line["text"] == "x" * log.MAX_FIELD_CHARS + "... [10000 characters]"
+    assert line["items"] == list(range(log.MAX_ITEMS)) + ["[80 more items]"]
+    assert len(line["keys"]) == log.MAX_ITEMS + 1 and line["keys"]["..."] == "[80 more keys]"
+    assert "nested too deep" in json.dumps(line["nested"])
+
+
+def test_debug_payloads_are_not_walked_when_debug_is_off(lines):
+    class Exploding(dict):
+        def items(self):
+            raise AssertionError("debug payload walked")
+
+    log.debug("not logged", payload=Exploding(a=1))
+    assert lines() == []
+
+
+def test_debug_logs_full_payloads(lines, monkeypatch):
+    monkeypatch.setattr(log, "_level", log.LEVELS["DEBUG"])
+    log.info("full", text="x" * 10000, items=list(range(100)))
+    line = lines()[0]
+    assert line["text"] == "x" * 10000 and line["items"] == list(range(100))
+
+
+@pytest.mark.parametrize("level", ["INFO", "DEBUG"])
+def test_sensitive_values_are_always_redacted(lines, monkeypatch, level):
+    monkeypatch.setattr(log, "_level", log.LEVELS[level])
+    log.info(
+        "redacted",
+        operationRequest={"parameters": [{"key": "db_password", "value": "hunter2"}]},
+        environmentVariablesOverride=[
+            {"Name": "TF_VAR_db_password", "Value": "hunter2"},
+            {"Name": "TF_VAR_default_tags_json", "Value": '{"team": "a"}'},
+            {"Name": "OPERATION", "Value": "PROVISION_PRODUCT"},
+        ],
+        parameters=[{"key": "db_password", "isNoEcho": True, "defaultValue": "hunter2"}],
+        credentials={"AccessKeyId": "AKIA", "SecretAccessKey": "hunter2", "SessionToken": "hunter2"},
+    )
+    line = lines()[0]
+
+    assert "hunter2" not in json.dumps(line)
+    assert line["operationRequest"]["parameters"][0] == {"key": "db_password", "value": log.REDACTED}
+    assert [v["Value"] for v in line["environmentVariablesOverride"]] == [
+        log.REDACTED,
+        '{"team": "a"}',
+        "PROVISION_PRODUCT",
+    ]
+
+
+def test_sampled_invocations_log_at_debug(monkeypatch):
+    monkeypatch.setattr(log, "LEVEL", log.LEVELS["INFO"])
+    monkeypatch.setattr(log, "DEBUG_SAMPLE_RATE", 1)
+    log.start_invocation()
+    assert log.debug_enabled()
+
+    monkeypatch.setattr(log, "DEBUG_SAMPLE_RATE", 0)
+    log.start_invocation()
+    assert not log.debug_enabled()
@@ -0,0 +1,176 @@
+import argparse
+import json
+import urllib.parse
+
+import migrate_state_keys
+import scheduler
+import state_keys
+
+BUCKET = "tfstate-bucket"
+PARTITIONS = 16
+
+# {flat key: body} of two products of one account and one product of another
+OBJECTS = {
+    "111111111111/pp-1.tfstate": b'{"version": 4, "serial": 7}',
+    "111111111111/pp-1.tfoutputs.json": b'{"bucket_name": {"value": "b1"}}',
+    "111111111111/pp-1-rec-1.stderr.txt": b"Error: something failed\n",
+    "111111111111/pp-2.tfstate": b'{"version": 4, "serial": 1}',
+    "222222222222/pp-3.tfstate": b'{"version": 4, "serial": 3}',
+    "222222222222/pp-3.fingerprint.json": b'{"value": "f"}',
+}
+# Engine objects outside the product key layouts
+OTHER_OBJECTS = {
+    "ledger/rec-1.json": b"{}",
+    "parameter-cache/abc.json": b"{}",
+    "provider-cache/key/mirror.zip": b"zip",
+}
+
+
+def put_objects(aws, objects):
+    for key, body in objects.items():
+        aws.s3.put(BUCKET, key, body)
+
+
+def sharded_key(flat_key):
+    account_id, rest = flat_key.split("/", 1)
+    pp_id = rest.split(".", 1)[0].split("-rec-", 1)[0]
+    flat = state_keys.flat_prefix(account_id, pp_id)
+    return state_keys.sharded_prefix(account_id, pp_id, PARTITIONS) + flat_key[len(flat) :]
+
+
+def migrate(tmp_path, **options):
+    args = argparse.Namespace(
+        bucket=BUCKET,
+        partitions=PARTITIONS,
+        account=[],
+        scheduler_prefix="scheduler/",
+        workers=4,
+        checkpoint=str(tmp_path / "checkpoint.jsonl"),
+        delete_source=False,
+        dry_run=False,
+    )
+    for name, value in options.items():
+        setattr(args, name, value)
+    return migrate_state_keys.run(args)
+
+
+def checkpoint(tmp_path):
+    with open(tmp_path / "checkpoint.jsonl") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_copies_are_verified_and_sources_kept(aws, tmp_path, monkeypatch):
+    put_objects(aws, {**OBJECTS, **OTHER_OBJECTS})
+
+    assert migrate(tmp_path) == {migrate_state_keys.COPIED: 3}
+
+    for key, body in OBJECTS.items():
+        assert aws.s3.get(BUCKET, sharded_key(key)) == body
+        assert aws.s3.get(BUCKET, key) == body
+    assert len(aws.s3.objects) == 2 * len(OBJECTS) + len(OTHER_OBJECTS)
+    products = sorted(e["product"] for e in checkpoint(tmp_path))
+    assert products == ["111111111111/pp-1", "111111111111/pp-2", "222222222222/pp-3"]
+
+    # The engine keeps using the flat keys of products whose flat state exists
+    monkeypatch.setattr(state_keys, "LAYOUT", state_keys.SHARDED)
+    monkeypatch.setattr(state_keys, "PARTITIONS", PARTITIONS)
+    assert state_keys.resolve(BUCKET, "111111111111", "pp-1") == "111111111111/pp-1"
+
+
+def test_delete_source_moves_products_to_the_sharded_layout(aws, tmp_path, monkeypatch):
+    put_objects(aws, {**OBJECTS, **OTHER_OBJECTS})
+
+    assert migrate(tmp_path, delete_source=True) == {migrate_state_keys.MIGRATED: 3}
+
+    assert {key: aws.s3.get(BUCKET, key) for _, key in aws.s3.objects} == {
+        **{sharded_key(key): body for key, body in OBJECTS.items()},
+        **OTHER_OBJECTS,
+    }
+    monkeypatch.setattr(state_keys, "LAYOUT", state_keys.SHARDED)
+    monkeypatch.setattr(state_keys, "PARTITIONS", PARTITIONS)
+    assert state_keys.resolve(BUCKET, "111111111111", "pp-1") == sharded_key("111111111111/pp-1")
+    # Products created after the switch start with sharded keys
+    assert state_keys.resolve(BUCKET, "111111111111", "pp-9") == sharded_key("111111111111/pp-9")
+
+
+def test_resumed_run_skips_migrated_products(aws, tmp_path):
+    put_objects(aws, OBJECTS)
+    migrate(tmp_path)
+    aws.calls.clear()
+
+    # Unchanged products are skipped, a product whose objects changed since is copied again
+    aws.s3.put(BUCKET, "111111111111/pp-2.tfstate", b'{"version": 4, "serial": 2}')
+    assert migrate(tmp_path) == {migrate_state_keys.COPIED: 1}
+    assert aws.calls["s3.CopyObject"] == 1
+    assert aws.s3.get(BUCKET, sharded_key("111111111111/pp-2.tfstate")) == b'{"version": 4, "serial": 2}'
+
+    # Copied products are migrated by the run deleting the sources
+    assert migrate(tmp_path, delete_source=True) == {migrate_state_keys.MIGRATED: 3}
+    assert migrate(tmp_path, delete_source=True) == {}
+
+
+def test_products_with_operations_in_the_scheduler_are_skipped(aws, tmp_path):
+    put_objects(aws, OBJECTS)
+    op_req = {"token": "t", "operation": "UPDATE_PROVISIONED_PRODUCT", "provisionedProductId": "pp-1", "recordId": "r"}
+    scheduler.submit(op_req, {"stateMachineArn": "arn", "name": "update-pp-1-r", "input": "{}"})
+
+    assert migrate(tmp_path, delete_source=True) == {migrate_state_keys.MIGRATED: 2, migrate_state_keys.SKIPPED: 1}
+    assert aws.s3.get(BUCKET, "111111111111/pp-1.tfstate") == OBJECTS["111111111111/pp-1.tfstate"]
+    assert aws.s3.get(BUCKET, sharded_key("111111111111/pp-1.tfstate")) is None
+
+    # Released products are migrated by the next run
+    scheduler.complete(op_req)
+    assert migrate(tmp_path, delete_source=True) == {migrate_state_keys.MIGRATED: 1}
+
+
+def test_source_changed_after_the_listing_fails_the_product(aws, tmp_path, monkeypatch):
+    put_objects(aws, OBJECTS)
+    list_flat_products = migrate_state_keys.list_flat_products
+
+    def list_then_change(bucket, accounts):
+        products = list_flat_products(bucket, accounts)
+        aws.s3.put(BUCKET, "222222222222/pp-3.tfstate", b'{"version": 4, "serial": 4}')
+        return products
+
+    monkeypatch.setattr(migrate_state_keys, "list_flat_products", list_then_change)
+
+    assert migrate(tmp_path, delete_source=True) == {migrate_state_keys.MIGRATED: 2, migrate_state_keys.FAILED: 1}
+    assert aws.s3.get(BUCKET, "222222222222/pp-3.tfstate") == b'{"version": 4, "serial": 4}'
+    # The state is copied last, no sharded state was written for the failed product
+    assert aws.s3.get(BUCKET, sharded_key("222222222222/pp-3.tfstate")) is None
+    failed = [e for e in checkpoint(tmp_path) if e["status"] == migrate_state_keys.FAILED]
+    assert [e["product"] for e in failed] == ["222222222222/pp-3"]
+    assert "PreconditionFailed" in failed[0]["reason"]
+
+
+def test_copy_with_another_checksum_keeps_the_source(aws, tmp_path):
+    put_objects(aws, OBJECTS)
+
+    # Copies of pp-2 are corrupted
+    def corrupting_copy(request):
+        response = aws.s3.handle("CopyObject", request)
+        key = urllib.parse.unquote(urllib.parse.urlsplit(request.url).path).lstrip("/").removeprefix(f"{BUCKET}/")
+        if "/pp-2" in key:
+            aws.s3.put(BUCKET, key, b"corrupted")
+        return response
+
+    aws.on("s3.CopyObject", corrupting_copy)
+
+    assert migrate(tmp_path, delete_source=True) == {migrate_state_keys.MIGRATED: 2, migrate_state_keys.FAILED: 1}
+    assert aws.s3.get(BUCKET, "111111111111/pp-2.tfstate") == OBJECTS["111111111111/pp-2.tfstate"]
+    failed = [e for e in checkpoint(tmp_path) if e["status"] == migrate_state_keys.FAILED]
+    assert [e["product"] for e in failed] == ["111111111111/pp-2"]
+    assert "checksum" in failed[0]["reason"]
+
+
+def test_account_filter_and_dry_run(aws, tmp_path):
+    put_objects(aws, OBJECTS)
+
+    assert migrate(tmp_path, account=["222222222222"], dry_run=True, delete_source=True) == {
+        migrate_state_keys.MIGRATED: 1
+    }
+    assert aws.calls["s3.CopyObject"] == aws.calls["s3.DeleteObject"] == 0
+    assert not (tmp_path / "checkpoint.jsonl").exists()
+
+    assert migrate(tmp_path, account=["222222222222"]) == {migrate_state_keys.COPIED: 1}
+    assert [e["product"] for e in checkpoint(tmp_path)] == ["222222222222/pp-3"]
@@ -0,0 +1,198 @@
+import collections
+import io
+import json
+import time
+
+import pytest
+
+import metrics
+import notify
+import local_aws
+import retry_notifications
+import succeeded_product_operation
+from conftest import json_response
+
+RETRY_QUEUE_URL = "https://sqs.us-east-1.amazonaws.com/111111111111/TerraformSvcCtlgEngine-NotifyRetry"
+NOTIFY_API = "service-catalog.NotifyTerminateProvisionedProductEngineWorkflowResult"
+
+
+def notify_args(i=1):
+    return {"WorkflowToken": f"token-{i}", "RecordId": f"rec-{i}", "Status": "SUCCEEDED"}
+
+
+# Service Catalog answering the notify calls of `responses` in turn, then succeeding
+class ServiceCatalog:
+    def __init__(self, aws, responses=()):
+        self.responses = collections.deque(responses)
+        self.calls = []
+        self.call_times = []
+        aws.on(NOTIFY_API, self.notify)
+
+    def notify(self, request):
+        self.calls.append(json.loads(request.body))
+        self.call_times.append(time.monotonic())
+        if self.responses:
+            return self.responses.popleft()
+        return json_response({})
+
+
+def throttled():
+    return 400, {}, local_aws.json_error("ThrottlingException", "Rate exceeded")
+
+
+def unavailable():
+    return 503, {}, local_aws.json_error("ServiceUnavailableException", "Service unavailable")
+
+
+def invalid_token():
+    return 400, {}, local_aws.json_error("InvalidParametersException", "Workflow token is expired or invalid")
+
+
+def retry_queue(aws):
+    messages = []
+
+    def send_message(request):
+        messages.append(json.loads(json.loads(request.body)["MessageBody"]))
+        return json_response({"MessageId": f"m-{len(messages)}", "MD5OfMessageBody": "md5"})
+
+    aws.on("sqs.SendMessage", send_message)
+    return messages
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(notify, "RETRY_SECONDS", 1)
+    monkeypatch.setattr(notify, "BACKOFF_BASE_SECONDS", 0.01)
+    monkeypatch.setattr(notify, "BACKOFF_MAX_SECONDS", 0.05)
+    monkeypatch.setattr(notify, "RETRY_QUEUE_URL", RETRY_QUEUE_URL)
+    monkeypatch.setattr(notify, "limiter", notify.TokenBucket(100, 100))
+    monkeypatch.setattr(metrics, "stream", io.StringIO())
+
+
+def emitted(name):
+    return sum(values[name][0] for values, _ in metrics.read(metrics.stream.getvalue().splitlines()) if name in values)
+
+
+def test_throttled_notification_is_retried(aws):
+    service_catalog = ServiceCatalog(aws, [throttled(), throttled()])
+
+    assert notify.result("TERMINATE_PROVISIONED_PRODUCT", notify_args()) is True
+
+    assert len(service_catalog.calls) == 3
+    assert emitted("NotifyThrottled") == 2
+    assert emitted("NotifyRetries") == 2
+
+
+def test_throttling_drains_the_shared_limiter(aws, monkeypatch):
+    monkeypatch.setattr(notify, "limiter", notify.TokenBucket(20, 5))
+    service_catalog = ServiceCatalog(aws, [throttled()])
+
+    for i in range(5):
+        notify.result("TERMINATE_PROVISIONED_PRODUCT", notify_args(i))
+
+    assert len(service_catalog.calls) == 6
+    # The throttled call empties the bucket, the 5 calls after it wait for the bucket to refill instead of using the
+    # rest of the burst
+    assert service_catalog.call_times[-1] - service_catalog.call_times[0] >= 5 / 20 * 0.9
+
+
+def test_notification_still_throttled_is_queued(aws):
+    ServiceCatalog(aws, [throttled()] * 1000)
+    messages = retry_queue(aws)
+
+    started = time.monotonic()
+    assert notify.result("TERMINATE_PROVISIONED_PRODUCT", notify_args()) is False
+
+    assert time.monotonic() - started < notify.RETRY_SECONDS + 0.5
+    assert messages == [
+        {
+            "operation": "TERMINATE_PROVISIONED_PRODUCT",
+            "notifyArgs": notify_args(),
+            "error": messages[0]["error"],
+        }
+    ]
+    assert "ThrottlingException" in messages[0]["error"]
+    assert emitted("NotificationsQueued") == 1
+
+
+def test_transient_errors_are_retried(aws):
+    service_catalog = ServiceCatalog(aws, [unavailable()])
+
+    assert notify.result("TERMINATE_PROVISIONED_PRODUCT", notify_args()) is True
+    assert len(service_catalog.calls) == 2
+    assert emitted("NotifyThrottled") == 0
+
+
+def test_permanent_errors_are_raised_without_retrying(aws):
+    service_catalog = ServiceCatalog(aws, [invalid_token()])
+    messages = retry_queue(aws)
+
+    with pytest.raises(Exception, match="InvalidParametersException"):
+        notify.result("TERMINATE_PROVISIONED_PRODUCT", notify_args())
+    # One http request, the botocore client does not retry either
+    assert len(service_catalog.calls) == 1
+    assert messages == []
+
+
+def test_retries_stop_at_the_invocation_deadline(aws):
+    ServiceCatalog(aws, [throttled()] * 1000)
+    messages = retry_queue(aws)
+    context = local_aws.LambdaContext(notify.DEADLINE_MARGIN_SECONDS + 0.2)
+
+    started = time.monotonic()
+    deadline = notify.invocation_deadline(context)
+    assert notify.result("TERMINATE_PROVISIONED_PRODUCT", notify_args(), deadline=deadline) is False
+
+    assert time.monotonic() - started < 0.5
+    assert len(messages) == 1
+
+
+def test_handler_queues_notifications_before_timing_out(aws, monkeypatch):
+    monkeypatch.setattr(notify, "RETRY_SECONDS", 30)
+    ServiceCatalog(aws, [throttled()] * 1000)
+    messages = retry_queue(aws)
+    event = {
+        "productOperationRequest": {
+            "token": "token-1",
+            "operation": "TERMINATE_PROVISIONED_PRODUCT",
+            "provisionedProductId": "pp-1",
+            "recordId": "rec-1",
+        },
+        "fingerprint": {"s3Uri": "s3://tfstate-bucket/111111111111/pp-1.fingerprint.json", "value": None},
+    }
+    timeout = notify.DEADLINE_MARGIN_SECONDS + 1
+    context = local_aws.LambdaContext(timeout)
+
+    succeeded_product_operation.handler(event, context)
+
+    assert context.get_remaining_time_in_millis() > 0
+    assert [m["notifyArgs"]["RecordId"] for m in messages] == ["rec-1"]
+
+
+def sqs_record(i):
+    body = {"operation": "TERMINATE_PROVISIONED_PRODUCT", "notifyArgs": notify_args(i), "error": "ThrottlingException"}
+    return {"messageId": f"m-{i}", "body": json.dumps(body), "attributes": {"ApproximateReceiveCount": "1"}}
+
+
+def test_retry_notifications_releases_records_it_has_no_time_for(aws):
+    service_catalog = ServiceCatalog(aws, [throttled()] * 1000)
+    margin_seconds = retry_notifications.MARGIN_MILLIS / 1000
+    # Time for the retries of one record only
+    context = local_aws.LambdaContext(notify.RETRY_SECONDS + margin_seconds + 0.5)
+
+    resp = retry_notifications.handler({"Records": [sqs_record(1), sqs_record(2)]}, context)
+
+    assert {c["RecordId"] for c in service_catalog.calls} == {"rec-1"}
+    assert resp == {"batchItemFailures": [{"itemIdentifier": "m-1"}, {"itemIdentifier": "m-2"}]}
+    assert context.get_remaining_time_in_millis() > 0
+
+
+def test_retry_notifications_does_not_queue_again(aws):
+    ServiceCatalog(aws, [invalid_token()] + [throttled()] * 1000)
+    messages = retry_queue(aws)
+
+    resp = retry_notifications.handler({"Records": [sqs_record(1), sqs_record(2)]}, local_aws.LambdaContext(30))
+
+    # Both failed records are released back into the retry queue, not sent to it again
+    assert resp == {"batchItemFailures": [{"itemIdentifier": "m-1"}, {"itemIdentifier": "m-2"}]}
+    assert messages == []
@@ -0,0 +1,116 @@
+import io
+import json
+import time
+
+import pytest
+
+import failed_product_operation
+import metrics
+import op_trace
+import start_product_operation
+import succeeded_product_operation
+from test_start_product_operation import StateMachine, fake_services, op_request, sqs_event
+
+DIMENSIONS = {"Operation": "PROVISION_PRODUCT", "ProductId": "prod-1"}
+PHASES = [
+    {"PhaseType": "SUBMITTED", "DurationInSeconds": 1},
+    {"PhaseType": "QUEUED", "DurationInSeconds": 30},
+    {"PhaseType": "PROVISIONING", "DurationInSeconds": 10},
+    {"PhaseType": "BUILD", "DurationInSeconds": 100},
+    {"PhaseType": "COMPLETED"},
+]
+
+
+@pytest.fixture(autouse=True)
+def captured_metrics(monkeypatch):
+    monkeypatch.setattr(metrics, "stream", io.StringIO())
+
+
+# {metric name: [(value, unit, dimensions)]} of the captured metric lines, then clears them
+def emitted():
+    values = {}
+    for metric_values, dimensions in metrics.read(metrics.stream.getvalue().splitlines()):
+        for name, (value, unit) in metric_values.items():
+            values.setdefault(name, []).append((value, unit, dimensions))
+    metrics.stream.seek(0)
+    metrics.stream.truncate()
+    return values
+
+
+# Start the operations of `op_reqs` from SQS messages sent `sent_ago` ms and first received `received_ago` ms ago.
+# Returns the state machine inputs by execution name.
+def start(aws, context, op_reqs, sent_ago=5000, received_ago=2000):
+    state_machine = StateMachine()
+    fake_services(aws, state_machine)
+    event = sqs_event(*op_reqs)
+    now = op_trace.now()
+    for record in event["Records"]:
+        record["attributes"]["SentTimestamp"] = str(now - sent_ago)
+        record["attributes"]["ApproximateFirstReceiveTimestamp"] = str(now - received_ago)
+    assert start_product_operation.handler(event, context) == {"batchItemFailures": []}
+    return state_machine.inputs
+
+
+def test_trace_through_start_succeeded_and_failed(aws, context):
+    started = time.time() * 1000
+    inputs = start(aws, context, [op_request(1, productId="prod-1"), op_request(2, productId="prod-1")])
+
+    values = emitted()
+    assert [(v, u) for v, u, _ in values["QueueWait"]] == [(3000, "Milliseconds")] * 2
+    for value, unit, dimensions in values["DispatchTime"]:
+        assert 2000 <= value <= 2000 + time.time() * 1000 - started and unit == "Milliseconds"
+        assert dimensions == DIMENSIONS
+
+    aws.s3.put("tfstate-bucket", "111111111111/pp-1.tfoutputs.json", b'{"url": {"value": "https://example.com"}}')
+    succeeded_event = dict(inputs["provision-pp-1-rec-1"], codebuild={"build": {"Phases": PHASES}})
+    succeeded_product_operation.handler(succeeded_event, context)
+
+    values = emitted()
+    assert values["CodeBuildQueueTime"] == [(31, "Seconds", DIMENSIONS)]
+    assert values["CodeBuildRunTime"] == [(110, "Seconds", DIMENSIONS)]
+    [(notify_latency, unit, dimensions)] = values["NotifyLatency"]
+    assert 0 < notify_latency < 1000 and unit == "Milliseconds" and dimensions == DIMENSIONS
+    [(end_to_end, _, _)] = values["EndToEndLatency"]
+    assert end_to_end >= 5000
+
+    failed_event = {
+        "State": dict(
+            inputs["provision-pp-2-rec-2"],
+            Error={"Error": "States.TaskFailed", "Cause": json.dumps({"Build": {"Phases": PHASES}})},
+        ),
+        "Context": {"Execution": {"Id": "arn:aws:states:us-east-1:111111111111:execution:sm:provision-pp-2-rec-2"}},
+    }
+    failed_product_operation.handler(failed_event, context)
+
+    values = emitted()
+    assert values["CodeBuildQueueTime"] == [(31, "Seconds", DIMENSIONS)]
+    assert values["CodeBuildRunTime"] == [(110, "Seconds", DIMENSIONS)]
+    assert [d for _, _, d in values["NotifyLatency"]] == [DIMENSIONS]
+    assert values["EndToEndLatency"][0][0] >= 5000
+
+
+def test_missing_or_malformed_trace_context_emits_nothing():
+    op_req = op_request(1, productId="prod-1")
+    malformed = [None, [], "trace", {}, {"sentTimestamp": "yesterday", "firstReceiveTimestamp": None}]
+
+    assert op_trace.from_sqs_record({"messageId": "m-1"}) == {}
+    assert op_trace.from_sqs_record({"attributes": None}) == {}
+    attributes = {"SentTimestamp": "", "ApproximateFirstReceiveTimestamp": "x"}
+    assert op_trace.from_sqs_record({"attributes": attributes}) == {}
+    for trace in malformed:
+        op_trace.emit_dispatched(trace, op_req)
+        op_trace.emit_notified(time.perf_counter(), trace, op_req)
+
+    # Only the metric that does not depend on the trace context
+    assert list(emitted()) == ["NotifyLatency"]
+
+
+def test_operations_with_malformed_sqs_timestamps_start(aws, context):
+    state_machine = StateMachine()
+    fake_services(aws, state_machine)
+    event = sqs_event(op_request(1))
+    event["Records"][0]["attributes"]["SentTimestamp"] = "not-a-timestamp"
+
+    assert start_product_operation.handler(event, context) == {"batchItemFailures": []}
+    assert state_machine.started == ["provision-pp-1-rec-1"]
+    assert "QueueWait" not in emitted()
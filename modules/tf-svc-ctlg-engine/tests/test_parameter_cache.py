@@ -0,0 +1,136 @@
+import collections
+import io
+import json
+import zipfile
+
+import pytest
+
+import parameter_cache
+import parameter_parser
+from test_s3_zip import assume_role_response
+
+CACHE_BUCKET = "engine-bucket"
+ARTIFACT_BUCKET = "sc-1f4e39d8d6ee2486532d12570660174a-us-east-1"
+CONTENT_HASH = (
+    "60413ed8e0ba1e67a89ecd3b1f2280e9-466c76bf1ec0618e4672d8061734b1c2473207d1d225e2cde200bece3f37ef50"
+    "-bb6b1286bd6031a333ce4ecd6285008449134e044ee16407f8090cc7c5db13d9"
+)
+LAUNCH_ROLE_ARN = "arn:aws:iam::111111111111:role/ServiceCatalogLaunchRole"
+RESP = {
+    "parameters": [
+        {
+            "key": "bucket_name_prefix",
+            "type": "string",
+            "description": "No description provided",
+            "defaultValue": "svc-ctlg-bucket-",
+            "isNoEcho": False,
+        }
+    ]
+}
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(parameter_cache, "_entries", collections.OrderedDict())
+    monkeypatch.setattr(parameter_cache, "_entries_bytes", 0)
+    monkeypatch.setattr(parameter_cache, "counters", dict.fromkeys(parameter_cache.counters, 0))
+    monkeypatch.setenv("PARAMETER_CACHE_BUCKET", CACHE_BUCKET)
+
+
+# Service Catalog copy of the artifact of a product version, each request gets a new path
+def artifact_path(request):
+    request_uuid = f"7e12aeec-f913-4833-b819-8fd4a9c5be5{request}"
+    return f"s3://{ARTIFACT_BUCKET}/out/7a4b8a59bd08f838400ad80309444392/{CONTENT_HASH}-1732556832175-{request_uuid}"
+
+
+def artifact(default="svc-ctlg-bucket-"):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        zf.writestr("main.tf", 'resource "aws_s3_bucket" "bucket" {}')
+        variables = {"variable": {"bucket_name_prefix": {"type": "string", "default": default}}}
+        zf.writestr("variables.tf.json", json.dumps(variables))
+    return buf.getvalue()
+
+
+def event(path):
+    return {"artifact": {"path": path, "type": "AWS_S3"}, "launchRoleArn": LAUNCH_ROLE_ARN}
+
+
+def test_memory_tier_evicts_least_recently_used_entries(monkeypatch):
+    monkeypatch.delenv("PARAMETER_CACHE_BUCKET")
+    monkeypatch.setattr(parameter_cache, "MAX_ENTRIES", 2)
+    parameter_cache.put("a", {"n": 1})
+    parameter_cache.put("b", {"n": 2})
+
+    assert parameter_cache.get("a") == {"n": 1}
+    parameter_cache.put("c", {"n": 3})
+
+    assert list(parameter_cache._entries) == ["a", "c"]
+    assert parameter_cache.get("b") is None
+    assert parameter_cache.counters == {"memory_hits": 1, "s3_hits": 0, "misses": 1, "evictions": 1}
+
+
+def test_memory_tier_evicts_by_size(monkeypatch):
+    monkeypatch.delenv("PARAMETER_CACHE_BUCKET")
+    entry = {"value": "x" * 100}
+    entry_bytes = len(json.dumps(entry))
+    monkeypatch.setattr(parameter_cache, "MAX_BYTES", 2 * entry_bytes + 10)
+    for key in ["a", "b", "c"]:
+        parameter_cache.put(key, entry)
+
+    assert list(parameter_cache._entries) == ["b", "c"]
+    assert parameter_cache._entries_bytes == 2 * entry_bytes
+    # Replacing an entry does not count its previous size
+    parameter_cache.put("c", entry)
+    assert list(parameter_cache._entries) == ["b", "c"]
+    assert parameter_cache.counters["evictions"] == 1
+
+
+def test_entries_over_the_entry_size_limit_are_not_cached(aws, monkeypatch):
+    monkeypatch.setattr(parameter_cache, "MAX_ENTRY_BYTES", 100)
+
+    parameter_cache.put("large", {"value": "x" * 100})
+    parameter_cache.put("small", {"value": "x"})
+
+    assert list(parameter_cache._entries) == ["small"]
+    assert aws.calls["s3.PutObject"] == 1
+    assert aws.s3.get(CACHE_BUCKET, "parameter-cache/large.json") is None
+
+
+def test_s3_tier_hit_skips_the_launch_role_and_the_artifact(aws, context):
+    aws.on("sts.AssumeRole", assume_role_response)
+    aws.s3.put(ARTIFACT_BUCKET, artifact_path(1)[len(f"s3://{ARTIFACT_BUCKET}/") :], artifact())
+
+    # Parsed by another execution environment, for another request of the same product version
+    assert parameter_parser.handler(event(artifact_path(1)), context) == RESP
+    cache_key = parameter_cache.key_from_artifact_path(artifact_path(1), "variables.tf.json")
+    assert json.loads(aws.s3.get(CACHE_BUCKET, f"parameter-cache/{cache_key}.json")) == RESP
+    parameter_cache._entries.clear()
+    aws.calls.clear()
+
+    assert parameter_parser.handler(event(artifact_path(2)), context) == RESP
+    assert aws.calls == {"s3.GetObject": 1}
+    # Kept in memory for the next warm invocation
+    assert parameter_parser.handler(event(artifact_path(3)), context) == RESP
+    assert aws.calls == {"s3.GetObject": 1}
+    assert parameter_cache.counters == {"memory_hits": 1, "s3_hits": 1, "misses": 1, "evictions": 0}
+
+
+def test_etag_key_without_a_content_hash_in_the_path(aws, context):
+    aws.on("sts.AssumeRole", assume_role_response)
+    path = "s3://artifact-bucket/out/product.zip"
+    etag = aws.s3.put("artifact-bucket", "out/product.zip", artifact())
+
+    assert parameter_cache.key_from_artifact_path(path, "variables.tf.json") is None
+    assert parameter_parser.handler(event(path), context) == RESP
+    assert list(parameter_cache._entries) == [parameter_cache.key_from_etag(etag, "variables.tf.json")]
+    aws.calls.clear()
+
+    # The object is checked for changes, its content is not downloaded again
+    assert parameter_parser.handler(event(path), context) == RESP
+    assert aws.calls == {"s3.HeadObject": 1}
+
+    # New artifact content at the same path
+    aws.s3.put("artifact-bucket", "out/product.zip", artifact(default="other-prefix-"))
+    assert parameter_parser.handler(event(path), context)["parameters"][0]["defaultValue"] == "other-prefix-"
+    assert parameter_cache.counters == {"memory_hits": 1, "s3_hits": 0, "misses": 2, "evictions": 0}
@@ -0,0 +1,208 @@
+import json
+import subprocess
+import sys
+
+import provider_cache
+
+AWS = "registry.terraform.io/hashicorp/aws"
+RANDOM = "registry.terraform.io/hashicorp/random"
+
+LOCK_FILE = """# This file is maintained automatically by "terraform init".
+# Manual edits may be lost in future updates.
+
+provider "registry.terraform.io/hashicorp/aws" {
+  version     = "5.31.0"
+  constraints = ">= 5.0.0"
+  hashes = [
+    "h1:ltxyuBWIy9cq0kIKDJH1jeWJy/y7XJLjS4QrsQK4plA=",
+    "zh:0cdb9c2083bf0902442384f7309367791e4640581652dda456f2d6d7abf0de8d",
+  ]
+}
+
+provider "registry.terraform.io/hashicorp/random" {
+  version = "3.6.0"
+  hashes = [
+    "h1:R5Ucn26riKIEijcsiOMBR3uOAjuOMfI1x7XvH4P6B1w=",
+  ]
+}
+"""
+
+MAIN_TF = """
+terraform {
+  required_version = ">= 1.5" # not a provider
+  required_providers {
+    aws = {
+      source  = "hashicorp/aws" // the AWS provider
+      version = "~> 5.0"
+    }
+    # legacy version string
+    random = ">= 3.0"
+    /*
+    tls = {
+      source = "hashicorp/tls"
+    }
+    */
+  }
+}
+
+provider "aws" {
+  region = "us-east-1"
+}
+
+resource "aws_s3_bucket" "b" {
+  bucket = "not-a-comment-#-or-//-in-a-string"
+  tags   = { Name = "provider \\"fake\\" { }" }
+}
+"""
+
+
+def write(directory, files):
+    for name, content in files.items():
+        path = directory / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+    return str(directory)
+
+
+def mirror(directory, providers):
+    for source, version, platform in providers:
+        (directory / source / version / platform).mkdir(parents=True)
+        (directory / source / version / platform / "terraform-provider").write_text("binary")
+    return str(directory)
+
+
+def test_lock_file_providers():
+    assert provider_cache.lock_file_providers(LOCK_FILE) == [(AWS, "5.31.0"), (RANDOM, "3.6.0")]
+
+
+def test_tf_providers_ignore_comments_and_strings():
+    assert sorted(provider_cache.tf_providers(MAIN_TF)) == [(AWS, ""), (AWS, "~> 5.0"), (RANDOM, ">= 3.0")]
+
+
+def test_tf_json_providers():
+    doc = {
+        "terraform": [{"required_providers": [{"aws": {"source": "HashiCorp/AWS", "version": "~> 5.0"}}]}],
+        "provider": {"random": {}, "example.com/acme/widget": [{"alias": "a"}]},
+        "variable": {"name": {"type": "string"}},
+    }
+    assert sorted(provider_cache.tf_json_providers(doc)) == [
+        ("example.com/acme/widget", ""),
+        (AWS, "~> 5.0"),
+        (RANDOM, ""),
+    ]
+    assert provider_cache.tf_json_providers([]) == []
+
+
+def test_requirements_prefer_the_lock_file(tmp_path):
+    artifact = write(tmp_path, {"main.tf": MAIN_TF, ".terraform.lock.hcl": LOCK_FILE})
+
+    assert provider_cache.requirements(artifact) == {"locked": True, "providers": [(AWS, "5.31.0"), (RANDOM, "3.6.0")]}
+
+
+def test_requirements_of_an_unlocked_artifact(tmp_path):
+    artifact = write(
+        tmp_path,
+        {
+            "main.tf": MAIN_TF,
+            "modules/network/versions.tf.json": json.dumps(
+                {"terraform": {"required_providers": {"tls": {"source": "hashicorp/tls"}}}}
+            ),
+            # Skipped: downloaded modules and files that cannot be parsed
+            ".terraform/modules/m/main.tf": 'provider "google" {}',
+            "broken.tf.json": "{",
+        },
+    )
+
+    # aws is declared with and without a constraint, the constrained declaration is kept
+    assert provider_cache.requirements(artifact) == {
+        "locked": False,
+        "providers": [(AWS, "~> 5.0"), (RANDOM, ">= 3.0"), ("registry.terraform.io/hashicorp/tls", "")],
+    }
+
+
+def test_cache_key_is_stable(tmp_path):
+    first = write(tmp_path / "first", {"main.tf": MAIN_TF})
+    # Same requirements, other formatting, comments and file layout
+    second = write(
+        tmp_path / "second",
+        {
+            "versions.tf": 'terraform {\n  required_providers {\n    random = ">= 3.0"\n'
+            '    aws = { version = "~> 5.0", source = "hashicorp/aws" }\n  }\n}\n',
+            "providers.tf": '# provider "google" {}\nprovider "aws" {}\n',
+            "outputs.tf": 'output "x" { value = 1 }\n',
+        },
+    )
+    key = provider_cache.cache_key(first, "1.9.8", "linux_amd64")
+
+    assert key == provider_cache.cache_key(first, "1.9.8", "linux_amd64")
+    assert key == provider_cache.cache_key(second, "1.9.8", "linux_amd64")
+    assert len({key, provider_cache.cache_key(first, "1.9.7", "linux_amd64")}) == 2
+    assert len({key, provider_cache.cache_key(first, "1.9.8", "linux_arm64")}) == 2
+
+    write(tmp_path / "first", {".terraform.lock.hcl": LOCK_FILE})
+    assert key != provider_cache.cache_key(first, "1.9.8", "linux_amd64")
+
+
+def test_manifest_lists_mirrored_providers(tmp_path):
+    mirror_dir = mirror(
+        tmp_path,
+        [
+            ("registry.terraform.io/hashicorp/aws", "5.31.0", "linux_amd64"),
+            ("registry.terraform.io/hashicorp/random", "3.6.0", "linux_amd64"),
+        ],
+    )
+
+    out = subprocess.run(
+        [sys.executable, provider_cache.__file__, "manifest", mirror_dir, "key-1", "1.9.8", "linux_amd64"],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    manifest_doc = json.loads(out)
+
+    assert {k: v for k, v in manifest_doc.items() if k != "created"} == {
+        "key": "key-1",
+        "keyVersion": provider_cache.KEY_VERSION,
+        "terraformVersion": "1.9.8",
+        "platform": "linux_amd64",
+        "providers": [
+            {"source": AWS, "version": "5.31.0", "platform": "linux_amd64"},
+            {"source": RANDOM, "version": "3.6.0", "platform": "linux_amd64"},
+        ],
+    }
+
+
+def test_missing_providers_of_a_locked_artifact(tmp_path):
+    artifact = write(tmp_path / "artifact", {".terraform.lock.hcl": LOCK_FILE})
+    mirror_dir = mirror(
+        tmp_path / "mirror",
+        [
+            ("registry.terraform.io/hashicorp/aws", "5.31.0", "linux_amd64"),
+            ("registry.terraform.io/hashicorp/random", "3.5.0", "linux_amd64"),
+        ],
+    )
+    manifest_doc = provider_cache.manifest(mirror_dir, "key-1", "1.9.8", "linux_amd64")
+
+    # Locked versions must match
+    assert provider_cache.missing_providers(manifest_doc, artifact) == [f"{RANDOM} 3.6.0"]
+
+
+def test_missing_providers_of_an_unlocked_artifact(tmp_path):
+    artifact = write(tmp_path / "artifact", {"main.tf": MAIN_TF})
+    mirror_dir = mirror(
+        tmp_path / "mirror",
+        [
+            ("registry.terraform.io/hashicorp/aws", "5.31.0", "linux_amd64"),
+            # Other platforms don't count
+            ("registry.terraform.io/hashicorp/random", "3.6.0", "darwin_arm64"),
+        ],
+    )
+    manifest_path = tmp_path / "manifest.json"
+    manifest_path.write_text(json.dumps(provider_cache.manifest(mirror_dir, "key-1", "1.9.8", "linux_amd64")))
+
+    assert provider_cache.missing_providers(json.loads(manifest_path.read_text()), artifact) == [RANDOM]
+    check = subprocess.run(
+        [sys.executable, provider_cache.__file__, "check", str(manifest_path), artifact], capture_output=True, text=True
+    )
+    assert check.returncode == 1
+    assert RANDOM in check.stdout
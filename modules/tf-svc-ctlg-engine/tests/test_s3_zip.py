@@ -0,0 +1,107 @@
+import builtins
+import datetime
+import io
+import json
+import os
+import tracemalloc
+import zipfile
+
+import clients
+import parameter_cache
+import parameter_parser
+import s3_zip
+
+BUCKET = "artifact-bucket"
+KEY = "out/product.zip"
+MEMBERS = 1000
+MEMBER_BYTES = 32 * 1024
+
+
+def assume_role_response(request):
+    expiration = (datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)).isoformat()
+    body = (
+        "<AssumeRoleResponse><AssumeRoleResult><Credentials>"
+        "<AccessKeyId>ASIAEXAMPLE</AccessKeyId><SecretAccessKey>secret</SecretAccessKey>"
+        f"<SessionToken>token</SessionToken><Expiration>{expiration}</Expiration>"
+        "</Credentials></AssumeRoleResult></AssumeRoleResponse>"
+    )
+    return 200, {}, body.encode()
+
+
+# Artifact with vendored providers and fixtures: many incompressible members around the variables file
+def large_artifact():
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as zf:
+        for i in range(MEMBERS // 2):
+            zf.writestr(f".terraform/providers/provider-{i}.bin", os.urandom(MEMBER_BYTES))
+        variables = {"variable": {"bucket_name_prefix": {"type": "string", "default": "svc-ctlg-bucket-"}}}
+        zf.writestr("variables.tf.json", json.dumps(variables))
+        for i in range(MEMBERS // 2):
+            zf.writestr(f"fixtures/fixture-{i}.json", os.urandom(MEMBER_BYTES))
+    return buf.getvalue()
+
+
+def event():
+    return {
+        "artifact": {"path": f"s3://{BUCKET}/{KEY}", "type": "AWS_S3"},
+        "launchRoleArn": "arn:aws:iam::111111111111:role/ServiceCatalogLaunchRole",
+    }
+
+
+def no_disk_writes(monkeypatch):
+    real_open = builtins.open
+
+    def read_only_open(file, mode="r", *args, **kwargs):
+        assert not set(mode) & set("wax+"), f"file {file} opened for writing"
+        return real_open(file, mode, *args, **kwargs)
+
+    monkeypatch.setattr(builtins, "open", read_only_open)
+
+
+def test_large_artifact_parsed_with_ranged_gets_in_memory(aws, context, monkeypatch):
+    artifact = large_artifact()
+    aws.s3.put(BUCKET, KEY, artifact)
+    aws.on("sts.AssumeRole", assume_role_response)
+    no_disk_writes(monkeypatch)
+
+    # First invocation creates the clients, a warm invocation is measured
+    parameter_parser.handler(event(), context)
+    parameter_cache._entries.clear()
+    aws.calls.clear()
+
+    tracemalloc.start()
+    try:
+        resp = parameter_parser.handler(event(), context)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    assert resp["parameters"] == [
+        {
+            "key": "bucket_name_prefix",
+            "type": "string",
+            "description": "No description provided",
+            "defaultValue": "svc-ctlg-bucket-",
+            "isNoEcho": False,
+        }
+    ]
+    # End of central directory record + central directory, then the variables file member
+    assert aws.calls["s3.GetObject"] <= 3
+    # Central directory and a few cached ranges, whatever the artifact size
+    assert peak < 4 * 1024 * 1024 < len(artifact)
+
+
+def test_read_member_when_range_is_ignored(aws):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("main.tf", "# " + "x" * 200000)
+        zf.writestr("variables.tf.json", '{"variable": {}}')
+    aws.s3.put(BUCKET, KEY, buf.getvalue())
+
+    # S3 compatible store answering ranged gets with the full object
+    def get_without_range(request):
+        return 200, {"ETag": '"etag"'}, aws.s3.get(BUCKET, KEY)
+
+    aws.on("s3.GetObject", get_without_range)
+    assert s3_zip.read_member(clients.client("s3"), BUCKET, KEY, "variables.tf.json") == b'{"variable": {}}'
+    assert aws.calls["s3.GetObject"] == 1
@@ -0,0 +1,229 @@
+import json
+import re
+import subprocess
+import sys
+
+import pytest
+
+import json_store
+import ledger
+import local_aws
+import release_stale_operations
+import scheduler
+from conftest import SIMULATOR, json_response
+
+
+def op_request(i, pp="pp-1", operation="UPDATE_PROVISIONED_PRODUCT"):
+    return {"token": f"token-{i}", "operation": operation, "provisionedProductId": pp, "recordId": f"rec-{i}"}
+
+
+def start_args(op_req):
+    return {
+        "stateMachineArn": local_aws.STATE_MACHINE_ARN,
+        "name": f"update-{op_req['provisionedProductId']}-{op_req['recordId']}",
+        "input": "{}",
+    }
+
+
+# Step Functions with executions {name: status}
+def state_machine(aws, executions):
+    def start_execution(request):
+        executions[json.loads(request.body)["name"]] = "RUNNING"
+        return json_response({"executionArn": "arn", "startDate": 0})
+
+    def describe_execution(request):
+        name = json.loads(request.body)["executionArn"].rsplit(":", 1)[-1]
+        if name not in executions:
+            return 400, {}, local_aws.json_error("ExecutionDoesNotExist", f"Execution Does Not Exist: '{name}'")
+        return json_response({"executionArn": "arn", "status": executions[name], "startDate": 0})
+
+    aws.on("sfn.StartExecution", start_execution)
+    aws.on("sfn.DescribeExecution", describe_execution)
+
+
+def service_catalog(aws):
+    notifications = []
+
+    def notify(request):
+        notifications.append(json.loads(request.body))
+        return json_response({})
+
+    aws.on("service-catalog.NotifyUpdateProvisionedProductEngineWorkflowResult", notify)
+    return notifications
+
+
+# First operation running with its execution in `status`, second operation queued behind it
+def running_and_queued(aws, status):
+    executions = {}
+    state_machine(aws, executions)
+    first, second = op_request(1), op_request(2)
+    assert scheduler.submit(first, start_args(first)) == scheduler.RUNNING
+    scheduler.start_execution(start_args(first))
+    ledger.record(first, ledger.STARTED)
+    assert scheduler.submit(second, start_args(second)) == scheduler.QUEUED
+    executions[start_args(first)["name"]] = status
+    return first, second, executions
+
+
+def test_succeeded_execution_that_did_not_complete_starts_the_queued_operation(aws):
+    notifications = service_catalog(aws)
+    first, second, executions = running_and_queued(aws, "SUCCEEDED")
+    ledger.record(first, ledger.SUCCEEDED)
+
+    assert scheduler.sweep() == 1
+
+    assert executions[start_args(second)["name"]] == "RUNNING"
+    assert ledger.state(second) == ledger.STARTED
+    assert scheduler.store.get("pp-1.json")["running"]["productOperationRequest"]["recordId"] == "rec-2"
+    assert notifications == []
+
+
+def test_execution_ended_without_notifying_is_notified_failed(aws):
+    notifications = service_catalog(aws)
+    first, second, executions = running_and_queued(aws, "TIMED_OUT")
+
+    assert scheduler.sweep() == 1
+
+    assert [(n["RecordId"], n["Status"]) for n in notifications] == [("rec-1", "FAILED")]
+    assert "TIMED_OUT" in notifications[0]["FailureReason"]
+    assert ledger.state(first) == ledger.FAILED
+    assert executions[start_args(second)["name"]] == "RUNNING"
+    # Released operations are swept once
+    assert scheduler.sweep() == 0
+    assert len(notifications) == 1
+
+
+def test_ledger_error_after_starting_a_queued_operation_does_not_notify_it(aws):
+    notifications = service_catalog(aws)
+    first, second, executions = running_and_queued(aws, "SUCCEEDED")
+    third = op_request(3, operation="PROVISION_PRODUCT")
+    assert scheduler.submit(third, start_args(third)) == scheduler.QUEUED
+    aws.deny("s3.PutObject", "/ledger/rec-2.json")
+
+    scheduler.complete(first)
+
+    # The started operation stays running, the operation queued behind it waits for it
+    assert notifications == []
+    assert executions[start_args(second)["name"]] == "RUNNING"
+    assert start_args(third)["name"] not in executions
+    doc = scheduler.store.get("pp-1.json")
+    assert doc["running"]["productOperationRequest"]["recordId"] == "rec-2"
+    assert [e["productOperationRequest"]["recordId"] for e in doc["queue"]] == ["rec-3"]
+
+
+def test_superseded_operation_that_cannot_be_notified_does_not_fail_the_new_one(aws):
+    first, second, executions = running_and_queued(aws, "SUCCEEDED")
+    notifications = []
+
+    def expired_token(request):
+        notifications.append(json.loads(request.body))
+        return 400, {}, local_aws.json_error("InvalidParametersException", "Workflow token is expired or invalid")
+
+    aws.on("service-catalog.NotifyUpdateProvisionedProductEngineWorkflowResult", expired_token)
+    third = op_request(3)
+
+    assert scheduler.submit(third, start_args(third)) == scheduler.QUEUED
+
+    assert [n["RecordId"] for n in notifications] == ["rec-2"]
+    assert ledger.state(second) == ledger.FAILED
+    scheduler.complete(first)
+    assert executions[start_args(third)["name"]] == "RUNNING"
+    assert start_args(second)["name"] not in executions
+    assert len(notifications) == 1
+
+
+def test_running_execution_is_left_alone(aws):
+    running_and_queued(aws, "RUNNING")
+
+    assert scheduler.sweep() == 0
+    assert aws.calls["sfn.StartExecution"] == 1
+
+
+def test_operation_without_execution_is_started_after_the_grace_period(aws, monkeypatch):
+    executions = {}
+    state_machine(aws, executions)
+    op_req = op_request(1)
+    scheduler.submit(op_req, start_args(op_req))
+
+    # The redelivered message starts the execution first
+    assert scheduler.sweep() == 0
+    assert executions == {}
+
+    monkeypatch.setattr(scheduler, "START_GRACE_SECONDS", 0)
+    assert scheduler.sweep() == 0
+    assert executions == {start_args(op_req)["name"]: "RUNNING"}
+    assert ledger.state(op_req) == ledger.STARTED
+
+
+def test_operation_notified_without_execution_is_released(aws):
+    executions = {}
+    state_machine(aws, executions)
+    op_req = op_request(1)
+    scheduler.submit(op_req, start_args(op_req))
+    # No-op update notified, then complete() failed
+    ledger.record(op_req, ledger.SUCCEEDED)
+
+    assert scheduler.sweep() == 1
+    assert scheduler.store.get("pp-1.json") == {"running": None, "queue": []}
+    # Idle documents are deleted by the next sweep
+    assert scheduler.sweep() == 0
+    assert scheduler.store.get("pp-1.json") is None
+    assert executions == {}
+
+
+def test_errors_on_one_product_do_not_stop_the_sweep(aws):
+    notifications = service_catalog(aws)
+    executions = {}
+    state_machine(aws, executions)
+    for i, pp in enumerate(["pp-1", "pp-2"]):
+        op_req = op_request(i, pp=pp)
+        scheduler.submit(op_req, start_args(op_req))
+        executions[start_args(op_req)["name"]] = "ABORTED"
+    aws.deny("s3.GetObject", "/ledger/rec-0.json")
+
+    assert scheduler.sweep() == 1
+    assert [n["RecordId"] for n in notifications] == ["rec-1"]
+
+
+def test_idle_document_changed_concurrently_is_kept():
+    store = json_store.MemoryJsonStore()
+    store.put_if("pp-1.json", {"running": None, "queue": []}, None)
+    _, version = store.get_versioned("pp-1.json")
+    store.put("pp-1.json", {"running": {"started": "now"}, "queue": []})
+
+    with pytest.raises(json_store.ConditionFailed):
+        store.delete_if("pp-1.json", version)
+    assert store.list() == ["pp-1.json"]
+
+
+def test_sweep_stops_before_the_invocation_times_out(aws):
+    executions = {}
+    state_machine(aws, executions)
+    for i in range(3):
+        op_req = op_request(i, pp=f"pp-{i}")
+        scheduler.submit(op_req, start_args(op_req))
+        ledger.record(op_req, ledger.SUCCEEDED)
+
+    # Less time left than the margin, nothing is swept
+    release_stale_operations.handler({}, local_aws.LambdaContext(release_stale_operations.MARGIN_MILLIS / 2000))
+    assert aws.calls["sfn.DescribeExecution"] == 0
+
+    release_stale_operations.handler({}, local_aws.LambdaContext(120))
+    assert aws.calls["sfn.DescribeExecution"] == 3
+    assert all(scheduler.store.get(f"pp-{i}.json")["running"] is None for i in range(3))
+
+
+def simulate_lambda_errors(*args):
+    argv = ["--rate", "20", "--duration", "1", "--lambda-error-rate", "0.8", "--drain-timeout", "10", *args]
+    report = subprocess.run([sys.executable, SIMULATOR, *argv], capture_output=True, text=True, check=True)
+    stuck = int(re.search(r"stuck operations \(never notified\): (\d+)", report.stdout)[1])
+    duplicates = int(re.search(r"operations notified more than once: (\d+)", report.stdout)[1])
+    return stuck, duplicates, report.stdout
+
+
+def test_sweep_releases_products_blocked_by_failed_notify_lambdas():
+    stuck, _, report = simulate_lambda_errors("--sweep-interval", "0")
+    assert stuck > 0, report
+
+    stuck, duplicates, report = simulate_lambda_errors("--sweep-interval", "0.5")
+    assert (stuck, duplicates) == (0, 0), report
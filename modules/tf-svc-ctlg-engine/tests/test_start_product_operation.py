@@ -0,0 +1,202 @@
+import json
+import time
+
+import fingerprint
+import ledger
+import scheduler
+import start_product_operation
+from conftest import json_response
+
+QUEUE_ARN = "arn:aws:sqs:us-east-1:111111111111:ServiceCatalogExternalProvisionOperationQueue"
+
+
+def op_request(i, operation="PROVISION_PRODUCT", **fields):
+    return {
+        "token": f"token-{i}",
+        "operation": operation,
+        "provisionedProductId": f"pp-{i}",
+        "provisionedProductName": f"product-{i}",
+        "productId": "prod-1",
+        "provisioningArtifactId": "pa-1",
+        "recordId": f"rec-{i}",
+        "launchRoleArn": "arn:aws:iam::111111111111:role/ServiceCatalogLaunchRole",
+        "artifact": {"path": "S3://artifact-bucket/out/product.zip", "type": "AWS_S3"},
+        "identity": {"principal": "AROAEXAMPLE", "awsAccountId": "111111111111", "organizationId": None},
+        "parameters": [{"key": "bucket_name_prefix", "value": f"prefix-{i}-"}],
+        "tags": [{"key": "project", "value": "a"}],
+        **fields,
+    }
+
+
+def sqs_event(*op_reqs):
+    return {
+        "Records": [
+            {
+                "messageId": f"m-{op_req['recordId']}",
+                "receiptHandle": f"handle-{op_req['recordId']}",
+                "body": json.dumps(op_req),
+                "attributes": {"ApproximateReceiveCount": "1"},
+                "eventSourceARN": QUEUE_ARN,
+            }
+            for op_req in op_reqs
+        ]
+    }
+
+
+# Artifact path with a content hash, updates of the same artifact can skip terraform
+ARTIFACT_PATH = (
+    "S3://sc-artifacts/out/7a4b8a59bd08f838400ad80309444392/60413ed8e0ba1e67a89ecd3b1f2280e9-"
+    + "1" * 64
+    + "-"
+    + "2" * 64
+    + "-1732629850224-f9596553-597b-4626-80c9-bcd71d092c98"
+)
+
+
+# Step Functions answering StartExecution after `delay(name)` seconds, `failures` names fail with an error
+class StateMachine:
+    def __init__(self, delay=lambda name: 0, failures=()):
+        self.delay = delay
+        self.failures = failures
+        self.started = []
+        # {execution name: state machine input}
+        self.inputs = {}
+
+    def start_execution(self, request):
+        name = json.loads(request.body)["name"]
+        time.sleep(self.delay(name))
+        if name in self.failures:
+            return 400, {}, json.dumps({"__type": "InvalidExecutionInput", "message": "Invalid input"}).encode()
+        self.started.append(name)
+        self.inputs[name] = json.loads(json.loads(request.body)["input"])
+        return json_response({"executionArn": f"arn:aws:states:us-east-1:111111111111:execution:sm:{name}"})
+
+
+class ServiceCatalog:
+    def __init__(self):
+        self.notifications = []
+
+    def notify(self, request):
+        self.notifications.append(json.loads(request.body))
+        return json_response({})
+
+
+def fake_services(aws, state_machine):
+    service_catalog = ServiceCatalog()
+    aws.on("sfn.StartExecution", state_machine.start_execution)
+    for operation in ["ProvisionProduct", "UpdateProvisionedProduct"]:
+        aws.on(f"service-catalog.Notify{operation}EngineWorkflowResult", service_catalog.notify)
+    return service_catalog
+
+
+def test_batch_records_start_concurrently(aws, context):
+    # 0.1s to 0.46s per StartExecution, 2.8s in total
+    delays = {f"provision-pp-{i}-rec-{i}": 0.1 + 0.04 * i for i in range(10)}
+    state_machine = StateMachine(delay=lambda name: delays[name])
+    fake_services(aws, state_machine)
+
+    started = time.monotonic()
+    resp = start_product_operation.handler(sqs_event(*[op_request(i) for i in range(10)]), context)
+    elapsed = time.monotonic() - started
+
+    assert resp == {"batchItemFailures": []}
+    assert sorted(state_machine.started) == sorted(delays)
+    # About the slowest record, not the sum of the records
+    assert elapsed < max(delays.values()) + 0.5 < sum(delays.values())
+
+
+def test_only_failed_records_are_returned_to_the_queue(aws, context):
+    state_machine = StateMachine(failures={"provision-pp-3-rec-3"})
+    service_catalog = fake_services(aws, state_machine)
+
+    resp = start_product_operation.handler(sqs_event(*[op_request(i) for i in range(10)]), context)
+
+    assert resp == {"batchItemFailures": [{"itemIdentifier": "m-rec-3"}]}
+    assert len(state_machine.started) == 9
+    assert [(n["RecordId"], n["Status"]) for n in service_catalog.notifications] == [("rec-3", "FAILED")]
+    assert "InvalidExecutionInput" in service_catalog.notifications[0]["FailureReason"]
+
+
+def test_failed_record_is_deleted_when_its_result_cannot_be_recorded(aws, context):
+    state_machine = StateMachine(failures={"provision-pp-1-rec-1"})
+    service_catalog = fake_services(aws, state_machine)
+    aws.deny("s3.PutObject", "/ledger/")
+
+    resp = start_product_operation.handler(sqs_event(op_request(1)), context)
+
+    # A redelivery would not find the FAILED result in the ledger and would start the operation
+    assert resp == {"batchItemFailures": []}
+    assert [(n["RecordId"], n["Status"]) for n in service_catalog.notifications] == [("rec-1", "FAILED")]
+    assert scheduler.store.get("pp-1.json")["running"] is None
+
+
+def test_ledger_errors_after_the_execution_started_do_not_notify(aws, context):
+    state_machine = StateMachine()
+    service_catalog = fake_services(aws, state_machine)
+    aws.deny("s3.PutObject", "/ledger/")
+
+    resp = start_product_operation.handler(sqs_event(op_request(1)), context)
+
+    assert resp == {"batchItemFailures": []}
+    assert state_machine.started == ["provision-pp-1-rec-1"]
+    # The execution notifies the result
+    assert service_catalog.notifications == []
+
+
+def test_operations_start_without_the_ledger(aws, context):
+    state_machine = StateMachine()
+    service_catalog = fake_services(aws, state_machine)
+    aws.deny("s3.GetObject", "/ledger/")
+    aws.deny("s3.PutObject", "/ledger/")
+
+    resp = start_product_operation.handler(sqs_event(op_request(1)), context)
+
+    assert resp == {"batchItemFailures": []}
+    assert state_machine.started == ["provision-pp-1-rec-1"]
+    assert service_catalog.notifications == []
+
+
+def test_redelivered_message_of_a_notified_operation_is_skipped(aws, context):
+    state_machine = StateMachine()
+    service_catalog = fake_services(aws, state_machine)
+    ledger.record(op_request(1), ledger.FAILED)
+
+    resp = start_product_operation.handler(sqs_event(op_request(1)), context)
+
+    assert resp == {"batchItemFailures": []}
+    assert state_machine.started == []
+    assert service_catalog.notifications == []
+
+
+def test_update_runs_terraform_when_the_last_fingerprint_cannot_be_loaded(aws, context):
+    state_machine = StateMachine()
+    service_catalog = fake_services(aws, state_machine)
+    update = op_request(1, "UPDATE_PROVISIONED_PRODUCT", artifact={"path": ARTIFACT_PATH, "type": "AWS_S3"})
+    aws.deny("s3.GetObject", ".fingerprint.json")
+
+    resp = start_product_operation.handler(sqs_event(update), context)
+
+    assert resp == {"batchItemFailures": []}
+    assert state_machine.started == ["update-pp-1-rec-1"]
+    assert service_catalog.notifications == []
+
+
+def test_update_with_the_inputs_of_the_last_apply_skips_terraform(aws, context):
+    state_machine = StateMachine()
+    service_catalog = fake_services(aws, state_machine)
+    update = op_request(1, "UPDATE_PROVISIONED_PRODUCT", artifact={"path": ARTIFACT_PATH, "type": "AWS_S3"})
+    start_product_operation.handler(sqs_event(update), context)
+    # Saved by succeeded_product_operation after the apply
+    applied = state_machine.inputs["update-pp-1-rec-1"]["fingerprint"]
+    fingerprint.save(applied["s3Uri"], applied["value"], update)
+    aws.s3.put("tfstate-bucket", "111111111111/pp-1.tfoutputs.json", b'{"url": {"value": "https://example.com"}}')
+    scheduler.complete(update)
+
+    resp = start_product_operation.handler(sqs_event(dict(update, token="token-2", recordId="rec-2")), context)
+
+    assert resp == {"batchItemFailures": []}
+    assert state_machine.started == ["update-pp-1-rec-1"]
+    assert [(n["RecordId"], n["Status"]) for n in service_catalog.notifications] == [("rec-2", "SUCCEEDED")]
+    outputs = service_catalog.notifications[0]["Outputs"]
+    assert [(o["OutputKey"], o["OutputValue"]) for o in outputs] == [("url", "https://example.com")]
+    assert aws.s3.get("tfstate-bucket", "111111111111/pp-1-rec-2.context.json") is None
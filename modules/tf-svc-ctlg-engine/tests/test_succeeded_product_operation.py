@@ -0,0 +1,66 @@
+import json
+
+import ledger
+import op_context
+import succeeded_product_operation
+from conftest import json_response
+
+
+def terminate_event():
+    op_req = {
+        "token": "token-1",
+        "operation": "TERMINATE_PROVISIONED_PRODUCT",
+        "provisionedProductId": "pp-1",
+        "recordId": "rec-1",
+    }
+    return {
+        "productOperationRequest": op_req,
+        "fingerprint": {"s3Uri": "s3://tfstate-bucket/111111111111/pp-1.fingerprint.json", "value": None},
+    }
+
+
+def service_catalog(aws):
+    notifications = []
+
+    def notify(request):
+        notifications.append(json.loads(request.body))
+        return json_response({})
+
+    for operation in ["ProvisionProduct", "TerminateProvisionedProduct"]:
+        aws.on(f"service-catalog.Notify{operation}EngineWorkflowResult", notify)
+    return notifications
+
+
+def test_notifies_without_the_ledger(aws, context):
+    notifications = service_catalog(aws)
+    aws.deny("s3.GetObject", "/ledger/")
+    aws.deny("s3.PutObject", "/ledger/")
+
+    succeeded_product_operation.handler(terminate_event(), context)
+
+    assert [(n["RecordId"], n["Status"]) for n in notifications] == [("rec-1", "SUCCEEDED")]
+
+
+def test_retried_invocation_does_not_notify_again(aws, context):
+    notifications = service_catalog(aws)
+
+    succeeded_product_operation.handler(terminate_event(), context)
+    succeeded_product_operation.handler(terminate_event(), context)
+
+    assert len(notifications) == 1
+    assert ledger.state(terminate_event()["productOperationRequest"]) == ledger.SUCCEEDED
+
+
+def test_context_with_noecho_values_is_deleted_after_notifying(aws, context):
+    notifications = service_catalog(aws)
+    op_req = dict(terminate_event()["productOperationRequest"], operation="PROVISION_PRODUCT")
+    outputs_s3_uri = "s3://tfstate-bucket/111111111111/pp-1.tfoutputs.json"
+    context_s3_uri = "s3://tfstate-bucket/111111111111/pp-1-rec-1.context.json"
+    op_context.put(context_s3_uri, op_req, [{"Name": "OUTPUTS_S3_URI", "Value": outputs_s3_uri}])
+    aws.s3.put("tfstate-bucket", "111111111111/pp-1.tfoutputs.json", b"{}")
+
+    event = {"productOperationRequest": op_req, "context": {"s3Uri": context_s3_uri}}
+    succeeded_product_operation.handler(event, context)
+
+    assert [(n["RecordId"], n["Status"]) for n in notifications] == [("rec-1", "SUCCEEDED")]
+    assert aws.s3.get("tfstate-bucket", "111111111111/pp-1-rec-1.context.json") is None
@@ -0,0 +1,110 @@
+import io
+import json
+import tracemalloc
+
+import tf_outputs
+
+
+def outputs(**values):
+    tf_outputs_json = {k: {"sensitive": False, "type": "string", "value": v} for k, v in values.items()}
+    return io.BytesIO(json.dumps(tf_outputs_json).encode())
+
+
+def sc_values(sc_outputs):
+    return {o["OutputKey"]: o["OutputValue"] for o in sc_outputs}
+
+
+def test_values_within_the_limit_are_kept_whatever_their_escapes():
+    # Every character is escaped in the raw json
+    quotes = '"' * 4096
+    controls = "\u0001" * 4096
+    mixed = 'a"b\\c\n' * 682 + "é<"
+    sc_outputs = tf_outputs.to_sc_outputs(outputs(quotes=quotes, controls=controls, mixed=mixed), 4096, 65536)
+    assert sc_values(sc_outputs) == {"quotes": quotes, "controls": controls, "mixed": mixed}
+
+
+def test_oversized_strings_are_decoded_and_truncated():
+    value = 'a"b\\c\n\u0001é' * 1000
+    sc_outputs = tf_outputs.to_sc_outputs(outputs(value=value), 100, 65536)
+    marker = tf_outputs.TRUNCATED_MARKER.format(len(value))
+    assert sc_values(sc_outputs) == {"value": value[: 100 - len(marker)] + marker}
+
+
+def test_oversized_strings_cut_in_an_escape_sequence():
+    for escape, char in [("\\u003c", "<"), ("\\ud83d\\ude00", "\U0001f600")]:
+        for prefix_chars in range(13):
+            raw = '{"value": {"value": "' + "x" * prefix_chars + escape * 5000 + '"}}'
+            value = tf_outputs.to_sc_outputs(io.BytesIO(raw.encode()), 100, 65536)[0]["OutputValue"]
+            decoded = json.loads(raw)["value"]["value"]
+            assert value.startswith(decoded[: len(value) - len(tf_outputs.TRUNCATED_MARKER.format(0)) - 5])
+            assert "\\" not in value and not any("\ud800" <= c <= "\udfff" for c in value), value
+            assert len(value) <= 100
+
+
+def test_outputs_over_the_total_limit_are_omitted():
+    values = {f"output_{i}": "v" * 100 for i in range(200)}
+    sc_outputs = tf_outputs.to_sc_outputs(outputs(**values), 4096, 1000)
+
+    omitted = sc_outputs.pop()
+    assert omitted["OutputKey"] == tf_outputs.OMITTED_OUTPUTS_KEY
+    assert omitted["OutputValue"] == tf_outputs.OMITTED_MARKER.format(190, 1000)
+    assert [o["OutputValue"] for o in sc_outputs] == ["v" * 100] * 10
+    assert sum(len(o["OutputValue"]) for o in sc_outputs) == 1000
+
+
+def test_output_reaching_the_total_limit_is_truncated():
+    sc_outputs = tf_outputs.to_sc_outputs(outputs(a="a" * 900, b="b" * 900, c="c"), 4096, 1000)
+    marker = tf_outputs.TRUNCATED_MARKER.format(900)
+    assert sc_values(sc_outputs) == {
+        "a": "a" * 900,
+        "b": "b" * (100 - len(marker)) + marker,
+        tf_outputs.OMITTED_OUTPUTS_KEY: tf_outputs.OMITTED_MARKER.format(1, 1000),
+    }
+
+
+def test_sensitive_and_non_string_values():
+    stream = io.BytesIO(
+        json.dumps(
+            {
+                "password": {"sensitive": True, "type": "string", "value": "secret"},
+                "subnets": {"sensitive": False, "type": ["list", "string"], "value": ["subnet-1", "subnet-2"]},
+                "count": {"sensitive": False, "type": "number", "value": 3},
+            }
+        ).encode()
+    )
+    assert sc_values(tf_outputs.to_sc_outputs(stream)) == {
+        "password": tf_outputs.REDACTED_VALUE,
+        "subnets": '["subnet-1", "subnet-2"]',
+        "count": "3",
+    }
+
+
+def test_multi_megabyte_outputs_are_streamed():
+    stream = outputs(
+        policy='{"Statement": [' + '{"Effect": "Allow"}, ' * 500000 + "]}",
+        table="x" * 10 * 1024 * 1024,
+        small="value",
+    )
+    stream_bytes = len(stream.getvalue())
+
+    tracemalloc.start()
+    try:
+        sc_outputs = tf_outputs.to_sc_outputs(stream)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    assert sc_values(sc_outputs)["small"] == "value"
+    assert all(len(o["OutputValue"]) <= tf_outputs.MAX_VALUE_CHARS for o in sc_outputs)
+    # A few read buffers, whatever the output sizes
+    assert peak < 1024 * 1024 < stream_bytes
+
+
+def test_escape_sequences_split_across_read_buffers(monkeypatch):
+    monkeypatch.setattr(tf_outputs, "READ_SIZE", 3)
+    values = ['\\u"', "\\\\u", 'a\\\\\\"u' * 20, "<é>" * 30]
+    for value in values:
+        raw = '{"value": {"value": ' + json.dumps(value).replace("<", "\\u003c") + "}}"
+        marker = tf_outputs.TRUNCATED_MARKER.format(len(value))
+        expected = value if len(value) <= 60 else value[: 60 - len(marker)] + marker
+        assert tf_outputs.to_sc_outputs(io.BytesIO(raw.encode()), 60, 65536)[0]["OutputValue"] == expected
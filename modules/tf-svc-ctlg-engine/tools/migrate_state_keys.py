@@ -0,0 +1,195 @@
+# Migrates the per provisioned product objects of the tfstate bucket from the flat key layout to the sharded layout
+# (see lambda/state_keys.py): terraform state, outputs, fingerprint and the operation context and stderr objects.
+#
+# Each product is migrated on its own, products are migrated in parallel:
+# 1. products with a running or queued operation in the scheduler are skipped, run the tool again later
+# 2. every flat object is copied to its sharded key, the terraform state last. Copies are conditional on the listed
+#    source ETag, a source changed since the listing fails the product instead of copying a newer state half-migrated.
+# 3. source and copy are downloaded and their SHA-256 checksums compared
+# 4. with --delete-source, the flat objects are deleted, the terraform state first: once the flat state is gone the
+#    engine uses the sharded keys for the product. Deletes are conditional on the verified ETag.
+#
+# Progress is appended to a checkpoint file. Runs are resumable: products already migrated with the same objects are
+# skipped, and every step is idempotent, so an interrupted run can be started again.
+#
+# Migrate while the engine uses the sharded layout (state_key_layout = "sharded"), products still having a flat state
+# keep using it until they are migrated. Run first without --delete-source to copy and verify, then with it.
+#
+# Usage, from the repository root, with credentials for the engine account:
+#   python modules/tf-svc-ctlg-engine/tools/migrate_state_keys.py --bucket tfstate-111111111111-us-east-1-... \
+#       [--partitions 256] [--workers 16] [--delete-source] [--dry-run]
+
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda")
+sys.path.insert(0, LAMBDA_DIR)
+
+import botocore.exceptions
+
+import clients
+import json_store
+import state_keys
+
+ACCOUNT_PREFIX = re.compile(r"^\d{12}/$")
+# <account id>/<provisioned product id> followed by ".tfstate", ".tfoutputs.json", "-<record id>.stderr.txt", ...
+FLAT_KEY = re.compile(r"^(\d{12})/(pp-[0-9a-z]+)([.-].*)$")
+
+MIGRATED = "migrated"
+COPIED = "copied"
+SKIPPED = "skipped"
+FAILED = "failed"
+
+
+class Checkpoint:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # {"<account id>/<provisioned product id>": last entry}
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.entries[entry["product"]] = entry
+
+    # True if the product was migrated (or copied, without --delete-source) with exactly these flat objects
+    def done(self, product, objects, delete_source):
+        entry = self.entries.get(product)
+        statuses = [MIGRATED] if delete_source else [MIGRATED, COPIED]
+        return bool(entry) and entry["status"] in statuses and entry["objects"] == objects
+
+    def record(self, product, objects, status, reason=None):
+        entry = {"product": product, "objects": objects, "status": status}
+        if reason:
+            entry["reason"] = reason
+        with self.lock:
+            self.entries[product] = entry
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+
+# {"<account id>/<provisioned product id>": {flat key: etag}}
+def list_flat_products(bucket, accounts):
+    s3 = clients.client("s3")
+    products = collections.defaultdict(dict)
+    account_prefixes = [f"{a}/" for a in accounts]
+    if not account_prefixes:
+        for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Delimiter="/"):
+            prefixes = [p["Prefix"] for p in page.get("CommonPrefixes", [])]
+            account_prefixes += [p for p in prefixes if ACCOUNT_PREFIX.match(p)]
+    for account_prefix in account_prefixes:
+        for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=account_prefix):
+            for obj in page.get("Contents", []):
+                match = FLAT_KEY.match(obj["Key"])
+                if match:
+                    products[f"{match.group(1)}/{match.group(2)}"][obj["Key"]] = obj["ETag"]
+    return products
+
+
+def migrate_product(args, product, objects):
+    s3 = clients.client("s3")
+    account_id, pp_id = product.split("/")
+    flat = state_keys.flat_prefix(account_id, pp_id)
+    sharded = state_keys.sharded_prefix(account_id, pp_id, args.partitions)
+
+    if busy(args, pp_id):
+        return SKIPPED, "operation running or queued"
+
+    # Terraform state copied last and deleted first, it decides which layout the engine uses for the product
+    keys = sorted(objects, key=lambda k: (k.endswith(state_keys.STATE_SUFFIX), k))
+    for key in keys:
+        target = sharded + key[len(flat) :]
+        if args.dry_run:
+            print(f"would copy s3://{args.bucket}/{key} to s3://{args.bucket}/{target}")
+            continue
+        s3.copy_object(
+            Bucket=args.bucket,
+            Key=target,
+            CopySource={"Bucket": args.bucket, "Key": key},
+            CopySourceIfMatch=objects[key],
+            MetadataDirective="COPY",
+        )
+        source_checksum = checksum(args.bucket, key)
+        target_checksum = checksum(args.bucket, target)
+        if source_checksum != target_checksum:
+            return FAILED, f"checksum of {target} ({target_checksum}) does not match {key} ({source_checksum})"
+
+    if not args.delete_source:
+        return COPIED, None
+    if busy(args, pp_id):
+        return SKIPPED, "operation started during the copy, the flat objects are kept"
+    for key in reversed(keys):
+        if args.dry_run:
+            print(f"would delete s3://{args.bucket}/{key}")
+            continue
+        s3.delete_object(Bucket=args.bucket, Key=key, IfMatch=objects[key])
+    return MIGRATED, None
+
+
+def busy(args, pp_id):
+    doc = json_store.S3JsonStore(args.bucket, args.scheduler_prefix).get(f"{pp_id}.json")
+    return bool(doc and (doc.get("running") or doc.get("queue")))
+
+
+def checksum(bucket, key):
+    body = clients.client("s3").get_object(Bucket=bucket, Key=key)["Body"]
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: body.read(1024 * 1024), b""):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def run(args):
+    checkpoint = Checkpoint(args.checkpoint)
+    products = list_flat_products(args.bucket, args.account)
+    todo = {p: o for p, o in products.items() if not checkpoint.done(p, o, args.delete_source)}
+    print(f"{len(products)} products with flat keys, {len(products) - len(todo)} already done")
+
+    results = collections.Counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(migrate_product, args, p, o): p for p, o in sorted(todo.items())}
+        for future in concurrent.futures.as_completed(futures):
+            product = futures[future]
+            try:
+                status, reason = future.result()
+            except botocore.exceptions.ClientError as e:
+                # PreconditionFailed: an object changed since it was listed
+                status, reason = FAILED, repr(e)
+            results[status] += 1
+            if reason:
+                print(f"{product}: {status}: {reason}")
+            if not args.dry_run:
+                checkpoint.record(product, todo[product], status, reason)
+
+    print(", ".join(f"{status} {count}" for status, count in sorted(results.items())) or "nothing to migrate")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate tfstate bucket objects to the sharded key layout")
+    parser.add_argument("--bucket", required=True, help="engine tfstate bucket")
+    parser.add_argument("--partitions", type=int, default=state_keys.PARTITIONS, help="var.state_key_partitions")
+    parser.add_argument("--account", action="append", default=[], help="only migrate products of this account id")
+    parser.add_argument("--scheduler-prefix", default="scheduler/", help="scheduler documents prefix")
+    parser.add_argument("--workers", type=int, default=16, help="products migrated in parallel")
+    parser.add_argument("--checkpoint", help="progress file, default migrate-state-keys-<bucket>.jsonl")
+    parser.add_argument("--delete-source", action="store_true", help="delete flat objects after verifying the copies")
+    parser.add_argument("--dry-run", action="store_true", help="print the copies and deletes without making them")
+    args = parser.parse_args()
+    args.checkpoint = args.checkpoint or f"migrate-state-keys-{args.bucket}.jsonl"
+
+    results = run(args)
+    sys.exit(1 if results[FAILED] else 0)
+
+
+if __name__ == "__main__":
+    main()